@@ -1,16 +1,25 @@
-import os
 import six
 import sys
 from abc import (
     ABCMeta,
     abstractmethod,
 )
-from argparse import (
-    ArgumentParser,
+from collections import (
+    OrderedDict,
 )
 from inspect import (
     isclass,
 )
+from operator import (
+    attrgetter,
+)
+from threading import (
+    Lock,
+)
+from types import (
+    MethodType,
+    ModuleType,
+)
 
 from django import (
     VERSION,
@@ -18,11 +27,8 @@ from django import (
 from django.conf import (
     settings,
 )
-from django.core import (
-    management,
-)
-from django.db import (
-    transaction as _transaction,
+from django.core.exceptions import (
+    ValidationError,
 )
 from django.db.models.base import (
     Model,
@@ -33,11 +39,33 @@ from django.db.models.fields.related import (
 from django.db.models.manager import (
     Manager as _Manager,
 )
-from django.http import (
-    HttpResponse,
+from django.db.models.signals import (
+    class_prepared,
 )
-from django.template import (
-    loader,
+from django.template.context import (
+    Context,
+    RequestContext,
+)
+
+from m3_django_compat.identity import (
+    connect_signals as _connect_identity_map_signals,
+    get_identity_map,
+)
+from m3_django_compat.queries import (
+    bulk_update,
+    bulk_upsert,
+    in_bulk_chunked,
+    iterate_chunks,
+    prefetch_related_chunked,
+)
+from m3_django_compat.transaction import (
+    atomic,
+    atomic_many,
+    atomic_retry,
+    commit_unless_managed,
+    in_atomic_block,
+    on_commit,
+    transaction_cached,
 )
 
 
@@ -61,9 +89,6 @@ if MIN_SUPPORTED_VERSION <= _VERSION < (3, 0):
     from django.utils.decorators import (
         classproperty,
     )
-    from django.contrib.postgres.fields import (
-        JSONField,
-    )
 else:
     from django.core.exceptions import (
         FieldDoesNotExist,
@@ -71,40 +96,169 @@ else:
     from django.utils.functional import (
         classproperty,
     )
-    from django.db.models import (
-        JSONField,
+
+if _VERSION < (1, 8):
+    from django.test.signals import (
+        setting_changed,
+    )
+else:
+    from django.core.signals import (
+        setting_changed,
     )
 # -----------------------------------------------------------------------------
+# Сброс кэшей, зависящих от реестра моделей
+
+
+#: Поколение кэшей данных о моделях.
+#:
+#: Увеличивается при регистрации новых моделей и при изменении списка
+#: подключенных приложений, делая недействительными все ранее созданные кэши.
+_models_generation = 0
+
+
+def _expire_models_cache(**kwargs):
+    global _models_generation  # pylint: disable=global-statement
+    _models_generation += 1
+
+
+def _on_setting_changed(setting, **kwargs):
+    if setting == 'INSTALLED_APPS':
+        _expire_models_cache()
+
+
+class_prepared.connect(
+    _expire_models_cache, dispatch_uid='m3_django_compat.models_cache'
+)
+setting_changed.connect(
+    _on_setting_changed, dispatch_uid='m3_django_compat.models_cache'
+)
+# -----------------------------------------------------------------------------
+
+
+_installed_apps = None
+_installed_apps_set = None
+
+
+def _reset_installed_apps(setting, **kwargs):
+    # pylint: disable=global-statement
+    global _installed_apps, _installed_apps_set
+    global _user_model, _auth_user_model
+
+    if setting == 'INSTALLED_APPS':
+        _installed_apps = _installed_apps_set = None
+
+    if setting in ('INSTALLED_APPS', 'AUTH_USER_MODEL'):
+        _user_model = _auth_user_model = _UNDEFINED
+
+
+setting_changed.connect(
+    _reset_installed_apps, dispatch_uid='m3_django_compat.installed_apps'
+)
 
 
 def get_installed_apps():
     """Возвращает имена пакетов с django-приложениями.
 
+    Результат кэшируется до изменения параметра ``INSTALLED_APPS``.
+
     .. note::
 
        Невозможность обхода в цикле списка ``INSTALLED_APPS`` обусловлена
        тем, что начиная с Django 1.7 приложения проекта могут быть указаны
        как путь до класса с конфигурацией приложения, например как
        ``project.app1.apps.AppConfig``.
+
+    :rtype: tuple
     """
-    if _VERSION < (1, 7):
-        result = settings.INSTALLED_APPS
+    global _installed_apps  # pylint: disable=global-statement
 
-    else:
-        from django.apps import (
-            apps,
-        )
+    if _installed_apps is None:
+        if _VERSION < (1, 7):
+            _installed_apps = tuple(settings.INSTALLED_APPS)
 
-        result = (
-            app_config.name
-            for app_config in apps.get_app_configs()
-        )
+        else:
+            from django.apps import (
+                apps,
+            )
 
-    return result
+            _installed_apps = tuple(
+                app_config.name
+                for app_config in apps.get_app_configs()
+            )
+
+    return _installed_apps
+
+
+def _get_installed_apps_set():
+    """Возвращает множество имен пакетов с django-приложениями.
+
+    :rtype: frozenset
+    """
+    global _installed_apps_set  # pylint: disable=global-statement
+
+    if _installed_apps_set is None:
+        _installed_apps_set = frozenset(get_installed_apps())
+
+    return _installed_apps_set
 # -----------------------------------------------------------------------------
 # Загрузка модели
 
 
+if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 6):
+    from django.db.models.loading import (
+        get_model as _get_model,
+        get_models as _get_models,
+    )
+
+    def _get_registry_models():
+        return _get_models(include_auto_created=True)
+else:
+    from django.apps import (
+        apps as _apps,
+    )
+
+    _get_model = _apps.get_model
+
+    def _get_registry_models():
+        if _apps.models_ready:
+            return _apps.get_models(
+                include_auto_created=True, include_swapped=True
+            )
+
+
+_models_index = None
+_models_index_generation = None
+
+
+def _get_models_index():
+    """Возвращает индекс моделей по имени приложения и имени модели.
+
+    Ключами индекса являются пары из имени приложения и имени модели в
+    нижнем регистре. Индекс перестраивается после регистрации новых моделей
+    и изменения списка подключенных приложений. Если реестр моделей еще не
+    загружен, возвращает ``None``.
+
+    :rtype: dict or NoneType
+    """
+    # pylint: disable=global-statement
+    global _models_index, _models_index_generation
+
+    if (_models_index is None or
+            _models_index_generation != _models_generation):
+        generation = _models_generation
+        models = _get_registry_models()
+        if models is None:
+            return None
+
+        _models_index = dict(
+            ((model._meta.app_label, model._meta.object_name.lower()), model)
+            for model in models
+        )
+        _models_index_generation = generation
+
+    return _models_index
+
+
 def get_model(app_label, model_name):
     """Возвращает класс модели.
 
@@ -113,45 +267,56 @@ def get_model(app_label, model_name):
 
     :rtype: :class:`django.db.models.base.ModelBase`
     """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 6):
-        from django.db.models.loading import (
-            get_model as get_model_,
-        )
-        result = get_model_(app_label, model_name)
-    else:
-        from django.apps import (
-            apps,
-        )
-        result = apps.get_model(app_label, model_name)
+    index = _get_models_index()
+    if index is not None:
+        result = index.get((app_label, model_name.lower()))
+        if result is not None:
+            return result
+
+    result = _get_model(app_label, model_name)
+    if index is not None and result is not None:
+        index[app_label, model_name.lower()] = result
+
+    return result
+
+
+def get_models(model_references):
+    """Возвращает классы моделей по ссылкам вида ``'app_label.ModelName'``.
+
+    Все ссылки разрешаются за один проход по индексу моделей, поэтому
+    функция предпочтительнее многократного вызова :func:`get_model`.
+
+    :param model_references: Ссылки на модели.
+
+    :rtype: list
+    """
+    index = _get_models_index() or {}
+
+    result = []
+    for reference in model_references:
+        try:
+            app_label, model_name = reference.split('.')
+        except ValueError:
+            raise ValueError(
+                "Model reference must be of the form 'app_label.ModelName', "
+                "got '{}'.".format(reference)
+            )
+
+        model = index.get((app_label, model_name.lower()))
+        if model is None:
+            model = get_model(app_label, model_name)
+        result.append(model)
 
     return result
 # -----------------------------------------------------------------------------
 # Модель "Учетная запись"
 
 
-#: Содержит имя приложения и имя класса модели учетной записи.
-#:
-#: Строка содержит данные в виде, пригодном для использования при описании
-#: внешних ключей (``ForeignKey``, ``OneToOneField`` и т.п.), ссылающихся
-#: на модель учетной записи.
-#:
-#: Если подключено приложение ``'django.contrib.auth'``, то для Django 1.4
-#: всегда содержит значение ``'auth.User'``, а для более старших версий --
-#: значение параметра ``AUTH_USER_MODEL`` из настроек системы. Если же
-#: приложение ``'django.contrib.auth'`` не подключено, содержит ``None``.
-#:
-#: .. code::
-#:
-#:    from m3_django_compat import AUTH_USER_MODEL
-#:
-#:    class Person(models.Model):
-#:        user = models.ForeignKey(AUTH_USER_MODEL)
-AUTH_USER_MODEL = None
-if any(
-    app_package_name.startswith('django.contrib.auth')
-    for app_package_name in settings.INSTALLED_APPS
-):
-    AUTH_USER_MODEL = 'auth.User' if _14 else settings.AUTH_USER_MODEL
+_UNDEFINED = object()
+
+_user_model = _UNDEFINED
+
+_auth_user_model = _UNDEFINED
 
 
 def get_user_model():
@@ -162,9 +327,17 @@ def get_user_model():
     версий 1.5 и старше - результат вызова
     :func:`django.contrib.auth.get_user_model`.
 
+    Результат кэшируется до изменения параметров ``INSTALLED_APPS`` или
+    ``AUTH_USER_MODEL``.
+
     :rtype: :class:`django.db.models.base.ModelBase` or :class:`NoneType`
     """
-    if 'django.contrib.auth' not in get_installed_apps():
+    global _user_model  # pylint: disable=global-statement
+
+    if _user_model is not _UNDEFINED:
+        return _user_model
+
+    if 'django.contrib.auth' not in _get_installed_apps_set():
         result = None
     elif _14:
         result = get_model('auth', 'User')
@@ -174,121 +347,43 @@ def get_user_model():
         )
         result = _get_user_model()
 
+    _user_model = result
+
     return result
 # -----------------------------------------------------------------------------
-# Транзакции
-
-
-def in_atomic_block(using=None):
-    """Возвращает ``True``, если в момент вызова открыта транзакция.
-
-    Если включен режим автоподтверждения (autocommit), то возвращает ``False``.
-
-    :param str using: Алиас базы данных.
+# Обеспечение совместимости менеджеров моделей
 
-    :rtype: bool
-    """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-        result = _transaction.is_managed(using)
-    else:
-        result = _transaction.get_connection(using).in_atomic_block
 
-    return result
+#: Имена методов менеджера моделей, переименованных в Django 1.6.
+_RENAMED_MANAGER_METHODS = (
+    ('get_query_set', 'get_queryset'),
+    ('get_prefetch_query_set', 'get_prefetch_queryset'),
+)
 
 
-if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-    class _Atomic(object):
+class _ManagerBase(type(_Manager)):
 
-        def __init__(self, savepoint):
-            self._savepoint = savepoint
-            self._sid = None
+    """Метакласс менеджеров моделей.
 
-        def entering(self, using):
-            # pylint: disable=attribute-defined-outside-init
-            if in_atomic_block(using):
-                if self._savepoint:
-                    self._sid = _transaction.savepoint(using)
-            else:
-                self._commit_on_exit = True
-
-                _transaction.enter_transaction_management(using=using)
-                _transaction.managed(True, using=using)
-
-        def exiting(self, exc_value, using):
-            if self._sid:
-                if self._savepoint:
-                    if exc_value is None:
-                        _transaction.savepoint_commit(self._sid, using)
-                    else:
-                        _transaction.savepoint_rollback(self._sid, using)
-            else:
-                try:
-                    if exc_value is not None:
-                        if _transaction.is_dirty(using=using):
-                            _transaction.rollback(using=using)
-                    else:
-                        if _transaction.is_dirty(using=using):
-                            try:
-                                _transaction.commit(using=using)
-                            except:  # noqa
-                                _transaction.rollback(using=using)
-                                raise
-                finally:
-                    _transaction.leave_transaction_management(using=using)
-
-
-def atomic(using=None, savepoint=True):
-    """Совместимый аналог декоратора/менеджера контекста ``atomic``.
-
-    В Django>=1.6 задействует функционал ``atomic``, а в версиях ниже 1.6
-    имитирует его поведение средствами модуля ``django.db.transaction``, при
-    этом, в отличие от ``commit_on_success`` из Django<1.6, поддерживает
-    вложенность.
-
-    :param str using: Алиас базы данных. Если указано значение ``None``, будет
-        использован алиас базы данных по умолчанию.
-    :param bool savepoint: Определяет, будут ли использоваться точки сохранения
-        (savepoints) при использовании вложенных ``atomic``.
+    Если в классе менеджера определен только один из методов с прежним и
+    новым именем, то под вторым именем в классе сохраняется тот же метод.
     """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-        if callable(using):
-            # atomic вызван как декоратор без параметров
-            from django.db.utils import (
-                DEFAULT_DB_ALIAS,
-            )
-            func = using
-            using = DEFAULT_DB_ALIAS
-        else:
-            func = None
-
-        atomic_ = _Atomic(savepoint)
-        result = _transaction._transaction_func(
-            atomic_.entering, atomic_.exiting, using
-        )
-
-        if func:
-            result = result(func)
-    else:
-        result = _transaction.atomic(using, savepoint)
-
-    return result
 
+    if (1, 6) <= _VERSION <= (1, 7):
+        # Подавление предупреждения о необходимости переименования методов.
+        renamed_methods = ()
 
-def commit_unless_managed(using=None):
-    """Совместимый аналог функции commit_unless_managed.
+    def __new__(mcs, name, bases, attrs):
+        for old_name, new_name in _RENAMED_MANAGER_METHODS:
+            if old_name in attrs and new_name not in attrs:
+                attrs[new_name] = attrs[old_name]
+            elif new_name in attrs and old_name not in attrs:
+                attrs[old_name] = attrs[new_name]
 
-    В Django 1.6+ эта функция была помечена, как устаревшая, а в Django 1.8+
-    была удалена.
-    """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-        from django.db.transaction import (
-            commit_unless_managed as func,
-        )
-        return func(using)
-# -----------------------------------------------------------------------------
-# Обеспечение совместимости менеджеров моделей
+        return super(_ManagerBase, mcs).__new__(mcs, name, bases, attrs)
 
 
+@six.add_metaclass(_ManagerBase)
 class Manager(_Manager):
 
     """Базовый класс для менеджеров моделей.
@@ -296,114 +391,319 @@ class Manager(_Manager):
     Создан в связи с переименованием в Django 1.6 метода ``get_query_set`` в
     ``get_queryset`` и ``get_prefetch_query_set`` в ``get_prefetch_queryset``.
 
-    "Пробрасывает" вызовы этих методов к методам
-    :class:`django.db.models.manager.Manager`, соответствующим используемой
-    версии Django.
+    Методы доступны под обоими именами, при этом метод, переопределенный в
+    потомке под одним из имен, используется и под другим именем (в т.ч. при
+    вызове из методов :class:`django.db.models.manager.Manager`). Связь имен
+    устанавливается один раз при создании класса менеджера.
 
     Предназначен для использования в качестве базового класса вместо
     :class:`django.db.models.manager.Manager`.
     """
 
-    if (1, 6) <= _VERSION <= (1, 7):
-        # Подавление предупреждения о необходимости переименования методов.
-        from django.db.models.manager import (
-            RenameManagerMethods,
-        )
+    #: Определяет, используется ли менеджером карта идентичности объектов
+    #: (см. :mod:`m3_django_compat.identity`).
+    use_identity_map = False
 
-        # pylint: disable=invalid-name
-        class __metaclass__(RenameManagerMethods):
-            renamed_methods = ()
+    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
+        get_query_set = six.get_unbound_function(_Manager.get_query_set)
+    else:
+        get_queryset = six.get_unbound_function(_Manager.get_queryset)
 
-    def __get_queryset_method(self):
-        if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-            result = super(Manager, self).get_query_set
-        else:
-            result = super(Manager, self).get_queryset
+    def contribute_to_class(self, model, name, *args, **kwargs):
+        super(Manager, self).contribute_to_class(model, name, *args, **kwargs)
+        if self.use_identity_map:
+            _connect_identity_map_signals(model)
 
-        return result
+    def _get_identity_map(self):
+        """Возвращает карту идентичности, используемую менеджером.
+
+        Менеджеры связей (``parent.child_set``) наследуют класс менеджера
+        модели, но ограничивают выборку объектом-владельцем, поэтому карта
+        идентичности в них не используется.
+        """
+        if (
+            not self.use_identity_map or
+            getattr(self, 'core_filters', None) is not None or
+            getattr(self, 'instance', None) is not None
+        ):
+            return None
 
-    @property
-    def get_queryset(self):
-        return self.__get_queryset_method()
+        return get_identity_map()
 
-    @property
-    def get_query_set(self):
-        return self.__get_queryset_method()
+    def _get_identity_map_pk(self, kwargs):
+        """Возвращает значение первичного ключа из параметров ``get``.
 
-    def __get_prefetch_queryset_method(self):
-        if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 5):
-            result = super(Manager, self).get_prefetch_query_set
-        else:
-            result = super(Manager, self).get_prefetch_queryset
+        :returns: Значение первичного ключа или ``None``, если параметры
+            содержат другие условия.
+        """
+        if len(kwargs) != 1:
+            return None
+
+        (name, value), = kwargs.items()
+        if name.endswith('__exact'):
+            name = name[:-len('__exact')]
+        pk_field = self.model._meta.pk
+        if name not in ('pk', pk_field.name, pk_field.attname):
+            return None
+
+        try:
+            return pk_field.to_python(value)
+        except ValidationError:
+            return None
+
+    def get(self, *args, **kwargs):
+        objects = self._get_identity_map()
+        pk = None if objects is None or args else (
+            self._get_identity_map_pk(kwargs)
+        )
+        if pk is None:
+            return super(Manager, self).get(*args, **kwargs)
+
+        obj = objects.get(self, pk)
+        if obj is None:
+            obj = super(Manager, self).get(**kwargs)
+            objects.add(self, (obj,))
+
+        return obj
+
+    def in_bulk(self, id_list=None, *args, **kwargs):
+        objects = self._get_identity_map()
+        if (
+            objects is None or id_list is None or args or
+            kwargs.get('field_name', 'pk') != 'pk'
+        ):
+            return super(Manager, self).in_bulk(id_list, *args, **kwargs)
+
+        to_python = self.model._meta.pk.to_python
+        result, missing = objects.get_many(
+            self, [to_python(pk) for pk in id_list]
+        )
+        if missing:
+            loaded = super(Manager, self).in_bulk(missing)
+            objects.add(self, loaded.values())
+            result.update(loaded)
 
         return result
 
-    @property
-    def get_prefetch_queryset(self):
-        return self.__get_prefetch_queryset_method()
+    def iterate_chunks(self, chunk_size=1000, order_by='pk', values=None):
+        """Возвращает итератор по записям, загружаемым частями.
 
-    @property
-    def get_prefetch_query_set(self):
-        return self.__get_prefetch_queryset_method()
-# -----------------------------------------------------------------------------
-# Базовый класс для загрузчика шаблонов
+        См. :func:`m3_django_compat.queries.iterate_chunks`.
+        """
+        return iterate_chunks(self, chunk_size, order_by, values)
 
+    def in_bulk_chunked(self, ids, field='pk', chunk_size=None,
+                        threads=None):
+        """Возвращает объекты с указанными значениями поля.
 
-if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
-    from django.template.loader import (
-        BaseLoader,
-    )
-else:
-    from django.template.loaders.base import (
-        Loader as BaseLoader,
-    )
+        См. :func:`m3_django_compat.queries.in_bulk_chunked`.
+        """
+        return in_bulk_chunked(self, ids, field, chunk_size, threads)
+
+    def prefetch_related_chunked(self, objs, *lookups, **kwargs):
+        """Загружает связанные объекты для объектов модели частями.
+
+        См. :func:`m3_django_compat.queries.prefetch_related_chunked`.
+        """
+        prefetch_related_chunked(objs, *lookups, **kwargs)
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        """Обновляет значения полей объектов в БД.
+
+        См. :func:`m3_django_compat.queries.bulk_update`.
+        """
+        bulk_update(self, objs, fields, batch_size)
+    bulk_update.alters_data = True
+
+    def bulk_upsert(self, objs, unique_fields, update_fields=None,
+                    batch_size=None):
+        """Добавляет в БД новые объекты и обновляет существующие.
+
+        См. :func:`m3_django_compat.queries.bulk_upsert`.
+        """
+        bulk_upsert(self, objs, unique_fields, update_fields, batch_size)
+    bulk_upsert.alters_data = True
 # -----------------------------------------------------------------------------
 # Средства обеспечения совместимости с разными версиями Model API
 
 
 class RelatedObject(object):
 
-    """Совместимый аналог RelatedObject."""
+    """Совместимый аналог RelatedObject.
 
-    def __init__(self, relation):
-        self.relation = relation
+    Часто используемые атрибуты связи вычисляются при создании объекта,
+    остальные атрибуты берутся непосредственно из связи.
+    """
+
+    __slots__ = (
+        'relation', 'model', 'field', 'related_model', 'model_name',
+        'parent_model',
+    )
+
+    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
+        def __init__(self, relation):
+            self.relation = relation
+            self.model = self.parent_model = relation.model
+            self.field = relation.field
+            self.related_model = relation.model
+            self.model_name = relation.var_name
+    else:
+        def __init__(self, relation):
+            self.relation = relation
+            self.model = self.parent_model = relation.model
+            self.field = relation.field
+            self.related_model = relation.related_model
+            self.model_name = self.related_model._meta.model_name
 
     def __repr__(self, *args, **kwargs):
         return '{}: {}'.format(self.__class__.__name__, self.relation)
 
     def __getattr__(self, name):
+        if name == 'relation':
+            raise AttributeError(name)
         return getattr(self.relation, name)
 
-    @property
-    def model_name(self):
-        if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
-            result = self.relation.var_name
-        else:
-            result = self.relation.related_model._meta.model_name
-        return result
 
-    @property
-    def parent_model(self):
-        return self.relation.model
+def _get_related_object(relation):
+    """Возвращает общий для всех вызовов RelatedObject для связи.
 
+    Объект создается один раз и хранится в самой связи. До загрузки реестра
+    моделей связи могут ссылаться на еще не загруженные модели, поэтому в
+    этом случае каждый раз создается новый объект.
 
-def get_related(field):
-    """Возвращает RelatedObject для поля модели.
-
-    :param field: Поле модели.
-    :type field: django.db.models.fields.related.RelatedField
+    :rtype: RelatedObject
     """
-    assert isinstance(field, RelatedField), field
+    result = getattr(relation, '_compat_related_object', None)
+    # Связь могла быть скопирована вместе с атрибутами.
+    if result is None or result.relation is not relation:
+        result = RelatedObject(relation)
+        if _models_ready(relation.field.model._meta):
+            relation._compat_related_object = result
 
-    if _VERSION <= (1, 7):
-        result = field.related
-    elif _VERSION == (1, 8):
-        result = RelatedObject(field.related)
-    else:
-        result = RelatedObject(field.remote_field)
     return result
 
 
+if _VERSION <= (1, 7):
+    def get_related(field):
+        """Возвращает RelatedObject для поля модели.
+
+        В Django>=1.8 для одного и того же поля всегда возвращается один и
+        тот же объект.
+
+        :param field: Поле модели.
+        :type field: django.db.models.fields.related.RelatedField
+        """
+        assert isinstance(field, RelatedField), field
+
+        return field.related
+else:
+    _get_relation = attrgetter(
+        'related' if _VERSION == (1, 8) else 'remote_field'
+    )
+
+    def get_related(field):
+        """Возвращает RelatedObject для поля модели.
+
+        В Django>=1.8 для одного и того же поля всегда возвращается один и
+        тот же объект.
+
+        :param field: Поле модели.
+        :type field: django.db.models.fields.related.RelatedField
+        """
+        assert isinstance(field, RelatedField), field
+
+        relation = _get_relation(field)
+        result = getattr(relation, '_compat_related_object', None)
+        if result is None or result.relation is not relation:
+            result = _get_related_object(relation)
+
+        return result
+
+
+class _ModelCache(object):
+
+    """Кэш данных о модели."""
+
+    __slots__ = (
+        'generation', 'options',
+        'fields', 'compat_fields', 'missing_fields',
+        'related_objects', 'm2m_with_model',
+    )
+
+    def __init__(self):
+        self.generation = _models_generation
+        # Экземпляры ModelOptions (и его потомков) для модели.
+        self.options = {}
+        # Результаты get_field_by_name по именам полей.
+        self.fields = None
+        # Поля, доступные через get_field.
+        self.compat_fields = None
+        # Аргументы исключений FieldDoesNotExist для отсутствующих полей.
+        self.missing_fields = None
+        # Результаты get_all_related_objects и get_m2m_with_model.
+        self.related_objects = None
+        self.m2m_with_model = None
+
+
+if _VERSION < (1, 8):
+    def _get_model_cache(opts):
+        """Возвращает актуальный кэш данных о модели.
+
+        Кэш хранится в параметрах модели, поэтому живет не дольше самой
+        модели.
+
+        :param opts: Параметры модели (``Model._meta``).
+
+        :rtype: _ModelCache or NoneType
+        """
+        cache = getattr(opts, '_compat_cache', None)
+        if cache is None or cache.generation != _models_generation:
+            cache = _ModelCache()
+            try:
+                opts._compat_cache = cache
+            except AttributeError:
+                return None
+
+        return cache
+else:
+    def _get_model_cache(opts):
+        """Возвращает актуальный кэш данных о модели.
+
+        Кэш хранится в словаре ``Options._get_fields_cache``, который реестр
+        приложений заменяет новым при сбросе кэшей (``apps.clear_cache()``),
+        регистрации моделей и добавлении в модель полей. Поэтому кэш
+        устаревает одновременно с кэшем полей самой модели.
+
+        :param opts: Параметры модели (``Model._meta``).
+
+        :rtype: _ModelCache or NoneType
+        """
+        fields_cache = getattr(opts, '_get_fields_cache', None)
+        if fields_cache is None:
+            return None
+
+        try:
+            cache = fields_cache[_ModelCache]
+        except KeyError:
+            cache = fields_cache[_ModelCache] = _ModelCache()
+
+        return cache
+
+
+if _VERSION < (1, 7):
+    def _models_ready(opts):
+        # До Django 1.7 реестр моделей загружается по требованию при первом
+        # обращении к связям модели.
+        return True
+else:
+    def _models_ready(opts):
+        return opts.apps.models_ready
+
+
+#: Максимальное количество запоминаемых отсутствующих в модели полей.
+_MAX_MISSING_FIELDS = 1024
+
+
 class ModelOptions(object):
 
     """Совместимые параметры модели (``Model._meta``).
@@ -424,89 +724,363 @@ class ModelOptions(object):
             issubclass(self.model, Model)
         )
 
-    def get_field(self, name):
-        if (not self.is_django_model or
-                MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7)):
+    @classmethod
+    def for_model(cls, model):
+        """Возвращает общий для всех вызовов экземпляр для модели.
+
+        В отличие от создания нового экземпляра, повторные вызовы для одной
+        и той же модели возвращают закэшированный объект. Кэш сбрасывается
+        при перезагрузке реестра приложений.
+
+        :param model: Класс модели или ее экземпляр.
+
+        :rtype: ModelOptions
+        """
+        cache = _get_model_cache(getattr(model, '_meta', None))
+        if cache is None:
+            return cls(model)
+
+        options = cache.options
+        result = options.get(cls)
+        if result is None:
+            result = options[cls] = cls(model)
+
+        return result
+
+    def _get_fields_index(self):
+        """Возвращает кэш модели с построенным индексом полей.
+
+        Если реестр моделей еще не загружен, возвращает ``None``, т.к. в этом
+        случае обратные связи модели недоступны.
+
+        :rtype: _ModelCache or NoneType
+        """
+        cache = _get_model_cache(self.opts)
+        if cache.fields is None:
+            if not _models_ready(self.opts):
+                return None
+
+            fields = {}
+            compat_fields = {}
+
+            # Как и в Options.get_field, прямые поля имеют приоритет над
+            # обратными связями.
+            all_fields = self.opts.get_fields(include_hidden=True)
+            for reverse in (False, True):
+                for field in all_fields:
+                    if (field.auto_created and not field.concrete) != reverse:
+                        continue
+
+                    field_info = (
+                        field,
+                        field.model,
+                        not field.auto_created or field.concrete,
+                        field.many_to_many,
+                    )
+                    is_compat = not (
+                        field.auto_created or
+                        field.is_relation and field.related_model is None
+                    )
+                    for name in (field.name, getattr(field, 'attname', None)):
+                        if name is not None and name not in fields:
+                            fields[name] = field_info
+                            if is_compat:
+                                compat_fields[name] = field
+
+            cache.fields = fields
+            cache.compat_fields = compat_fields
+            cache.missing_fields = {}
+
+        return cache
+
+    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
+        def get_field(self, name):
             return self.opts.get_field(name)
-        else:
-            field = self.opts.get_field(name)
 
-            if (field.auto_created or
-                    field.is_relation and field.related_model is None):
-                raise FieldDoesNotExist("{} has no field named '{}'"
-                                        .format(self.model.__name__, name))
+        def get_field_by_name(self, name):
+            return self.opts.get_field_by_name(name)
+    else:
+        def get_field(self, name):
+            if not self.is_django_model:
+                return self.opts.get_field(name)
+
+            # Основной сценарий (индекс уже построен) обрабатывается без
+            # дополнительных вызовов.
+            cache = self.opts._get_fields_cache.get(_ModelCache)
+            if cache is None or cache.fields is None:
+                cache = self._get_fields_index()
+            if cache is not None:
+                field = cache.compat_fields.get(name)
+                if field is not None:
+                    return field
+
+                args = cache.missing_fields.get(name)
+                if args is not None:
+                    raise FieldDoesNotExist(*args)
+
+            try:
+                field = self.opts.get_field(name)
+
+                if (field.auto_created or
+                        field.is_relation and field.related_model is None):
+                    raise FieldDoesNotExist("{} has no field named '{}'"
+                                            .format(self.model.__name__, name))
+            except FieldDoesNotExist as error:
+                if (cache is not None and
+                        len(cache.missing_fields) < _MAX_MISSING_FIELDS):
+                    cache.missing_fields[name] = error.args
+                raise
 
             return field
 
-    def get_field_by_name(self, name):
-        if (not self.is_django_model or
-                MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7)):
-            result = self.opts.get_field_by_name(name)
-        else:
-            field = self.opts.get_field(name)
+        def get_field_by_name(self, name):
+            if not self.is_django_model:
+                return self.opts.get_field_by_name(name)
+
+            cache = self.opts._get_fields_cache.get(_ModelCache)
+            if cache is None or cache.fields is None:
+                cache = self._get_fields_index()
+            result = cache.fields.get(name) if cache is not None else None
+            if result is None:
+                # Словарь отсутствующих полей общий с get_field: поля,
+                # недоступные только через get_field (обратные связи и
+                # т.п.), есть в индексе и до этой проверки не доходят.
+                if cache is not None:
+                    args = cache.missing_fields.get(name)
+                    if args is not None:
+                        raise FieldDoesNotExist(*args)
 
-            result = (
-                field,
-                field.model,
-                not field.auto_created or field.concrete,
-                field.many_to_many,
-            )
-        return result
+                try:
+                    field = self.opts.get_field(name)
+                except FieldDoesNotExist as error:
+                    if (cache is not None and
+                            len(cache.missing_fields) < _MAX_MISSING_FIELDS):
+                        cache.missing_fields[name] = error.args
+                    raise
+
+                result = (
+                    field,
+                    field.model,
+                    not field.auto_created or field.concrete,
+                    field.many_to_many,
+                )
+
+            return result
+
+    def _get_ready_cache(self):
+        """Возвращает кэш данных о модели.
+
+        Если кэширование невозможно (модель не является моделью Django, либо
+        реестр моделей еще не загружен), возвращает ``None``.
+
+        :rtype: _ModelCache or NoneType
+        """
+        if self.is_django_model and _models_ready(self.opts):
+            return _get_model_cache(self.opts)
 
     def get_all_related_objects(self):
+        """Возвращает обратные связи модели "один ко многим" и "один к одному".
+
+        Результат кэшируется для модели, все вызывающие получают один и тот
+        же неизменяемый кортеж.
+
+        :rtype: tuple
+        """
+        cache = self._get_ready_cache()
+        if cache is not None and cache.related_objects is not None:
+            return cache.related_objects
+
         if (not self.is_django_model or
                 MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7)):
-            result = [
-                RelatedObject(relation)
+            result = tuple(
+                _get_related_object(relation)
                 for relation in self.model._meta.get_all_related_objects()
-            ]
+            )
         else:
-            result = [
-                RelatedObject(field)
+            result = tuple(
+                _get_related_object(field)
                 for field in self.model._meta.get_fields()
                 if (
                     (field.one_to_many or field.one_to_one) and
                     field.auto_created
                 )
-            ]
+            )
+
+        if cache is not None:
+            cache.related_objects = result
+
         return result
 
     def get_m2m_with_model(self):
+        """Возвращает поля "многие ко многим" модели.
+
+        Элементы результата - кортежи из поля и модели, в которой оно
+        объявлено (``None``, если поле объявлено в самой модели).
+
+        Результат кэшируется для модели, все вызывающие получают один и тот
+        же неизменяемый кортеж.
+
+        :rtype: tuple
+        """
+        cache = self._get_ready_cache()
+        if cache is not None and cache.m2m_with_model is not None:
+            return cache.m2m_with_model
+
         if (not self.is_django_model or
                 MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7)):
-            result = self.opts.get_m2m_with_model()
+            result = tuple(self.opts.get_m2m_with_model())
         else:
-            result = [
+            result = tuple(
                 (
                     field,
                     field.model if field.model != self.model else None
                 )
                 for field in self.opts.get_fields()
                 if field.many_to_many and not field.auto_created
-            ]
+            )
+
+        if cache is not None:
+            cache.m2m_with_model = result
+
         return result
+
+
+class _LRUCache(object):
+
+    """Кэш ограниченного размера.
+
+    При переполнении вытесняет элементы, к которым дольше всего не было
+    обращений.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                return default
+            self._data[key] = value
+
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+#: Максимальное количество запоминаемых путей к полям моделей.
+_MAX_FIELD_PATHS = 4096
+
+_field_paths = _LRUCache(_MAX_FIELD_PATHS)
+
+
+if _VERSION <= (1, 7):
+    def _get_related_model(field, direct):
+        if not direct:
+            # RelatedObject обратной связи.
+            return field.model
+        elif getattr(field, 'rel', None) is not None:
+            return field.rel.to
+else:
+    def _get_related_model(field, direct):
+        if field.is_relation:
+            return field.related_model
+
+
+def resolve_field_path(model, path):
+    """Возвращает цепочку полей, соответствующую пути поиска ORM.
+
+    Путь задается так же, как в аргументах ``QuerySet.filter``, например
+    ``'fk_field__m2m_field__name'``, и может включать обратные связи и
+    псевдоним ``pk``. Результаты кэшируются по модели и пути.
+
+    :param model: Класс модели или ее экземпляр.
+    :param str path: Путь к полю.
+
+    :returns: Кортеж пар (поле, модель, на которую оно ссылается). Для полей,
+        не являющихся связями, модель равна ``None``.
+    :rtype: tuple
+
+    :raises FieldDoesNotExist: если путь не соответствует полям моделей.
+    """
+    if not isclass(model):
+        model = model.__class__
+
+    key = (model, path)
+    model_cache = _get_model_cache(model._meta)
+    cached = _field_paths.get(key)
+    if cached is not None and cached[0] is model_cache:
+        return cached[1]
+
+    result = []
+    current_model = model
+    for name in path.split('__'):
+        if current_model is None:
+            raise FieldDoesNotExist(
+                "Cannot resolve '{}' of {}: '{}' is not a relation".format(
+                    path, model.__name__, result[-1][0].name
+                )
+            )
+
+        opts = ModelOptions.for_model(current_model)
+        if name == 'pk':
+            name = opts.opts.pk.name
+        field, _, direct, _ = opts.get_field_by_name(name)
+        current_model = _get_related_model(field, direct)
+        result.append((field, current_model))
+
+    result = tuple(result)
+    if _models_ready(model._meta):
+        _field_paths.set(key, (model_cache, result))
+
+    return result
 # -----------------------------------------------------------------------------
 # Доступ к HttpRequest.REQUEST
 
 
-def get_request_params(request):
-    """Возвращает параметры HTTP-запроса вне зависимости от его типа.
+def _get_request_params_17(request):
+    return request.REQUEST
 
-    В Django<=1.8 параметры были доступны в атрибуте ``REQUEST``, но в
-    Django>=1.9 этот атрибут был удален (в 1.7 - помечен, как устаревший).
-    """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
-        result = request.REQUEST
+
+def _get_request_params_18(request):
+    method = request.method
+    if method == 'GET':
+        result = request.GET
+    elif method == 'POST':
+        result = request.POST
     else:
-        if request.method == 'GET':
-            result = request.GET
-        elif request.method == 'POST':
-            result = request.POST
-        else:
-            result = {}
+        result = {}
 
     return result
+
+
+if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 7):
+    get_request_params = _get_request_params_17
+else:
+    get_request_params = _get_request_params_18
+get_request_params.__doc__ = """
+Возвращает параметры HTTP-запроса вне зависимости от его типа.
+
+В Django<=1.8 параметры были доступны в атрибуте ``REQUEST``, но в
+Django>=1.9 этот атрибут был удален (в 1.7 - помечен, как устаревший).
+"""
 # -----------------------------------------------------------------------------
+# Шаблоны
 
 
 class TemplateWrapper(object):
@@ -524,15 +1098,10 @@ class TemplateWrapper(object):
     def __getattr__(self, name):
         return getattr(self._template, name)
 
-    def render(self, context=None, request=None):
-        from django.template.context import (
-            Context as C,
-            RequestContext as RC,
-        )
-
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+    def _render_17(self, context=None, request=None):
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-        if isinstance(context, C) and _VERSION <= (1, 6):
+        if isinstance(context, Context) and _VERSION <= (1, 6):
             # Backport метода Context.flatten из Django 1.7
             def flatten(self):
                 flat = {}
@@ -540,43 +1109,58 @@ class TemplateWrapper(object):
                     flat.update(d)
                 return flat
 
-            from types import (
-                MethodType,
-            )
-
             context.flatten = MethodType(flatten, context, type(context))
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
+        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
-        if isinstance(context, RC):
-            if _VERSION <= (1, 7):
-                result = self._template.render(context)
-            else:
+        if isinstance(context, RequestContext):
+            result = self._template.render(context)
+
+        elif isinstance(context, Context):
+            if request:
                 result = self._template.render(
-                    context.flatten(), context.request
+                    RequestContext(request, context.flatten())
                 )
-
-        elif isinstance(context, C):
-            if _VERSION <= (1, 7):
-                if request:
-                    result = self._template.render(
-                        RC(request, context.flatten())
-                    )
-                else:
-                    result = self._template.render(context)
             else:
-                result = self._template.render(context.flatten(), request)
+                result = self._template.render(context)
 
         else:
-            if _VERSION <= (1, 7):
-                if request:
-                    result = self._template.render(RC(request, context))
-                else:
-                    result = self._template.render(C(context))
+            if request:
+                result = self._template.render(
+                    RequestContext(request, context)
+                )
             else:
-                result = self._template.render(context, request)
+                result = self._template.render(Context(context))
 
         return result
 
+    def _render_18(self, context=None, request=None):
+        if isinstance(context, RequestContext):
+            result = self._template.render(
+                context.flatten(), context.request
+            )
+        elif isinstance(context, Context):
+            result = self._template.render(context.flatten(), request)
+        else:
+            result = self._template.render(context, request)
+
+        return result
+
+    if _VERSION <= (1, 7):
+        render = _render_17
+    else:
+        render = _render_18
+    render.__doc__ = """
+    Возвращает результат отрисовки шаблона.
+
+    :param context: Контекст шаблона (:class:`dict`,
+        :class:`django.template.Context` или
+        :class:`django.template.RequestContext`).
+    :param request: HTTP-запрос.
+    :type request: django.http.HttpRequest
+
+    :rtype: str
+    """
+
 
 def get_template(*args, **kwargs):
     """Совместимый аналог функции :func:`django.template.loader.get_template`.
@@ -631,152 +1215,230 @@ class DatabaseRouterBase(object):
         def allow_migrate(self, db, app_label, model_name=None, **hints):
             return self._allow(db, app_label, model_name)
 # -----------------------------------------------------------------------------
+# Типы для wrapper-ов функций встроенных типов
+
+
+if sys.version_info < (3, 7):
+    WrapperDescriptorType = type(object.__init__)
+    MethodWrapperType = type(object().__init__)
+    MethodDescriptorType = type(str.join)
+else:
+    from types import (
+        MethodDescriptorType,
+        MethodWrapperType,
+        WrapperDescriptorType,
+    )
+# -----------------------------------------------------------------------------
+# Функции для совместимости c django 2.0
 
 
-class CommandParser(ArgumentParser):
+def _is_authenticated_111(user):
+    return user.is_authenticated()
 
-    def __init__(self, cmd, **kwargs):
-        self.cmd = cmd
-        super(CommandParser, self).__init__(**kwargs)
 
-    def parse_args(self, args=None, namespace=None):
-        # Catch missing argument for a better error message
-        if (hasattr(self.cmd, 'missing_args_message') and
-                not (args or any(
-                    not arg.startswith('-') for arg in args))):
-            self.error(self.cmd.missing_args_message)
-        return super(CommandParser, self).parse_args(args,
-                                                     namespace)
+def _is_authenticated_20(user):
+    return user.is_authenticated
 
-    def error(self, message):
-        if self.cmd._called_from_command_line:
-            super(CommandParser, self).error(message)
-        else:
-            raise management.CommandError("Error: %s" % message)
+
+if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 11):
+    is_authenticated = _is_authenticated_111
+else:
+    is_authenticated = _is_authenticated_20
+is_authenticated.__doc__ = """
+Возвращает True, если пользователь аутентифицирован.
+
+:param user: Объект модели пользователя из settings.AUTH_USER_MODEL.
+:type user: django.contrib.auth.base_user.AbstractBaseUser
+
+:rtype: bool
+"""
+
+# -----------------------------------------------------------------------------
+
+def render_to_response(template_name, context=None, content_type=None, status=None, using=None):
+    """
+    Return a HttpResponse whose content is filled with the result of calling
+    django.template.loader.render_to_string() with the passed arguments.
+    """
+    from django.http import (
+        HttpResponse,
+    )
+    from django.template import (
+        loader,
+    )
+    content = loader.render_to_string(template_name, context, using=using)
+    return HttpResponse(content, content_type, status)
+# -----------------------------------------------------------------------------
+# Отложенная загрузка атрибутов модуля
 
 
-class BaseCommand(management.BaseCommand):  # pylint: disable=abstract-method
+def _get_auth_user_model():
+    global _auth_user_model  # pylint: disable=global-statement
 
-    """Базовый класс для management-команд, использующий argparse."""
+    if _auth_user_model is _UNDEFINED:
+        if any(
+            app_package_name.startswith('django.contrib.auth')
+            for app_package_name in settings.INSTALLED_APPS
+        ):
+            _auth_user_model = 'auth.User' if _14 else settings.AUTH_USER_MODEL
+        else:
+            _auth_user_model = None
+
+    return _auth_user_model
 
-    def add_arguments(self, parser):
-        pass
 
-    def create_parser(self, prog_name, subcommand):
-        parser = CommandParser(
-            self, prog="%s %s" % (os.path.basename(prog_name), subcommand),
-            description=self.help or None,
+def _get_json_field():
+    if _VERSION < (3, 0):
+        from django.contrib.postgres.fields import (
+            JSONField,
         )
-        parser.add_argument('--version', action='version',
-                            version=self.get_version())
-        parser.add_argument(
-            '-v', '--verbosity', action='store', dest='verbosity',
-            default=1,
-            type=int, choices=[0, 1, 2, 3],
-            help='Verbosity level; 0=minimal output, 1=normal output, '
-                 '2=verbose output, 3=very verbose output',
+    else:
+        from django.db.models import (
+            JSONField,
         )
-        parser.add_argument(
-            '--settings',
-            help=(
-                'The Python path to a settings module, e.g. '
-                '"myproject.settings.main". If this isn\'t provided, the '
-                'DJANGO_SETTINGS_MODULE environment variable will be used.'
-            ),
+    return JSONField
+
+
+def _get_base_loader():
+    if _VERSION <= (1, 7):
+        from django.template.loader import (
+            BaseLoader,
         )
-        parser.add_argument(
-            '--pythonpath',
-            help='A directory to add to the Python path, e.g. '
-                 '"/home/djangoprojects/myproject".',
+    else:
+        from django.template.loaders.base import (
+            Loader as BaseLoader,
         )
-        parser.add_argument('--traceback', action='store_true',
-                            help='Raise on CommandError exceptions')
-
-        if _VERSION >= (1, 7):
-            parser.add_argument(
-                '--no-color', action='store_true', dest='no_color',
-                default=False,
-                help="Don't colorize the command output.",
-            )
-
-        if _VERSION >= (2,2):
-            parser.add_argument(
-                '--force-color', action='store_true',
-                help='Force colorization of the command output.',
-            )
+    return BaseLoader
 
-        parser.add_argument('args', nargs='*')
 
-        self.add_arguments(parser)
+def _get_loader():
+    from django.template import (
+        loader,
+    )
+    return loader
 
-        return parser
 
-    if _VERSION < (1, 8):
-        def run_from_argv(self, argv):
-            from django.core.management import (
-                CommandError,
-                handle_default_options,
-            )
+def _get_management():
+    from django.core import (
+        management,
+    )
+    return management
 
-            self._called_from_command_line = True
-            parser = self.create_parser(argv[0], argv[1])
 
-            options = parser.parse_args(argv[2:])
-            cmd_options = vars(options)
-            # Move positional args out of options to mimic legacy optparse
-            args = cmd_options.pop('args', ())
+def _get_http_response():
+    from django.http import (
+        HttpResponse,
+    )
+    return HttpResponse
 
-            handle_default_options(options)
-            try:
-                self.execute(*args, **cmd_options)
-            except Exception as e:  # pylint: disable=broad-except
-                if options.traceback or not isinstance(e, CommandError):
-                    raise
 
-                # SystemCheckError takes care of its own formatting.
-                if isinstance(e, CommandError):
-                    self.stderr.write(str(e), lambda x: x)
-                else:
-                    self.stderr.write('%s: %s' % (e.__class__.__name__, e))
-                sys.exit(1)
-# -----------------------------------------------------------------------------
-# Типы для wrapper-ов функций встроенных типов
+def _get_base_command():
+    from m3_django_compat.commands import (
+        BaseCommand,
+    )
+    return BaseCommand
 
 
-if sys.version_info < (3, 7):
-    WrapperDescriptorType = type(object.__init__)
-    MethodWrapperType = type(object().__init__)
-    MethodDescriptorType = type(str.join)
-else:
-    from types import (
-        MethodDescriptorType,
-        MethodWrapperType,
-        WrapperDescriptorType,
+def _get_command_parser():
+    from m3_django_compat.commands import (
+        CommandParser,
     )
-# -----------------------------------------------------------------------------
-# Функции для совместимости c django 2.0
+    return CommandParser
 
 
-def is_authenticated(user):
-    """Возвращает True, если пользователь аутентифицирован.
+#: Атрибуты модуля, значения которых вычисляются при первом обращении.
+#:
+#: Импорт соответствующих модулей Django (в т.ч. ``psycopg2`` для
+#: ``JSONField``) заметно увеличивает время запуска, а сами атрибуты нужны
+#: далеко не всегда.
+_LAZY_ATTRIBUTES = {
+    'BaseCommand': _get_base_command,
+    'BaseLoader': _get_base_loader,
+    'CommandParser': _get_command_parser,
+    'HttpResponse': _get_http_response,
+    'JSONField': _get_json_field,
+    'loader': _get_loader,
+    'management': _get_management,
+}
+
+#: Атрибуты модуля, значения которых зависят от настроек системы.
+#:
+#: Значения не сохраняются в атрибутах модуля, а кэшируются до изменения
+#: параметров ``INSTALLED_APPS`` или ``AUTH_USER_MODEL``.
+_DYNAMIC_ATTRIBUTES = {
+    # Содержит имя приложения и имя класса модели учетной записи.
+    #
+    # Строка содержит данные в виде, пригодном для использования при
+    # описании внешних ключей (``ForeignKey``, ``OneToOneField`` и т.п.),
+    # ссылающихся на модель учетной записи.
+    #
+    # Если подключено приложение ``'django.contrib.auth'``, то для Django 1.4
+    # всегда содержит значение ``'auth.User'``, а для более старших версий --
+    # значение параметра ``AUTH_USER_MODEL`` из настроек системы. Если же
+    # приложение ``'django.contrib.auth'`` не подключено, содержит ``None``.
+    #
+    # .. code::
+    #
+    #    from m3_django_compat import AUTH_USER_MODEL
+    #
+    #    class Person(models.Model):
+    #        user = models.ForeignKey(AUTH_USER_MODEL)
+    'AUTH_USER_MODEL': _get_auth_user_model,
+}
+
+
+class _LazyModule(ModuleType):
+
+    """Модуль с отложенной загрузкой атрибутов.
+
+    Заменяет исходный модуль в ``sys.modules``, т.к. атрибуты модулей
+    поддерживают отложенную загрузку (PEP 562) только в Python 3.7+.
+    Значения атрибутов хранятся в пространстве имен исходного модуля, с
+    которым работают функции модуля.
+    """
 
-    :param user: Объект модели пользователя из settings.AUTH_USER_MODEL.
-    :type user: django.contrib.auth.base_user.AbstractBaseUser
+    def __init__(self, module):
+        super(_LazyModule, self).__init__(module.__name__, module.__doc__)
+        # Остальные атрибуты, устанавливаемые конструктором (``__spec__`` и
+        # т.п.), должны браться из исходного модуля.
+        for name in tuple(self.__dict__):
+            if name not in ('__name__', '__doc__'):
+                del self.__dict__[name]
+        # Ссылка на исходный модуль нужна, т.к. в Python 2 при удалении
+        # модуля значения его глобальных переменных заменяются на None.
+        self.__dict__['_module'] = module
+        self.__dict__['_namespace'] = module.__dict__
 
-    :rtype: bool
+    def __getattr__(self, name):
+        namespace = self._namespace
+        if name in namespace:
+            value = namespace[name]
+        elif name in _LAZY_ATTRIBUTES:
+            value = namespace[name] = _LAZY_ATTRIBUTES[name]()
+        elif name in _DYNAMIC_ATTRIBUTES:
+            value = _DYNAMIC_ATTRIBUTES[name]()
+        else:
+            raise AttributeError(
+                'module {!r} has no attribute {!r}'.format(self.__name__, name)
+            )
 
-    """
-    if MIN_SUPPORTED_VERSION <= _VERSION <= (1, 11):
-        return user.is_authenticated()
-    else:
-        return user.is_authenticated
+        return value
 
-# -----------------------------------------------------------------------------
+    def __setattr__(self, name, value):
+        self._namespace[name] = value
 
-def render_to_response(template_name, context=None, content_type=None, status=None, using=None):
-    """
-    Return a HttpResponse whose content is filled with the result of calling
-    django.template.loader.render_to_string() with the passed arguments.
-    """
-    content = loader.render_to_string(template_name, context, using=using)
-    return HttpResponse(content, content_type, status)
+    def __delattr__(self, name):
+        try:
+            del self._namespace[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __dir__(self):
+        return sorted(
+            set(self._namespace) |
+            set(_LAZY_ATTRIBUTES) |
+            set(_DYNAMIC_ATTRIBUTES)
+        )
+
+
+sys.modules[__name__] = _LazyModule(sys.modules[__name__])
@@ -0,0 +1,282 @@
+# coding: utf-8
+"""Карта идентичности объектов моделей.
+
+Карта идентичности хранит объекты, загруженные методами ``get(pk=...)`` и
+``in_bulk`` менеджеров :class:`m3_django_compat.Manager` с атрибутом
+``use_identity_map = True``, и возвращает их при повторной загрузке без
+обращения к БД. Карта действует в пределах блока :func:`identity_map` (или
+запроса при использовании
+:class:`m3_django_compat.middleware.IdentityMapMiddleware`) и только в
+потоке, в котором был открыт блок.
+
+.. code::
+
+   class PersonManager(Manager):
+       use_identity_map = True
+
+   with identity_map() as objects:
+       Person.objects.get(pk=1)
+       Person.objects.get(pk=1)  # без запроса к БД
+       objects.hits, objects.misses  # (1, 1)
+
+Объекты удаляются из карты при сохранении и удалении (сигналы
+``post_save`` и ``post_delete``). Изменения, выполненные методами
+``QuerySet.update`` и ``QuerySet.delete`` без отправки сигналов, в карте не
+отражаются.
+"""
+from contextlib import (
+    contextmanager,
+)
+from threading import (
+    local,
+)
+
+from django.db.models.signals import (
+    class_prepared,
+    post_delete,
+    post_save,
+)
+
+
+def _get_concrete_model(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+
+# Конкретные модели, в таблицах которых хранятся объекты моделей: {модель:
+# множество конкретных моделей}.
+_table_models = {}
+
+
+def _get_table_models(model):
+    """Возвращает конкретные модели, в таблицах которых хранятся объекты.
+
+    Объекты модели, унаследованной от других конкретных моделей
+    (multi-table inheritance), хранятся также в таблицах родительских
+    моделей.
+
+    :rtype: frozenset
+    """
+    result = _table_models.get(model)
+    if result is None:
+        concrete_model = _get_concrete_model(model)
+        result = _table_models[model] = frozenset(
+            [concrete_model] + list(concrete_model._meta.get_parent_list())
+        )
+
+    return result
+
+
+class IdentityMap(object):
+
+    """Карта идентичности объектов моделей."""
+
+    def __init__(self):
+        # Объекты по моделям: {модель: {(алиас БД, класс менеджера):
+        # {первичный ключ: объект}}}.
+        self._objects = {}
+        #: Количество объектов, найденных в карте.
+        self.hits = 0
+        #: Количество объектов, не найденных в карте.
+        self.misses = 0
+
+    def _get_objects(self, manager):
+        model_objects = self._objects.get(manager.model)
+        if model_objects is None:
+            model_objects = self._objects[manager.model] = {}
+
+        key = (manager.db, manager.__class__)
+        objects = model_objects.get(key)
+        if objects is None:
+            objects = model_objects[key] = {}
+
+        return objects
+
+    def get(self, manager, pk):
+        """Возвращает объект из карты (либо ``None``, если его нет в карте).
+
+        :param manager: Менеджер модели.
+        :param pk: Значение первичного ключа.
+        """
+        obj = self._get_objects(manager).get(pk)
+        if obj is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return obj
+
+    def get_many(self, manager, pks):
+        """Возвращает объекты из карты.
+
+        :param manager: Менеджер модели.
+        :param pks: Значения первичных ключей.
+        :type pks: collections.Iterable
+
+        :returns: Кортеж из словаря с найденными объектами и списка значений
+            первичных ключей объектов, которых нет в карте.
+        :rtype: tuple
+        """
+        objects = self._get_objects(manager)
+        found = {}
+        missing = []
+        for pk in pks:
+            obj = objects.get(pk)
+            if obj is None:
+                missing.append(pk)
+            else:
+                found[pk] = obj
+        self.hits += len(found)
+        self.misses += len(missing)
+
+        return found, missing
+
+    def add(self, manager, objs):
+        """Добавляет объекты в карту.
+
+        :param manager: Менеджер, которым загружены объекты.
+        :param objs: Объекты модели.
+        :type objs: collections.Iterable
+        """
+        objects = self._get_objects(manager)
+        for obj in objs:
+            objects[obj.pk] = obj
+
+    def discard(self, model, pk):
+        """Удаляет объект из карты.
+
+        Удаляются также объекты прокси-моделей, родительских и дочерних
+        моделей с тем же первичным ключом, т.к. они хранятся в тех же
+        таблицах.
+
+        :param model: Модель.
+        :param pk: Значение первичного ключа.
+        """
+        table_models = _get_table_models(model)
+        for objects_model, model_objects in self._objects.items():
+            if not table_models.isdisjoint(_get_table_models(objects_model)):
+                for objects in model_objects.values():
+                    objects.pop(pk, None)
+
+    def clear(self):
+        """Удаляет все объекты из карты."""
+        self._objects.clear()
+
+
+class _State(local):
+
+    def __init__(self):
+        super(_State, self).__init__()
+        # Стек открытых блоков identity_map.
+        self.stack = []
+
+
+_state = _State()
+
+
+def get_identity_map():
+    """Возвращает карту идентичности текущего блока :func:`identity_map`.
+
+    :rtype: IdentityMap or None
+    """
+    stack = _state.stack
+    return stack[-1] if stack else None
+
+
+def push_identity_map():
+    """Открывает блок карты идентичности.
+
+    :returns: Карта идентичности блока.
+    :rtype: IdentityMap
+    """
+    result = IdentityMap()
+    _state.stack.append(result)
+
+    return result
+
+
+def pop_identity_map(objects):
+    """Закрывает блок карты идентичности.
+
+    :param objects: Карта идентичности, возвращенная функцией
+        :func:`push_identity_map`.
+
+    :raises RuntimeError: если блок карты ``objects`` не является последним
+        открытым блоком.
+    """
+    stack = _state.stack
+    if not stack or stack[-1] is not objects:
+        raise RuntimeError('Unbalanced identity map.')
+    stack.pop()
+
+
+def reset_identity_maps():
+    """Закрывает все блоки карты идентичности, открытые в текущем потоке.
+
+    Блоки, не закрытые при обработке предыдущего запроса (например, если
+    метод ``process_response`` промежуточного слоя не был вызван), иначе
+    действовали бы при обработке следующих запросов в этом потоке.
+    """
+    del _state.stack[:]
+
+
+@contextmanager
+def identity_map():
+    """Менеджер контекста, открывающий блок карты идентичности.
+
+    Вложенный блок использует собственную карту идентичности.
+
+    :rtype: IdentityMap
+    """
+    objects = push_identity_map()
+    try:
+        yield objects
+    finally:
+        pop_identity_map(objects)
+# -----------------------------------------------------------------------------
+# Удаление объектов из карты при изменении
+
+
+def _discard(sender, instance, **kwargs):
+    for objects in _state.stack:
+        objects.discard(sender, instance.pk)
+
+
+# Модели, менеджеры которых используют карту идентичности.
+_models = set()
+
+# Конкретные модели, в таблицах которых хранятся объекты моделей из
+# _models.
+_tables = set()
+
+
+def _on_class_prepared(sender, **kwargs):
+    if sender in _models:
+        _tables.update(_get_table_models(sender))
+
+    if not _tables.isdisjoint(_get_table_models(sender)):
+        post_delete.connect(
+            _discard, sender=sender, dispatch_uid='m3_django_compat.identity'
+        )
+
+
+def connect_signals(model):
+    """Подключает удаление объектов модели из карты при их изменении.
+
+    Объекты удаляются из карты также при изменении объектов прокси-моделей,
+    родительских и дочерних моделей (при наследовании с отдельными
+    таблицами). Обработчик ``post_save`` подключается для всех моделей, а
+    обработчики ``post_delete`` - только для моделей, использующих таблицы
+    моделей с картой идентичности, т.к. их наличие отключает быстрое
+    удаление объектов.
+
+    Вызывается при добавлении менеджера в класс модели, поэтому обработчик
+    ``post_delete`` подключается после подготовки класса (сигнал
+    ``class_prepared``).
+    """
+    if model._meta.abstract:
+        return
+
+    _models.add(model)
+    uid = 'm3_django_compat.identity'
+    post_save.connect(_discard, dispatch_uid=uid)
+    class_prepared.connect(_on_class_prepared, dispatch_uid=uid)
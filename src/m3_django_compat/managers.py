@@ -0,0 +1,582 @@
+# coding: utf-8
+"""Менеджер моделей с кэшированием результатов запросов.
+
+:class:`CachedManager` кэширует результаты запросов ``cached_all()``,
+``cached_filter(...)`` и ``cached_get(...)`` на заданное время. Кэш
+сбрасывается при сохранении и удалении объектов модели (в т.ч. через ее
+прокси-модели, а также родительские и дочерние модели при наследовании с
+отдельными таблицами) и при изменении ее связей "многие ко многим"
+(сигналы ``post_save``, ``post_delete`` и ``m2m_changed``). Если изменение
+выполнено в транзакции, кэш сбрасывается после ее подтверждения, а до
+этого запросы к модели в этой транзакции выполняются без использования
+кэша.
+
+.. code::
+
+   class Currency(models.Model):
+       objects = Manager()
+       cached_objects = CachedManager(timeout=600)
+
+   Currency.cached_objects.cached_all()
+   Currency.cached_objects.cached_get(code='RUB')
+
+Кэш хранится в памяти процесса (:class:`LocMemBackend`) либо в кэше Django
+(:class:`DjangoCacheBackend`). Изменения, выполненные методами
+``QuerySet.update`` и ``QuerySet.delete`` без отправки сигналов, кэш не
+сбрасывают.
+"""
+from hashlib import (
+    md5,
+)
+from inspect import (
+    isclass,
+)
+from threading import (
+    Lock,
+)
+from timeit import (
+    default_timer,
+)
+
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    connections,
+)
+from django.db.models import (
+    Model,
+)
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_save,
+)
+
+from m3_django_compat import (
+    _VERSION,
+    Manager,
+    ModelOptions,
+    _LRUCache,
+    get_related,
+)
+from m3_django_compat.relations import (
+    _get_all_models,
+    _get_remote_field,
+)
+from m3_django_compat.transaction import (
+    in_atomic_block,
+)
+
+
+if _VERSION < (1, 7):
+    def _get_django_cache(alias):
+        from django.core.cache import (
+            get_cache,
+        )
+        return get_cache(alias)
+else:
+    def _get_django_cache(alias):
+        from django.core.cache import (
+            caches,
+        )
+        return caches[alias]
+
+
+def _get_concrete_model(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+
+def _get_model_label(model):
+    """Возвращает метку модели, по которой сбрасывается кэш.
+
+    Прокси-модели используют метку конкретной модели.
+    """
+    opts = _get_concrete_model(model)._meta
+    return '{}.{}'.format(opts.app_label, opts.object_name).lower()
+# -----------------------------------------------------------------------------
+# Хранилища кэша
+
+
+class LocMemBackend(object):
+
+    """Хранилище кэша в памяти процесса.
+
+    При переполнении вытесняет результаты, к которым дольше всего не было
+    обращений.
+    """
+
+    def __init__(self, maxsize=1024):
+        """Инициализация экземпляра.
+
+        :param int maxsize: Максимальное количество хранимых результатов.
+        """
+        self._data = _LRUCache(maxsize)
+        self._versions = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        """Возвращает значение из кэша (либо ``None``, если его нет)."""
+        item = self._data.get(key)
+        if item is not None:
+            expires, value = item
+            if expires is None or expires > default_timer():
+                return value
+
+    def set(self, key, value, timeout):
+        """Сохраняет значение в кэше.
+
+        :param timeout: Время хранения в секундах (``None`` - без
+            ограничения).
+        """
+        expires = None if timeout is None else default_timer() + timeout
+        self._data.set(key, (expires, value))
+
+    def get_version(self, label):
+        """Возвращает версию кэша модели."""
+        return self._versions.get(label, 0)
+
+    def incr_version(self, label):
+        """Увеличивает версию кэша модели.
+
+        Результаты, сохраненные для предыдущих версий, становятся
+        недоступны и со временем вытесняются.
+        """
+        with self._lock:
+            self._versions[label] = self._versions.get(label, 0) + 1
+
+    def clear(self):
+        """Удаляет все значения из кэша."""
+        self._data.clear()
+
+
+class DjangoCacheBackend(object):
+
+    """Хранилище кэша, использующее кэш Django.
+
+    Версии кэша моделей хранятся в том же кэше, поэтому сброс кэша в
+    одном процессе действует и на остальные процессы, использующие
+    общий кэш (например, memcached или redis).
+    """
+
+    #: Префикс ключей кэша.
+    key_prefix = 'm3_django_compat.cache'
+
+    def __init__(self, alias='default'):
+        """Инициализация экземпляра.
+
+        :param str alias: Алиас кэша в параметре ``CACHES`` настроек.
+        """
+        self.alias = alias
+
+    @property
+    def cache(self):
+        return _get_django_cache(self.alias)
+
+    def _get_version_key(self, label):
+        return '{}:version:{}'.format(self.key_prefix, label)
+
+    def get(self, key):
+        """Возвращает значение из кэша (либо ``None``, если его нет)."""
+        return self.cache.get('{}:{}'.format(self.key_prefix, key))
+
+    def set(self, key, value, timeout):
+        """Сохраняет значение в кэше.
+
+        :param timeout: Время хранения в секундах (``None`` - без
+            ограничения).
+        """
+        self.cache.set('{}:{}'.format(self.key_prefix, key), value, timeout)
+
+    def get_version(self, label):
+        """Возвращает версию кэша модели."""
+        return self.cache.get(self._get_version_key(label)) or 0
+
+    def incr_version(self, label):
+        """Увеличивает версию кэша модели."""
+        key = self._get_version_key(label)
+        try:
+            self.cache.incr(key)
+        except ValueError:
+            # Версии нет в кэше (не сохранялась либо вытеснена).
+            if not self.cache.add(key, 1, None):
+                self.cache.incr(key)
+
+
+#: Хранилище кэша по умолчанию.
+default_backend = LocMemBackend()
+# -----------------------------------------------------------------------------
+# Сброс кэша при изменении объектов
+
+
+# Хранилища, использованные для кэширования результатов запросов к
+# моделям: {метка модели: множество хранилищ}.
+_backends = {}
+
+
+def _incr_versions(label):
+    for backend in tuple(_backends.get(label, ())):
+        backend.incr_version(label)
+
+
+class _ChangedModels(object):
+
+    """Модели, объекты которых изменены в транзакции.
+
+    Хранится в соединении с БД до подтверждения или отката внешней
+    транзакции, т.е. откат точек сохранения его не сбрасывает. После
+    подтверждения транзакции сбрасывает кэш изменявшихся моделей.
+    """
+
+    __slots__ = ('labels', 'owner', 'run_on_commit')
+
+    def __init__(self, owner=None):
+        self.labels = set()
+        # Объект, существующий только в пределах транзакции (функция,
+        # зарегистрированная в connection.run_on_commit, либо внешний
+        # блок atomic).
+        self.owner = owner
+        # Список connection.run_on_commit, в котором проверено наличие
+        # owner (используется в Django>=1.9).
+        self.run_on_commit = None
+
+    def commit(self):
+        for label in self.labels:
+            _incr_versions(label)
+
+
+if _VERSION >= (1, 9):
+    def _get_changed_models(using, create=False):
+        """Возвращает модели, изменявшиеся в текущей транзакции.
+
+        :param bool create: Определяет, нужно ли создать и зарегистрировать
+            список моделей, если его еще нет.
+
+        :rtype: _ChangedModels or None
+        """
+        connection = connections[using]
+        run_on_commit = connection.run_on_commit
+        state = getattr(connection, '_compat_changed_models', None)
+        if state is not None and state.run_on_commit is not run_on_commit:
+            # Django заменяет список при завершении транзакции (функция
+            # state при этом удаляется) и при откате точки сохранения (в
+            # этом случае функция остается в новом списке).
+            if any(entry[1] is state.owner for entry in run_on_commit):
+                state.run_on_commit = run_on_commit
+            else:
+                state = None
+
+        if state is None and create:
+            state = _ChangedModels()
+            # Запись добавляется без идентификаторов точек сохранения,
+            # поэтому их откат ее не удаляет, а функция вызывается после
+            # подтверждения внешней транзакции.
+            state.owner = state.commit
+            run_on_commit.append((set(), state.owner))
+            state.run_on_commit = run_on_commit
+            connection._compat_changed_models = state
+
+        return state
+
+else:
+    def _get_changed_models(using, create=False):
+        """Возвращает модели, изменявшиеся в текущей транзакции.
+
+        В Django<1.9 список доступен только в транзакциях, открытых функцией
+        :func:`~m3_django_compat.transaction.atomic`.
+
+        :param bool create: Определяет, нужно ли создать и зарегистрировать
+            список моделей, если его еще нет.
+
+        :rtype: _ChangedModels or None
+        """
+        from m3_django_compat.transaction import (
+            _Callbacks,
+            _state,
+        )
+
+        frames = _state.frames.get(using)
+        if not frames or not frames[0].outermost:
+            return None
+
+        frame = frames[0]
+        state = getattr(frame.connection, '_compat_changed_models', None)
+        if state is not None and state.owner is not frame:
+            state = None
+
+        if state is None and create:
+            state = _ChangedModels(frame)
+            # Функции внешнего блока не удаляются при откате вложенных
+            # блоков.
+            if frame.callbacks is None:
+                frame.callbacks = _Callbacks()
+            frame.callbacks.funcs.append(state.commit)
+            frame.connection._compat_changed_models = state
+
+        return state
+
+
+def invalidate(model, using=None):
+    """Сбрасывает кэш результатов запросов к модели.
+
+    Если на момент вызова открыта транзакция, кэш сбрасывается после
+    подтверждения внешней транзакции (при ее откате кэш не сбрасывается).
+    До этого запросы к модели в транзакции выполняются без использования
+    кэша, в т.ч. после отката точек сохранения.
+
+    :param model: Класс модели.
+    :param str using: Алиас базы данных, в которой изменены объекты.
+    """
+    _invalidate(_get_model_label(model), using)
+
+
+def _invalidate(label, using):
+    using = using or DEFAULT_DB_ALIAS
+    state = None
+    if in_atomic_block(using):
+        state = _get_changed_models(using, create=True)
+
+    if state is None:
+        # Транзакция не открыта либо (в Django<1.9) открыта не функцией
+        # atomic из m3_django_compat, поэтому дождаться ее подтверждения
+        # нельзя.
+        _incr_versions(label)
+    else:
+        state.labels.add(label)
+
+
+def _is_changed(model, using):
+    """Проверяет, изменялись ли объекты модели в текущей транзакции."""
+    if not in_atomic_block(using):
+        return False
+
+    state = _get_changed_models(using)
+    return state is not None and _get_model_label(model) in state.labels
+
+
+# Метки моделей, результаты запросов к которым зависят от данных таблицы
+# модели: {метка модели таблицы: множество меток моделей}.
+_dependents = {}
+
+# Метки моделей, в таблицах которых хранятся объекты модели: {модель:
+# кортеж меток}.
+_table_labels = {}
+
+
+def _get_table_labels(model):
+    """Возвращает метки моделей, в таблицах которых хранятся объекты модели.
+
+    Объекты модели, унаследованной от других конкретных моделей
+    (multi-table inheritance), хранятся также в таблицах родительских
+    моделей.
+
+    :rtype: tuple
+    """
+    result = _table_labels.get(model)
+    if result is None:
+        concrete_model = _get_concrete_model(model)
+        result = _table_labels[model] = tuple(
+            _get_model_label(table_model)
+            for table_model in [concrete_model] + list(
+                concrete_model._meta.get_parent_list()
+            )
+        )
+
+    return result
+
+
+def _on_change(sender, instance, using=None, **kwargs):
+    for table_label in _get_table_labels(sender):
+        for label in _dependents.get(table_label, ()):
+            _invalidate(label, using)
+
+
+def _on_m2m_change(sender, instance, action, model, using=None, **kwargs):
+    if action.startswith('post_'):
+        invalidate(instance.__class__, using)
+        invalidate(model, using)
+
+
+def _get_through_models(model):
+    """Возвращает промежуточные модели связей "многие ко многим" модели.
+
+    Учитываются как поля модели, так и поля других моделей, ссылающиеся
+    на нее.
+    """
+    concrete_model = _get_concrete_model(model)
+    result = set(
+        _get_remote_field(field).through
+        for field, _ in ModelOptions.for_model(
+            concrete_model
+        ).get_m2m_with_model()
+    )
+    for other in _get_all_models():
+        for field in other._meta.local_many_to_many:
+            target = get_related(field).parent_model
+            if (
+                isclass(target) and
+                _get_concrete_model(target) is concrete_model
+            ):
+                result.add(_get_remote_field(field).through)
+
+    return result
+
+
+def _connect_signals(model):
+    """Подключает сброс кэша при изменении объектов модели.
+
+    Кэш сбрасывается при изменении объектов модели, ее прокси-моделей, а
+    также родительских и дочерних моделей при наследовании с отдельными
+    таблицами (multi-table inheritance).
+
+    Обработчики подключаются при первом обращении к кэшу, т.к. при
+    создании менеджера промежуточные модели связей могут быть еще не
+    загружены. Обработчик ``post_save`` подключается для всех моделей, а
+    обработчики ``post_delete`` - только для моделей, использующих таблицы
+    модели, т.к. их наличие отключает быстрое удаление объектов.
+    """
+    label = _get_model_label(model)
+    table_labels = set(_get_table_labels(model))
+    for table_label in table_labels:
+        _dependents.setdefault(table_label, set()).add(label)
+
+    uid = 'm3_django_compat.managers'
+    post_save.connect(_on_change, dispatch_uid=uid)
+    for sender in _get_all_models():
+        if table_labels.intersection(_get_table_labels(sender)):
+            post_delete.connect(_on_change, sender=sender, dispatch_uid=uid)
+
+    concrete_model = _get_concrete_model(model)
+    for through in _get_through_models(concrete_model):
+        m2m_changed.connect(
+            _on_m2m_change, sender=through,
+            dispatch_uid='m3_django_compat.managers:' +
+            _get_model_label(through),
+        )
+# -----------------------------------------------------------------------------
+
+
+def _get_key_value(value):
+    """Возвращает значение аргумента запроса, пригодное для ключа кэша."""
+    if isinstance(value, Model):
+        return (_get_model_label(value.__class__), value.pk)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        result = tuple(_get_key_value(item) for item in value)
+        return tuple(sorted(result)) if isinstance(
+            value, (set, frozenset)
+        ) else result
+    else:
+        return value
+
+
+class CachedManager(Manager):
+
+    """Менеджер модели, кэширующий результаты запросов.
+
+    Кэшируются результаты запросов, выполненных методами
+    :meth:`cached_all`, :meth:`cached_filter` и :meth:`cached_get`.
+    Аргументы ``cached_filter`` и ``cached_get`` должны быть значениями
+    простых типов или объектами моделей. Методы возвращают копии
+    закэшированных списков, но не объектов, поэтому изменять полученные
+    объекты без сохранения не следует.
+    """
+
+    #: Время хранения результатов в кэше (в секундах).
+    cache_timeout = 300
+
+    #: Хранилище кэша (по умолчанию - :data:`default_backend`).
+    cache_backend = None
+
+    def __init__(self, timeout=None, backend=None):
+        """Инициализация экземпляра.
+
+        :param timeout: Время хранения результатов в кэше (в секундах).
+        :param backend: Хранилище кэша.
+        """
+        super(CachedManager, self).__init__()
+        if timeout is not None:
+            self.cache_timeout = timeout
+        if backend is not None:
+            self.cache_backend = backend
+
+    def _get_backend(self):
+        backend = self.cache_backend or default_backend
+        label = _get_model_label(self.model)
+        backends = _backends.get(label)
+        if backends is None or backend not in backends:
+            _connect_signals(self.model)
+            _backends.setdefault(label, set()).add(backend)
+
+        return backend
+
+    def _get_cache_key(self, backend, kwargs):
+        label = _get_model_label(self.model)
+        params = repr((
+            self.db,
+            self.model._meta.object_name,
+            self.__class__.__module__,
+            self.__class__.__name__,
+            sorted(
+                (name, _get_key_value(value))
+                for name, value in kwargs.items()
+            ),
+        ))
+        return '{}:{}:{}'.format(
+            label,
+            backend.get_version(label),
+            md5(params.encode('utf-8')).hexdigest(),
+        )
+
+    def _get_cached(self, kwargs):
+        """Возвращает закэшированный список объектов."""
+        backend = self._get_backend()
+        if _is_changed(self.model, self.db):
+            return list(self.get_queryset().filter(**kwargs))
+
+        key = self._get_cache_key(backend, kwargs)
+        result = backend.get(key)
+        if result is None:
+            result = list(self.get_queryset().filter(**kwargs))
+            backend.set(key, result, self.cache_timeout)
+
+        return list(result)
+
+    def cached_all(self):
+        """Возвращает список всех объектов модели.
+
+        :rtype: list
+        """
+        return self._get_cached({})
+
+    def cached_filter(self, **kwargs):
+        """Возвращает список объектов, удовлетворяющих условиям.
+
+        :rtype: list
+        """
+        return self._get_cached(kwargs)
+
+    def cached_get(self, **kwargs):
+        """Возвращает объект, удовлетворяющий условиям.
+
+        :raises django.core.exceptions.ObjectDoesNotExist: если объект не
+            найден.
+        :raises django.core.exceptions.MultipleObjectsReturned: если
+            найдено несколько объектов.
+        """
+        result = self._get_cached(kwargs)
+        if not result:
+            raise self.model.DoesNotExist(
+                '{} matching query does not exist.'.format(
+                    self.model._meta.object_name
+                )
+            )
+        elif len(result) > 1:
+            raise self.model.MultipleObjectsReturned(
+                'get() returned more than one {} -- it returned {}!'.format(
+                    self.model._meta.object_name, len(result)
+                )
+            )
+
+        return result[0]
+
+    def invalidate_cache(self):
+        """Сбрасывает кэш результатов запросов к модели."""
+        invalidate(self.model, self.db)
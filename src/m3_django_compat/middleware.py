@@ -2,9 +2,82 @@
 # pylint: disable=unused-import
 from __future__ import unicode_literals
 
+from m3_django_compat.identity import (
+    pop_identity_map,
+    push_identity_map,
+    reset_identity_maps,
+)
+from m3_django_compat.routers import (
+    pop_sticky_scope,
+    push_sticky_scope,
+    reset_sticky_scopes,
+)
+
 
 # Примесь для промежуточных слоев, переход от MIDDLEWARE_CLASSES к MIDDLEWARE
 try:
     from django.utils.deprecation import MiddlewareMixin
 except ImportError:
     MiddlewareMixin = object
+
+
+class IdentityMapMiddleware(MiddlewareMixin):
+
+    """Открывает блок карты идентичности на время обработки запроса.
+
+    Карта идентичности доступна через атрибут запроса ``identity_map`` и
+    функцию :func:`m3_django_compat.identity.get_identity_map`.
+
+    Блок закрывается при обработке ответа или исключения, а блоки, не
+    закрытые при обработке предыдущего запроса в том же потоке, - перед
+    обработкой запроса.
+    """
+
+    def _close(self, request):
+        objects = getattr(request, 'identity_map', None)
+        if objects is not None:
+            request.identity_map = None
+            pop_identity_map(objects)
+
+    def process_request(self, request):
+        reset_identity_maps()
+        request.identity_map = push_identity_map()
+
+    def process_exception(self, request, exception):
+        self._close(request)
+
+    def process_response(self, request, response):
+        self._close(request)
+
+        return response
+
+
+class ReplicaRoutingMiddleware(MiddlewareMixin):
+
+    """Открывает область чтения из основной БД после записи на время запроса.
+
+    После первой записи в основную базу данных все запросы на чтение до
+    конца обработки запроса направляются в основную базу данных.
+
+    Область закрывается при обработке ответа или исключения, а области, не
+    закрытые при обработке предыдущего запроса в том же потоке, - перед
+    обработкой запроса.
+    """
+
+    def _close(self, request):
+        if getattr(request, '_sticky_scope', False):
+            request._sticky_scope = False
+            pop_sticky_scope()
+
+    def process_request(self, request):
+        reset_sticky_scopes()
+        push_sticky_scope()
+        request._sticky_scope = True
+
+    def process_exception(self, request, exception):
+        self._close(request)
+
+    def process_response(self, request, response):
+        self._close(request)
+
+        return response
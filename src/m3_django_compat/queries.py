@@ -0,0 +1,797 @@
+# coding: utf-8
+"""Средства выполнения запросов к большим объемам данных.
+
+Функции принимают как выборку (``QuerySet``), так и менеджер модели, и
+работают одинаково во всех поддерживаемых версиях Django. Они также доступны
+в виде методов менеджера :class:`m3_django_compat.Manager`.
+
+.. code::
+
+   from m3_django_compat.queries import iterate_chunks
+
+   for person in iterate_chunks(Person.objects.filter(active=True)):
+       ...
+"""
+from collections import (
+    OrderedDict,
+    deque,
+)
+from threading import (
+    Thread,
+)
+
+from django import (
+    VERSION,
+)
+from django.db import (
+    DEFAULT_DB_ALIAS,
+    connections,
+)
+from django.db.models.fields import (
+    AutoField,
+)
+from django.db.models.fields.related import (
+    ManyToManyField,
+)
+from django.db.models.query_utils import (
+    Q,
+)
+
+from m3_django_compat.transaction import (
+    atomic,
+    in_atomic_block,
+)
+
+
+try:
+    from concurrent.futures import (
+        ThreadPoolExecutor,
+    )
+except ImportError:
+    # Python 2 без пакета futures.
+    ThreadPoolExecutor = None
+
+
+_VERSION = VERSION[:2]
+
+#: Максимальное количество значений в списке ``IN`` при загрузке объектов
+#: частями (по умолчанию). Планы запросов с более длинными списками
+#: значительно дороже.
+IN_BULK_CHUNK_SIZE = 1000
+
+#: Максимальное количество параметров запроса в SQLite (значение
+#: SQLITE_MAX_VARIABLE_NUMBER по умолчанию в версиях до 3.32).
+_SQLITE_MAX_QUERY_PARAMS = 999
+
+
+def _get_max_query_params(connection):
+    """Возвращает максимальное количество параметров в запросе к БД.
+
+    :rtype: int or None
+    """
+    max_params = getattr(connection.features, 'max_query_params', None)
+    if max_params is None and connection.vendor == 'sqlite':
+        max_params = _SQLITE_MAX_QUERY_PARAMS
+
+    return max_params
+
+
+def _get_batch_size(connection, params_per_object, count,
+                    batch_size=None):
+    """Возвращает количество объектов, обрабатываемых одним запросом.
+
+    Учитывает ограничения СУБД на количество параметров запроса и на
+    количество элементов в списке ``IN``.
+
+    :param connection: Подключение к БД.
+    :param int params_per_object: Количество параметров запроса на объект.
+    :param int count: Общее количество объектов.
+    :param int batch_size: Количество объектов, указанное явно.
+
+    :rtype: int
+    """
+    result = batch_size or count
+    max_params = _get_max_query_params(connection)
+    if max_params:
+        result = min(result, max_params // params_per_object)
+    max_in_list_size = getattr(connection.ops, 'max_in_list_size', None)
+    if max_in_list_size is not None and max_in_list_size():
+        result = min(result, max_in_list_size())
+
+    return max(result, 1)
+# -----------------------------------------------------------------------------
+# Постраничная обработка записей
+
+
+def _get_values_fields(model, values, field_name):
+    """Возвращает параметры выборки значений полей.
+
+    :returns: Кортеж из имен полей для ``values()``, ключа значения поля
+        сортировки в строках и признака добавления этого поля к указанным.
+    :rtype: tuple
+    """
+    fields = tuple(values) or tuple(
+        field.attname for field in model._meta.fields if field.column
+    )
+    if field_name == 'pk' and 'pk' not in fields:
+        pk_name = model._meta.pk.attname
+        if pk_name in fields:
+            return fields, pk_name, False
+
+    if field_name in fields:
+        return fields, field_name, False
+
+    return fields + (field_name,), field_name, True
+
+
+def iterate_chunks(queryset, chunk_size=1000, order_by='pk', values=None):
+    """Возвращает итератор по записям выборки, загружаемым частями.
+
+    Записи загружаются запросами вида ``WHERE field > last ORDER BY field
+    LIMIT chunk_size`` (постраничная навигация по ключу), поэтому время
+    загрузки каждой части не зависит от ее положения в таблице, а в памяти
+    одновременно находится не более ``chunk_size`` записей.
+
+    .. note::
+
+       Значения поля, по которому упорядочиваются записи, должны быть
+       уникальными и отличными от ``NULL``, иначе часть записей будет
+       пропущена.
+
+    :param queryset: Выборка или менеджер модели.
+    :param int chunk_size: Количество записей, загружаемых одним запросом.
+    :param str order_by: Имя поля, по которому упорядочиваются записи. Для
+        упорядочивания по убыванию указывается с префиксом ``-``.
+    :param values: Имена полей. Если указаны, то вместо объектов моделей
+        возвращаются словари со значениями полей (как в ``values()``). Пустой
+        кортеж соответствует всем полям модели.
+    :type values: collections.Iterable or None
+
+    :rtype: collections.Iterator
+    """
+    assert chunk_size > 0, chunk_size
+
+    queryset = queryset.all().order_by(order_by)
+    field_name = order_by.lstrip('-')
+    lookup = '{}__{}'.format(
+        field_name, 'lt' if order_by.startswith('-') else 'gt'
+    )
+
+    if values is None:
+        key_name = field_name
+        strip_key = False
+    else:
+        fields, key_name, strip_key = _get_values_fields(
+            queryset.model, values, field_name
+        )
+        queryset = queryset.values(*fields)
+
+    last_key = None
+    while True:
+        if last_key is None:
+            chunk = list(queryset[:chunk_size])
+        else:
+            chunk = list(queryset.filter(**{lookup: last_key})[:chunk_size])
+        if not chunk:
+            return
+
+        if values is None:
+            last_key = getattr(chunk[-1], key_name)
+            for obj in chunk:
+                yield obj
+        else:
+            last_key = chunk[-1][key_name]
+            for row in chunk:
+                if strip_key:
+                    del row[key_name]
+                yield row
+
+        if len(chunk) < chunk_size:
+            return
+# -----------------------------------------------------------------------------
+# Обновление полей нескольких объектов
+
+
+def _get_concrete_fields(model, field_names, action):
+    fields = [model._meta.get_field(name) for name in field_names]
+    if any(
+        getattr(field, 'column', None) is None or
+        isinstance(field, ManyToManyField)
+        for field in fields
+    ):
+        raise ValueError(
+            '{}() can only be used with concrete fields.'.format(action)
+        )
+
+    return fields
+
+
+def _get_update_fields(model, field_names):
+    if not field_names:
+        raise ValueError('Field names must be given to bulk_update().')
+
+    fields = _get_concrete_fields(model, field_names, 'bulk_update')
+    if any(field.primary_key for field in fields):
+        raise ValueError(
+            'bulk_update() cannot be used with primary key fields.'
+        )
+
+    return fields
+
+
+if _VERSION >= (2, 2):
+    def _bulk_update(queryset, objs, fields, batch_size):
+        connection = connections[queryset.db]
+        queryset.bulk_update(objs, fields, _get_batch_size(
+            connection, 2 * len(fields) + 1, len(objs), batch_size
+        ))
+
+else:
+    def _get_case_sql(connection, field, pk_column, batch):
+        """Возвращает выражение ``CASE`` для значений поля и его параметры.
+
+        :rtype: tuple
+        """
+        quote_name = connection.ops.quote_name
+        # В PostgreSQL тип параметров выражения CASE не выводится из типа
+        # столбца.
+        value_sql = (
+            'CAST(%s AS {})'.format(field.db_type(connection))
+            if connection.vendor == 'postgresql' else '%s'
+        )
+        sql = ['CASE', quote_name(pk_column)]
+        params = []
+        for pk, obj in batch:
+            sql.append('WHEN %s THEN')
+            sql.append(value_sql)
+            params.append(pk)
+            params.append(field.get_db_prep_save(
+                getattr(obj, field.attname), connection=connection
+            ))
+        sql.append('END')
+
+        return ' '.join(sql), params
+
+    def _bulk_update(queryset, objs, field_names, batch_size):
+        model = queryset.model
+        connection = connections[queryset.db]
+        quote_name = connection.ops.quote_name
+        fields = _get_update_fields(model, field_names)
+        if not objs:
+            return
+
+        # Поля родительских моделей хранятся в их таблицах.
+        tables = []
+        for field in fields:
+            for table in tables:
+                if table[0] is field.model:
+                    table[1].append(field)
+                    break
+            else:
+                tables.append((field.model, [field]))
+
+        batch_size = _get_batch_size(
+            connection, 2 * len(fields) + 1, len(objs), batch_size
+        )
+        filtered = bool(queryset.query.where)
+
+        with atomic(queryset.db, savepoint=False):
+            cursor = connection.cursor()
+            for start in range(0, len(objs), batch_size):
+                batch = objs[start:start + batch_size]
+                if filtered:
+                    # Объекты, не входящие в выборку, не обновляются.
+                    pks = set(queryset.filter(
+                        pk__in=[obj.pk for obj in batch]
+                    ).values_list('pk', flat=True))
+                    batch = [obj for obj in batch if obj.pk in pks]
+                    if not batch:
+                        continue
+
+                for table_model, table_fields in tables:
+                    pk_field = table_model._meta.pk
+                    pk_column = pk_field.column
+                    batch_pks = [
+                        (pk_field.get_db_prep_value(
+                            obj.pk, connection=connection
+                        ), obj)
+                        for obj in batch
+                    ]
+                    assignments = []
+                    params = []
+                    for field in table_fields:
+                        case_sql, case_params = _get_case_sql(
+                            connection, field, pk_column, batch_pks
+                        )
+                        assignments.append('{} = {}'.format(
+                            quote_name(field.column), case_sql
+                        ))
+                        params.extend(case_params)
+                    params.extend(pk for pk, _ in batch_pks)
+
+                    cursor.execute(
+                        'UPDATE {} SET {} WHERE {} IN ({})'.format(
+                            quote_name(table_model._meta.db_table),
+                            ', '.join(assignments),
+                            quote_name(pk_column),
+                            ', '.join(['%s'] * len(batch_pks)),
+                        ),
+                        params,
+                    )
+
+
+def bulk_update(queryset, objs, fields, batch_size=None):
+    """Обновляет значения полей объектов в БД.
+
+    В Django>=2.2 использует ``QuerySet.bulk_update``, а в более ранних
+    версиях обновляет поля запросами вида ``UPDATE ... SET field = CASE pk
+    WHEN ... THEN ... END WHERE pk IN (...)``. Количество объектов,
+    обновляемых одним запросом, ограничивается с учетом допустимого в СУБД
+    количества параметров запроса. Все запросы выполняются в одной
+    транзакции.
+
+    .. note::
+
+       В Django<2.2 в качестве значений полей не поддерживаются выражения
+       (например, ``F()``).
+
+    :param queryset: Выборка или менеджер модели. Объекты, не входящие в
+        выборку, не обновляются.
+    :param objs: Объекты модели с заполненными первичными ключами.
+    :type objs: collections.Iterable
+    :param fields: Имена обновляемых полей.
+    :type fields: collections.Iterable
+    :param int batch_size: Максимальное количество объектов, обновляемых
+        одним запросом.
+    """
+    if batch_size is not None and batch_size <= 0:
+        raise ValueError('Batch size must be a positive integer.')
+
+    objs = tuple(objs)
+    if any(obj.pk is None for obj in objs):
+        raise ValueError(
+            'All bulk_update() objects must have a primary key set.'
+        )
+
+    queryset = queryset.all()
+    queryset._for_write = True  # pylint: disable=protected-access
+    _bulk_update(queryset, objs, tuple(fields), batch_size)
+# -----------------------------------------------------------------------------
+# Добавление или обновление нескольких объектов
+
+
+def _get_on_conflict_sql(connection, unique_fields, update_fields):
+    """Возвращает условие разрешения конфликта для запроса INSERT.
+
+    :returns: Условие ``ON CONFLICT`` (PostgreSQL>=9.5, SQLite>=3.24),
+        ``ON DUPLICATE KEY`` (MySQL), либо ``None``, если СУБД не
+        поддерживает разрешение конфликтов.
+    :rtype: str or None
+    """
+    quote_name = connection.ops.quote_name
+
+    if connection.vendor == 'postgresql':
+        supported = getattr(connection, 'pg_version', 0) >= 90500
+    elif connection.vendor == 'sqlite':
+        from sqlite3 import (
+            sqlite_version_info,
+        )
+        supported = sqlite_version_info >= (3, 24, 0)
+    elif connection.vendor == 'mysql':
+        # В MySQL конфликт определяется по любому уникальному индексу.
+        return 'ON DUPLICATE KEY UPDATE {}'.format(', '.join(
+            '{0} = VALUES({0})'.format(quote_name(field.column))
+            for field in update_fields or unique_fields[:1]
+        ))
+    else:
+        supported = False
+
+    if not supported:
+        return None
+
+    conflict_target = ', '.join(
+        quote_name(field.column) for field in unique_fields
+    )
+    if not update_fields:
+        return 'ON CONFLICT ({}) DO NOTHING'.format(conflict_target)
+
+    return 'ON CONFLICT ({}) DO UPDATE SET {}'.format(
+        conflict_target,
+        ', '.join(
+            '{0} = EXCLUDED.{0}'.format(quote_name(field.column))
+            for field in update_fields
+        ),
+    )
+
+
+def _bulk_upsert_on_conflict(queryset, objs, unique_fields, update_fields,
+                             batch_size, on_conflict_sql):
+    """Добавляет или обновляет объекты запросами INSERT ... ON CONFLICT."""
+    if _VERSION >= (2, 2) and not update_fields:
+        # Добавление без обновления существующих записей поддерживается
+        # штатным bulk_create.
+        queryset.bulk_create(
+            objs, batch_size=batch_size, ignore_conflicts=True
+        )
+        return
+
+    model = queryset.model
+    connection = connections[queryset.db]
+    quote_name = connection.ops.quote_name
+
+    fields = [
+        field for field in model._meta.local_fields
+        if field.column and (
+            not isinstance(field, AutoField) or field in unique_fields
+        )
+    ]
+    row_sql = '({})'.format(', '.join(['%s'] * len(fields)))
+    insert_sql = 'INSERT INTO {} ({}) VALUES '.format(
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(field.column) for field in fields),
+    )
+    batch_size = _get_batch_size(
+        connection, len(fields), len(objs), batch_size
+    )
+
+    cursor = connection.cursor()
+    for start in range(0, len(objs), batch_size):
+        batch = objs[start:start + batch_size]
+        params = []
+        for obj in batch:
+            params.extend(
+                field.get_db_prep_save(
+                    field.pre_save(obj, True), connection=connection
+                )
+                for field in fields
+            )
+        cursor.execute(
+            '{}{} {}'.format(
+                insert_sql, ', '.join([row_sql] * len(batch)), on_conflict_sql
+            ),
+            params,
+        )
+
+
+def _get_unique_key(unique_fields, values):
+    """Возвращает значения уникальных полей, приведенные к типам полей.
+
+    Без приведения значения, отличающиеся только типом (например, ``1`` и
+    ``'1'`` для текстового поля), считались бы разными ключами.
+
+    :rtype: tuple
+    """
+    return tuple(
+        field.to_python(value) for field, value in zip(unique_fields, values)
+    )
+
+
+def _get_obj_unique_key(obj, unique_fields):
+    return _get_unique_key(
+        unique_fields,
+        [getattr(obj, field.attname) for field in unique_fields],
+    )
+
+
+def _get_existing_pks(queryset, keys, unique_fields, batch_size):
+    """Возвращает первичные ключи объектов, уже сохраненных в БД.
+
+    :param list keys: Значения уникальных полей объектов.
+
+    :returns: Словарь, ключами которого являются значения уникальных полей,
+        а значениями - первичные ключи.
+    :rtype: dict
+    """
+    connection = connections[queryset.db]
+    names = [field.attname for field in unique_fields]
+    batch_size = _get_batch_size(
+        connection, len(names), len(keys), batch_size
+    )
+
+    result = {}
+    for start in range(0, len(keys), batch_size):
+        batch = keys[start:start + batch_size]
+        if len(names) == 1:
+            condition = Q(**{names[0] + '__in': [key[0] for key in batch]})
+        else:
+            condition = Q()
+            for key in batch:
+                condition |= Q(**dict(zip(names, key)))
+
+        for row in queryset.filter(condition).values_list('pk', *names):
+            result[_get_unique_key(unique_fields, row[1:])] = row[0]
+
+    return result
+
+
+def _bulk_upsert_fallback(queryset, objs, unique_fields, update_fields,
+                          batch_size):
+    """Добавляет или обновляет объекты с предварительным поиском в БД."""
+    keys = OrderedDict(
+        (_get_obj_unique_key(obj, unique_fields), obj) for obj in objs
+    )
+    existing_pks = _get_existing_pks(
+        queryset, list(keys), unique_fields, batch_size
+    )
+
+    new_objs = []
+    existing_objs = []
+    for key, obj in keys.items():
+        pk = existing_pks.get(key)
+        if pk is None:
+            new_objs.append(obj)
+        else:
+            obj.pk = pk
+            existing_objs.append(obj)
+
+    if new_objs:
+        connection = connections[queryset.db]
+        queryset.bulk_create(new_objs, batch_size=_get_batch_size(
+            connection, len(queryset.model._meta.local_fields),
+            len(new_objs), batch_size,
+        ))
+    if existing_objs and update_fields:
+        bulk_update(
+            queryset, existing_objs,
+            [field.name for field in update_fields], batch_size,
+        )
+
+
+def bulk_upsert(queryset, objs, unique_fields, update_fields=None,
+                batch_size=None):
+    """Добавляет в БД новые объекты и обновляет существующие.
+
+    Объект считается существующим, если в БД есть запись с теми же
+    значениями полей ``unique_fields``. Если СУБД поддерживает разрешение
+    конфликтов при добавлении записей (PostgreSQL>=9.5, SQLite>=3.24,
+    MySQL), то используются запросы ``INSERT ... ON CONFLICT`` (``ON
+    DUPLICATE KEY UPDATE`` в MySQL). В остальных случаях существующие
+    записи загружаются из БД, после чего новые объекты добавляются с помощью
+    ``bulk_create``, а существующие обновляются функцией
+    :func:`bulk_update`. Все запросы выполняются в одной транзакции.
+
+    Из объектов с одинаковыми значениями уникальных полей сохраняется
+    последний. Первичные ключи добавленных объектов не заполняются.
+    Выборка не должна содержать условий и ограничений, т.к. запросы ``INSERT
+    ... ON CONFLICT`` затрагивают все записи таблицы.
+
+    .. note::
+
+       Для уникальных полей в БД должно быть создано ограничение
+       уникальности, иначе при разрешении конфликта СУБД возникнет
+       ошибка. При выполнении без разрешения конфликтов одновременное
+       добавление тех же записей другой транзакцией может привести к
+       ошибке ``IntegrityError``.
+
+    :param queryset: Выборка или менеджер модели.
+    :param objs: Объекты модели.
+    :type objs: collections.Iterable
+    :param unique_fields: Имена полей, однозначно определяющих запись.
+    :type unique_fields: collections.Iterable
+    :param update_fields: Имена полей, обновляемых в существующих записях.
+        Если не указаны, существующие записи не изменяются.
+    :type update_fields: collections.Iterable
+    :param int batch_size: Максимальное количество объектов, обрабатываемых
+        одним запросом.
+    """
+    if batch_size is not None and batch_size <= 0:
+        raise ValueError('Batch size must be a positive integer.')
+
+    model = queryset.model
+    if model._meta.parents:
+        raise ValueError(
+            "bulk_upsert() can't be used with multi-table inherited models."
+        )
+
+    queryset = queryset.all()
+    if queryset.query.where or not queryset.query.can_filter():
+        raise ValueError(
+            "bulk_upsert() can't be used with filtered or sliced querysets."
+        )
+
+    unique_fields = _get_concrete_fields(
+        model, unique_fields, 'bulk_upsert'
+    )
+    if not unique_fields:
+        raise ValueError('Unique fields must be given to bulk_upsert().')
+    update_fields = _get_concrete_fields(
+        model, update_fields or (), 'bulk_upsert'
+    )
+    if any(
+        field.primary_key or field in unique_fields
+        for field in update_fields
+    ):
+        raise ValueError(
+            'bulk_upsert() cannot update primary key or unique fields.'
+        )
+
+    # Из объектов с одинаковыми значениями уникальных полей сохраняется
+    # последний (повторное изменение строки одним запросом недопустимо).
+    objs = tuple(OrderedDict(
+        (_get_obj_unique_key(obj, unique_fields), obj) for obj in objs
+    ).values())
+    if not objs:
+        return
+
+    queryset._for_write = True  # pylint: disable=protected-access
+    connection = connections[queryset.db]
+
+    with atomic(queryset.db, savepoint=False):
+        on_conflict_sql = _get_on_conflict_sql(
+            connection, unique_fields, update_fields
+        )
+        if on_conflict_sql is not None:
+            _bulk_upsert_on_conflict(
+                queryset, objs, unique_fields, update_fields, batch_size,
+                on_conflict_sql,
+            )
+        else:
+            _bulk_upsert_fallback(
+                queryset, objs, unique_fields, update_fields, batch_size
+            )
+# -----------------------------------------------------------------------------
+# Загрузка объектов по спискам идентификаторов
+
+
+if _VERSION >= (1, 10):
+    from django.db.models import (
+        prefetch_related_objects as _prefetch_related_objects,
+    )
+else:
+    from django.db.models.query import (
+        prefetch_related_objects as _prefetch_related_objects_native,
+    )
+
+    def _prefetch_related_objects(model_instances, *related_lookups):
+        _prefetch_related_objects_native(
+            model_instances, list(related_lookups)
+        )
+
+
+def _get_in_chunk_size(connection, chunk_size):
+    return _get_batch_size(connection, 1, IN_BULK_CHUNK_SIZE, chunk_size)
+
+
+def _load_chunks(queryset, lookup, chunks, result):
+    for chunk in chunks:
+        result.extend(queryset.filter(**{lookup: chunk}))
+
+
+def _load_chunks_in_thread(queryset, lookup, chunks, result, errors):
+    """Загружает части из общей очереди, пока она не опустеет.
+
+    Выполняется в отдельном потоке, подключение которого к БД закрывается
+    по завершении загрузки.
+    """
+    try:
+        while not errors:
+            try:
+                chunk = chunks.popleft()
+            except IndexError:
+                break
+            result.extend(queryset.filter(**{lookup: chunk}))
+    except Exception as error:  # pylint: disable=broad-except
+        errors.append(error)
+    finally:
+        connections[queryset.db].close()
+
+
+def _load_chunks_in_threads(queryset, lookup, chunks, threads):
+    """Загружает части параллельно в ``threads`` потоках."""
+    chunks = deque(chunks)
+    results = [[] for _ in range(threads)]
+    errors = []
+    args_list = [
+        (queryset, lookup, chunks, result, errors) for result in results
+    ]
+
+    if ThreadPoolExecutor is not None:
+        with ThreadPoolExecutor(threads) as executor:
+            for args in args_list:
+                executor.submit(_load_chunks_in_thread, *args)
+    else:
+        workers = [
+            Thread(target=_load_chunks_in_thread, args=args)
+            for args in args_list
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    if errors:
+        raise errors[0]
+
+    return [obj for result in results for obj in result]
+
+
+def in_bulk_chunked(queryset, ids, field='pk', chunk_size=None,
+                    threads=None):
+    """Возвращает объекты с указанными значениями поля.
+
+    Аналог ``QuerySet.in_bulk``, разбивающий список значений на части с
+    учетом ограничений СУБД на количество параметров запроса (SQLite) и на
+    длину списка ``IN`` (Oracle). Части могут загружаться параллельно в
+    нескольких потоках (каждый поток использует отдельное подключение к
+    БД). Потоки (не больше, чем частей) берут части из общей очереди.
+    Внутри транзакции части загружаются последовательно, т.к. в других
+    подключениях не видны изменения текущей транзакции.
+
+    :param queryset: Выборка или менеджер модели.
+    :param ids: Значения поля.
+    :type ids: collections.Iterable
+    :param str field: Имя поля (значения должны быть уникальны).
+    :param int chunk_size: Количество значений, загружаемых одним запросом.
+        По умолчанию - :data:`IN_BULK_CHUNK_SIZE` с учетом ограничений СУБД.
+    :param int threads: Количество потоков для параллельной загрузки.
+
+    :returns: Словарь, ключами которого являются значения поля (для внешних
+        ключей - идентификаторы связанных объектов), а значениями - объекты
+        модели.
+    :rtype: dict
+    """
+    from m3_django_compat import (
+        ModelOptions,
+    )
+
+    queryset = queryset.all()
+    model = queryset.model
+    if field == 'pk':
+        attname = model._meta.pk.attname
+    else:
+        attname = ModelOptions.for_model(model).get_field(field).attname
+
+    ids = list(OrderedDict.fromkeys(ids))
+    if not ids:
+        return {}
+
+    using = queryset.db
+    chunk_size = _get_in_chunk_size(connections[using], chunk_size)
+    chunks = [
+        ids[start:start + chunk_size]
+        for start in range(0, len(ids), chunk_size)
+    ]
+    lookup = field + '__in'
+
+    if threads is None or threads < 2 or len(chunks) < 2 or (
+        in_atomic_block(using)
+    ):
+        objs = []
+        _load_chunks(queryset, lookup, chunks, objs)
+    else:
+        objs = _load_chunks_in_threads(
+            queryset, lookup, chunks, min(threads, len(chunks))
+        )
+
+    return dict((getattr(obj, attname), obj) for obj in objs)
+
+
+def prefetch_related_chunked(objs, *lookups, **kwargs):
+    """Загружает связанные объекты для объектов моделей частями.
+
+    Аналог ``prefetch_related_objects``, выполняющий загрузку для частей
+    списка объектов, что ограничивает длину списков ``IN`` в запросах
+    загрузки связанных объектов.
+
+    :param objs: Объекты модели.
+    :type objs: collections.Iterable
+    :param lookups: Связи, объекты которых необходимо загрузить (как в
+        ``prefetch_related``).
+    :param int chunk_size: Количество объектов в части (именованный
+        аргумент). По умолчанию - :data:`IN_BULK_CHUNK_SIZE` с учетом
+        ограничений СУБД.
+    """
+    chunk_size = kwargs.pop('chunk_size', None)
+    assert not kwargs, kwargs
+
+    objs = list(objs)
+    if not objs:
+        return
+
+    chunk_size = _get_in_chunk_size(
+        connections[objs[0]._state.db or DEFAULT_DB_ALIAS], chunk_size
+    )
+    for start in range(0, len(objs), chunk_size):
+        _prefetch_related_objects(
+            objs[start:start + chunk_size], *lookups
+        )
@@ -0,0 +1,305 @@
+# coding: utf-8
+"""Граф связей между моделями проекта.
+
+Граф строится один раз (при первом обращении) по всем моделям
+подключенных приложений и хранится в компактном виде: моделям присваиваются
+целочисленные идентификаторы, а связи хранятся в массивах, упорядоченных
+по исходной и по целевой модели. Это позволяет отвечать на вопросы вида
+"какие модели ссылаются на данную (в т.ч. транзитивно)" и "куда
+распространится каскадное удаление" без повторного обхода ``Model._meta``.
+
+.. code::
+
+   from m3_django_compat.relations import get_relation_graph
+
+   graph = get_relation_graph()
+   graph.get_referencing_models(Person, transitive=True)
+   graph.get_cascade_paths(Person)
+"""
+from array import (
+    array,
+)
+from collections import (
+    deque,
+)
+from inspect import (
+    isclass,
+)
+
+from django.db.models.deletion import (
+    CASCADE,
+    PROTECT,
+)
+from django.db.models.fields.related import (
+    RelatedField,
+)
+
+import m3_django_compat
+from m3_django_compat import (
+    _VERSION,
+    ModelOptions,
+    get_related,
+)
+
+
+if _VERSION < (1, 7):
+    def _get_all_models():
+        from django.db.models.loading import (
+            get_models,
+        )
+        return get_models(include_auto_created=True)
+else:
+    def _get_all_models():
+        from django.apps import (
+            apps,
+        )
+        return apps.get_models(include_auto_created=True)
+
+
+if _VERSION < (1, 9):
+    def _get_remote_field(field):
+        return field.rel
+else:
+    def _get_remote_field(field):
+        return field.remote_field
+# -----------------------------------------------------------------------------
+
+
+#: Признак связи "многие ко многим".
+_MANY_TO_MANY = 1
+
+#: Признак каскадного удаления по связи.
+_CASCADE = 2
+
+#: Признак запрета удаления по связи.
+_PROTECT = 4
+
+
+def _get_concrete_model(model):
+    return getattr(model._meta, 'concrete_model', None) or model
+
+
+class RelationGraph(object):
+
+    """Граф связей между моделями.
+
+    Связь направлена от модели, в которой объявлено поле (внешний ключ,
+    "один к одному" или "многие ко многим"), к модели, на которую это поле
+    ссылается. Прокси-модели при построении и в запросах заменяются
+    соответствующими им конкретными моделями.
+
+    Связи "многие ко многим" представлены как самим полем, так и внешними
+    ключами промежуточной модели, поэтому каскадное удаление строк
+    промежуточных таблиц учитывается так же, как и для обычных внешних
+    ключей.
+    """
+
+    def __init__(self, models):
+        """Инициализация экземпляра.
+
+        :param models: Модели, связи между которыми нужно учитывать.
+        """
+        self.models = tuple(
+            model for model in models
+            if _get_concrete_model(model) is model
+        )
+        self._ids = dict(
+            (model, model_id) for model_id, model in enumerate(self.models)
+        )
+
+        sources = array('i')
+        targets = array('i')
+        flags = bytearray()
+        fields = []
+
+        def add_edge(source_id, field, flag):
+            target = get_related(field).parent_model
+            # Связи с моделями из неподключенных приложений не учитываются.
+            target_id = self._ids.get(
+                _get_concrete_model(target) if isclass(target) else None
+            )
+            if target_id is not None:
+                sources.append(source_id)
+                targets.append(target_id)
+                flags.append(flag)
+                fields.append(field)
+
+        for source_id, model in enumerate(self.models):
+            for field in model._meta.local_fields:
+                if isinstance(field, RelatedField):
+                    on_delete = _get_remote_field(field).on_delete
+                    add_edge(
+                        source_id, field,
+                        _CASCADE if on_delete is CASCADE else
+                        _PROTECT if on_delete is PROTECT else
+                        0
+                    )
+
+            for field, parent in ModelOptions.for_model(
+                model
+            ).get_m2m_with_model():
+                if parent is None:
+                    add_edge(source_id, field, _MANY_TO_MANY)
+
+        self._sources = sources
+        self._targets = targets
+        self._flags = flags
+        self._fields = tuple(fields)
+
+        self._forward = self._build_index(sources)
+        self._reverse = self._build_index(targets)
+
+    def _build_index(self, keys):
+        """Возвращает индекс связей, сгруппированных по ключу.
+
+        Индекс - пара массивов: смещения групп (по одному на модель, плюс
+        завершающее) и номера связей, упорядоченные по ключу.
+        """
+        offsets = array('i', [0] * (len(self.models) + 1))
+        for key in keys:
+            offsets[key + 1] += 1
+        for i in range(len(self.models)):
+            offsets[i + 1] += offsets[i]
+
+        positions = array('i', offsets)
+        edges = array('i', [0] * len(keys))
+        for edge, key in enumerate(keys):
+            edges[positions[key]] = edge
+            positions[key] += 1
+
+        return offsets, edges
+
+    def _get_model_id(self, model):
+        try:
+            return self._ids[_get_concrete_model(model)]
+        except (AttributeError, KeyError):
+            raise LookupError(
+                'Model {} is not registered in the relation graph.'
+                .format(model)
+            )
+
+    def _iter_edges(self, index, model_id):
+        offsets, edges = index
+        for i in range(offsets[model_id], offsets[model_id + 1]):
+            yield edges[i]
+
+    def _walk(self, model, index, ends, transitive):
+        """Обходит граф в ширину, возвращая модели в порядке обхода."""
+        start_id = self._get_model_id(model)
+        visited = bytearray(len(self.models))
+        visited[start_id] = 1
+        queue = deque((start_id,))
+        result = []
+
+        while queue:
+            model_id = queue.popleft()
+            for edge in self._iter_edges(index, model_id):
+                next_id = ends[edge]
+                if not visited[next_id]:
+                    visited[next_id] = 1
+                    result.append(self.models[next_id])
+                    if transitive:
+                        queue.append(next_id)
+
+        return tuple(result)
+
+    def get_referencing_models(self, model, transitive=False):
+        """Возвращает модели, ссылающиеся на указанную модель.
+
+        :param model: Класс модели.
+        :param bool transitive: Определяет, нужно ли учитывать модели,
+            ссылающиеся на указанную модель через другие модели.
+
+        :rtype: tuple
+        """
+        return self._walk(model, self._reverse, self._sources, transitive)
+
+    def get_referenced_models(self, model, transitive=False):
+        """Возвращает модели, на которые ссылается указанная модель.
+
+        :param model: Класс модели.
+        :param bool transitive: Определяет, нужно ли учитывать модели, на
+            которые указанная модель ссылается через другие модели.
+
+        :rtype: tuple
+        """
+        return self._walk(model, self._forward, self._targets, transitive)
+
+    def get_cascade_paths(self, model):
+        """Возвращает пути каскадного удаления объектов модели.
+
+        Для каждой модели, объекты которой могут быть удалены каскадно при
+        удалении объектов указанной модели, возвращает кратчайшую цепочку
+        полей (внешних ключей), по которой распространяется удаление.
+
+        :param model: Класс модели.
+
+        :rtype: dict
+        """
+        start_id = self._get_model_id(model)
+        paths = {start_id: ()}
+        queue = deque((start_id,))
+
+        while queue:
+            model_id = queue.popleft()
+            path = paths[model_id]
+            for edge in self._iter_edges(self._reverse, model_id):
+                if not self._flags[edge] & _CASCADE:
+                    continue
+                next_id = self._sources[edge]
+                if next_id not in paths:
+                    paths[next_id] = path + (self._fields[edge],)
+                    queue.append(next_id)
+
+        del paths[start_id]
+
+        return dict(
+            (self.models[model_id], path)
+            for model_id, path in paths.items()
+        )
+
+    def get_protecting_fields(self, model):
+        """Возвращает поля, препятствующие удалению объектов модели.
+
+        Учитываются поля с ``on_delete=PROTECT``, ссылающиеся как на саму
+        модель, так и на модели, объекты которых будут удалены каскадно.
+
+        :param model: Класс модели.
+
+        :rtype: tuple
+        """
+        model_ids = [self._get_model_id(model)]
+        model_ids.extend(
+            self._ids[cascade_model]
+            for cascade_model in self.get_cascade_paths(model)
+        )
+
+        return tuple(
+            self._fields[edge]
+            for model_id in model_ids
+            for edge in self._iter_edges(self._reverse, model_id)
+            if self._flags[edge] & _PROTECT
+        )
+# -----------------------------------------------------------------------------
+
+
+_graph = None
+_graph_generation = None
+
+
+def get_relation_graph():
+    """Возвращает граф связей между моделями подключенных приложений.
+
+    Граф строится при первом вызове и перестраивается только после
+    регистрации новых моделей или изменения списка подключенных приложений.
+
+    :rtype: RelationGraph
+    """
+    global _graph, _graph_generation  # pylint: disable=global-statement
+
+    generation = m3_django_compat._models_generation
+    if _graph is None or _graph_generation != generation:
+        _graph = RelationGraph(_get_all_models())
+        _graph_generation = generation
+
+    return _graph
@@ -0,0 +1,376 @@
+# coding: utf-8
+"""Роутеры баз данных с чтением из реплик.
+
+:class:`ReplicaRouterBase` направляет запросы на запись в основную базу
+данных, а запросы на чтение - в одну из реплик, выбираемую стратегией
+(:class:`RoundRobinStrategy`, :class:`WeightedStrategy` или
+:class:`LeastRecentlyFailedStrategy`).
+
+.. code::
+
+   class Router(ReplicaRouterBase):
+       primary = 'default'
+       replicas = ('replica1', 'replica2')
+       strategy = WeightedStrategy({'replica1': 3, 'replica2': 1})
+
+   DATABASE_ROUTERS = ['project.routers.Router']
+   MIDDLEWARE = [
+       ...
+       'm3_django_compat.middleware.ReplicaRoutingMiddleware',
+   ]
+
+В пределах области :func:`sticky_scope` (при использовании
+:class:`m3_django_compat.middleware.ReplicaRoutingMiddleware` - в пределах
+запроса) после первой записи все запросы на чтение направляются в основную
+базу данных, т.к. изменения могут еще не дойти до реплик. Внутри
+транзакции основной базы данных и в блоке :func:`use_primary` чтение также
+выполняется из основной базы данных.
+
+Записью считаются сохранение и удаление объектов (сигналы ``pre_save`` и
+``pre_delete``), изменение связей "многие ко многим" (``m2m_changed``), а
+также запросы, для которых роутер вызывается без подсказки ``instance``
+(``QuerySet.update``, ``QuerySet.delete``, ``bulk_create`` и т.п.). Вызовы
+``db_for_write`` с подсказкой ``instance`` выполняются Django и без записи
+(например, при присваивании значения внешнему ключу), поэтому чтение из
+основной базы данных не включают. Запись методами менеджеров связей
+(например, ``obj.item_set.update(...)``), не отправляющая сигналов, чтение
+из основной базы данных не включает.
+
+Стратегии не получают сведений об ошибках автоматически. Об ошибках
+подключения к реплике нужно сообщать методом
+:meth:`ReplicaRouterBase.mark_failed`, например, в обработчике исключения
+``django.db.OperationalError`` при чтении (после чего запрос можно
+повторить - роутер выберет другую реплику).
+"""
+from abc import (
+    ABCMeta,
+    abstractmethod,
+)
+from bisect import (
+    bisect_right,
+)
+from contextlib import (
+    contextmanager,
+)
+from random import (
+    random,
+)
+from threading import (
+    Lock,
+    local,
+)
+from timeit import (
+    default_timer,
+)
+
+import six
+from django.db import (
+    DEFAULT_DB_ALIAS,
+)
+from django.db.models.signals import (
+    m2m_changed,
+    pre_delete,
+    pre_save,
+)
+
+from m3_django_compat import (
+    DatabaseRouterBase,
+)
+from m3_django_compat.transaction import (
+    in_atomic_block,
+)
+
+
+# -----------------------------------------------------------------------------
+# Стратегии выбора реплики
+
+
+@six.add_metaclass(ABCMeta)
+class ReplicaStrategy(object):
+
+    """Базовый класс стратегий выбора реплики.
+
+    В потомках нужно реализовать метод :meth:`select`.
+    """
+
+    @abstractmethod
+    def select(self, replicas):
+        """Возвращает алиас реплики для чтения.
+
+        :param replicas: Алиасы реплик (не пустая последовательность).
+        :type replicas: collections.Sequence
+
+        :rtype: str
+        """
+
+    def mark_failed(self, alias):
+        """Регистрирует ошибку при обращении к реплике.
+
+        :param str alias: Алиас реплики.
+        """
+
+
+class RoundRobinStrategy(ReplicaStrategy):
+
+    """Выбирает реплики по очереди."""
+
+    def __init__(self):
+        self._counter = 0
+        self._lock = Lock()
+
+    def _next(self, count):
+        with self._lock:
+            result = self._counter % count
+            self._counter = result + 1
+
+        return result
+
+    def select(self, replicas):
+        return replicas[self._next(len(replicas))]
+
+
+class WeightedStrategy(ReplicaStrategy):
+
+    """Выбирает реплики случайно с вероятностью, пропорциональной весу."""
+
+    def __init__(self, weights, default_weight=1):
+        """Инициализация экземпляра.
+
+        :param dict weights: Веса реплик (алиас -> неотрицательное число).
+        :param default_weight: Вес реплик, отсутствующих в ``weights``.
+        """
+        self.weights = dict(weights)
+        self.default_weight = default_weight
+
+    def select(self, replicas):
+        totals = []
+        total = 0
+        for alias in replicas:
+            total += self.weights.get(alias, self.default_weight)
+            totals.append(total)
+
+        if not total:
+            return replicas[0]
+
+        return replicas[bisect_right(totals, random() * total)]
+
+
+class LeastRecentlyFailedStrategy(RoundRobinStrategy):
+
+    """Выбирает реплики без недавних ошибок.
+
+    Реплики, при обращении к которым в течение ``retry_interval`` секунд
+    регистрировались ошибки (см. :meth:`mark_failed`), не используются,
+    остальные выбираются по очереди. Если ошибки недавно регистрировались
+    для всех реплик, выбирается реплика, ошибка которой была раньше всех.
+    """
+
+    def __init__(self, retry_interval=30):
+        """Инициализация экземпляра.
+
+        :param retry_interval: Время (в секундах), в течение которого
+            реплика с ошибкой не используется.
+        """
+        super(LeastRecentlyFailedStrategy, self).__init__()
+        self.retry_interval = retry_interval
+        # Время последней ошибки по алиасам реплик.
+        self._failures = {}
+
+    def select(self, replicas):
+        failures = self._failures
+        if failures:
+            threshold = default_timer() - self.retry_interval
+            available = [
+                alias for alias in replicas
+                if failures.get(alias, threshold) <= threshold
+            ]
+            if not available:
+                return min(replicas, key=failures.get)
+            replicas = available
+
+        return replicas[self._next(len(replicas))]
+
+    def mark_failed(self, alias):
+        self._failures[alias] = default_timer()
+
+    def mark_recovered(self, alias):
+        """Отменяет регистрацию ошибок при обращении к реплике.
+
+        :param str alias: Алиас реплики.
+        """
+        self._failures.pop(alias, None)
+# -----------------------------------------------------------------------------
+# Чтение из основной базы данных после записи
+
+
+class _State(local):
+
+    def __init__(self):
+        super(_State, self).__init__()
+        # Признаки записи в открытых областях sticky_scope.
+        self.scopes = []
+        # Уровень вложенности блоков use_primary.
+        self.forced = 0
+
+
+_state = _State()
+
+
+def push_sticky_scope():
+    """Открывает область чтения из основной базы данных после записи.
+
+    Вложенная область наследует признак записи внешней области.
+    """
+    scopes = _state.scopes
+    scopes.append(bool(scopes and scopes[-1]))
+
+
+def pop_sticky_scope():
+    """Закрывает область, открытую функцией :func:`push_sticky_scope`.
+
+    :raises RuntimeError: если открытых областей нет.
+    """
+    if not _state.scopes:
+        raise RuntimeError('Unbalanced sticky scope.')
+    _state.scopes.pop()
+
+
+def reset_sticky_scopes():
+    """Закрывает все области, открытые в текущем потоке.
+
+    Области, не закрытые при обработке предыдущего запроса (например, если
+    метод ``process_response`` промежуточного слоя не был вызван), иначе
+    направляли бы чтение в основную базу данных при обработке следующих
+    запросов в этом потоке.
+    """
+    del _state.scopes[:]
+
+
+@contextmanager
+def sticky_scope():
+    """Менеджер контекста области чтения из основной БД после записи."""
+    push_sticky_scope()
+    try:
+        yield
+    finally:
+        pop_sticky_scope()
+
+
+def pin_to_primary():
+    """Направляет чтение в основную базу данных до конца текущей области.
+
+    Признак записи устанавливается также для всех внешних областей. Вне
+    области :func:`sticky_scope` вызов не имеет эффекта.
+    """
+    scopes = _state.scopes
+    for i in range(len(scopes)):
+        scopes[i] = True
+
+
+def is_pinned_to_primary():
+    """Проверяет, выполняется ли чтение из основной базы данных.
+
+    :rtype: bool
+    """
+    return bool(_state.forced or _state.scopes and _state.scopes[-1])
+
+
+@contextmanager
+def use_primary():
+    """Менеджер контекста, направляющий чтение в основную базу данных."""
+    _state.forced += 1
+    try:
+        yield
+    finally:
+        _state.forced -= 1
+
+
+# Алиасы основных баз данных роутеров ReplicaRouterBase.
+_primaries = set()
+
+
+def _on_write(sender, using=None, **kwargs):
+    if using in _primaries:
+        pin_to_primary()
+
+
+def _on_m2m_change(sender, action, using=None, **kwargs):
+    if action.startswith('pre_'):
+        _on_write(sender, using)
+# -----------------------------------------------------------------------------
+
+
+class ReplicaRouterBase(DatabaseRouterBase):
+
+    """Базовый класс роутеров с чтением из реплик.
+
+    Запись выполняется в основную базу данных :attr:`primary`, чтение - из
+    реплики, выбранной стратегией :attr:`strategy`, кроме случаев, когда
+    чтение нужно выполнять из основной базы данных (см. описание модуля).
+    Миграции по умолчанию применяются только к основной базе данных.
+
+    Признак чтения из основной базы данных после записи общий для всех
+    роутеров, поэтому запись в основную базу данных одного роутера
+    направляет в основные базы данных и чтение через другие роутеры.
+    """
+
+    #: Алиас основной базы данных.
+    primary = DEFAULT_DB_ALIAS
+
+    #: Алиасы реплик основной базы данных.
+    replicas = ()
+
+    #: Стратегия выбора реплики (по умолчанию - :class:`RoundRobinStrategy`).
+    strategy = None
+
+    def __init__(self):
+        if self.strategy is None:
+            self.strategy = RoundRobinStrategy()
+
+        _primaries.add(self.primary)
+        uid = 'm3_django_compat.routers'
+        pre_save.connect(_on_write, dispatch_uid=uid)
+        pre_delete.connect(_on_write, dispatch_uid=uid)
+        m2m_changed.connect(_on_m2m_change, dispatch_uid=uid)
+
+    def _use_primary(self, model, **hints):
+        """Возвращает True, если чтение нужно выполнять из основной БД.
+
+        Может быть переопределен в потомках, например, для моделей, данные
+        которых не реплицируются.
+        """
+        return (
+            not self.replicas or
+            is_pinned_to_primary() or
+            in_atomic_block(self.primary)
+        )
+
+    def _allow(self, db, app_label, model_name):
+        return db == self.primary
+
+    def db_for_read(self, model, **hints):
+        if self._use_primary(model, **hints):
+            return self.primary
+
+        return self.strategy.select(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        if 'instance' not in hints:
+            pin_to_primary()
+
+        return self.primary
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = (self.primary,) + tuple(self.replicas)
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+
+    def mark_failed(self, alias):
+        """Регистрирует ошибку при обращении к реплике.
+
+        Роутер не отслеживает ошибки сам, метод должен вызываться кодом,
+        выполняющим запросы (см. описание модуля).
+
+        :param str alias: Алиас реплики.
+        """
+        self.strategy.mark_failed(alias)
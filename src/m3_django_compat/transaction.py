@@ -0,0 +1,1607 @@
+# coding: utf-8
+"""Средства управления транзакциями.
+
+Совместимый аналог ``atomic`` отслеживает открытые им блоки (отдельно для
+каждого потока и алиаса базы данных) и уведомляет о них зарегистрированных
+слушателей. Слушатель - вызываемый объект, принимающий экземпляр
+:class:`TransactionEvent`.
+
+.. code::
+
+   from m3_django_compat.transaction import (
+       TransactionStatistics,
+       add_transaction_listener,
+   )
+
+   statistics = TransactionStatistics()
+   add_transaction_listener(statistics)
+   ...
+   statistics.get_statistics()
+"""
+import linecache
+import sys
+import traceback
+from bisect import (
+    bisect_left,
+)
+from collections import (
+    namedtuple,
+)
+from functools import (
+    wraps,
+)
+from logging import (
+    getLogger,
+)
+from random import (
+    uniform,
+)
+from threading import (
+    Event,
+    Lock,
+    Thread,
+    current_thread,
+    local,
+)
+from time import (
+    sleep,
+)
+from timeit import (
+    default_timer,
+)
+
+import six
+from six.moves._thread import (
+    get_ident,
+)
+from django import (
+    VERSION,
+)
+from django.db import (
+    connections,
+    transaction as _transaction,
+)
+from django.db.transaction import (
+    TransactionManagementError,
+)
+from django.db.utils import (
+    DEFAULT_DB_ALIAS,
+    DatabaseError,
+    OperationalError,
+)
+
+
+_VERSION = VERSION[:2]
+
+_logger = getLogger(__name__)
+
+#: Значение параметра ``savepoint`` функции :func:`atomic`, при котором точка
+#: сохранения вложенного блока создается перед первым изменяющим запросом.
+LAZY_SAVEPOINT = 'lazy'
+# -----------------------------------------------------------------------------
+# Реализация atomic для разных версий Django
+
+
+if _VERSION <= (1, 5):
+    from django.db.transaction import (
+        commit_unless_managed,
+    )
+
+    def in_atomic_block(using=None):
+        """Возвращает ``True``, если в момент вызова открыта транзакция.
+
+        Если включен режим автоподтверждения (autocommit), то возвращает
+        ``False``.
+
+        :param str using: Алиас базы данных.
+
+        :rtype: bool
+        """
+        return _transaction.is_managed(using)
+
+    class _Atomic(object):
+
+        def __init__(self, savepoint):
+            self._savepoint = savepoint
+            self._sid = None
+
+        def entering(self, using):
+            # pylint: disable=attribute-defined-outside-init
+            if in_atomic_block(using):
+                if self._savepoint:
+                    self._sid = _transaction.savepoint(using)
+            else:
+                self._commit_on_exit = True
+
+                _transaction.enter_transaction_management(using=using)
+                _transaction.managed(True, using=using)
+
+        def exiting(self, exc_value, using):
+            if self._sid:
+                if self._savepoint:
+                    if exc_value is None:
+                        _transaction.savepoint_commit(self._sid, using)
+                    else:
+                        _transaction.savepoint_rollback(self._sid, using)
+            else:
+                try:
+                    if exc_value is not None:
+                        if _transaction.is_dirty(using=using):
+                            _transaction.rollback(using=using)
+                    else:
+                        if _transaction.is_dirty(using=using):
+                            try:
+                                _transaction.commit(using=using)
+                            except:  # noqa
+                                _transaction.rollback(using=using)
+                                raise
+                finally:
+                    _transaction.leave_transaction_management(using=using)
+
+    def _get_native_atomic(using, savepoint):
+        return None
+
+    def _enter_atomic(native, connection, using, savepoint):
+        """Открывает блок atomic.
+
+        :returns: Объект, управляющий блоком, и признак создания точки
+            сохранения.
+        :rtype: tuple
+        """
+        atomic_ = _Atomic(savepoint)
+        atomic_.entering(using)
+
+        return atomic_, atomic_._sid is not None
+
+    def _exit_atomic(atomic_, using, exc_type, exc_value, traceback):
+        atomic_.exiting(exc_value, using)
+
+    def _needs_rollback(connection):
+        return False
+
+    def _in_transaction(connection, using):
+        return _transaction.is_managed(using)
+
+else:
+    def in_atomic_block(using=None):
+        """Возвращает ``True``, если в момент вызова открыта транзакция.
+
+        Если включен режим автоподтверждения (autocommit), то возвращает
+        ``False``.
+
+        :param str using: Алиас базы данных.
+
+        :rtype: bool
+        """
+        return _transaction.get_connection(using).in_atomic_block
+
+    def commit_unless_managed(using=None):
+        """Совместимый аналог функции commit_unless_managed.
+
+        В Django 1.6+ эта функция была помечена, как устаревшая, а в
+        Django 1.8+ была удалена, поэтому ничего не делает.
+        """
+
+    def _get_native_atomic(using, savepoint):
+        # Состояние блоков хранится в соединении с БД, поэтому один
+        # экземпляр Atomic может использоваться повторно.
+        return _transaction.atomic(using, savepoint)
+
+    def _enter_atomic(native, connection, using, savepoint):
+        """Открывает блок atomic.
+
+        :returns: Объект, управляющий блоком, и признак создания точки
+            сохранения.
+        :rtype: tuple
+        """
+        nested = connection.in_atomic_block
+        native.__enter__()
+
+        return native, nested and connection.savepoint_ids[-1] is not None
+
+    def _exit_atomic(atomic_, using, exc_type, exc_value, traceback):
+        atomic_.__exit__(exc_type, exc_value, traceback)
+
+    def _needs_rollback(connection):
+        return connection.needs_rollback
+
+    def _in_transaction(connection, using):
+        return connection.in_atomic_block
+
+
+if _VERSION >= (2, 0):
+    class _QueryCounter(object):
+
+        """Счетчик запросов, выполненных через соединение с БД."""
+
+        __slots__ = ('count',)
+
+        def __init__(self):
+            self.count = 0
+
+        def __call__(self, execute, sql, params, many, context):
+            self.count += 1
+            return execute(sql, params, many, context)
+
+    def _start_query_counter(connection):
+        counter = _QueryCounter()
+        connection.execute_wrappers.append(counter)
+        return counter
+
+    def _stop_query_counter(connection, counter):
+        if counter in connection.execute_wrappers:
+            connection.execute_wrappers.remove(counter)
+
+    #: Начала запросов, не требующих создания отложенных точек сохранения.
+    _READ_QUERY_PREFIXES = ('SELECT', 'RELEASE', 'ROLLBACK')
+
+    class _LazySavepoints(object):
+
+        """Отложенные точки сохранения вложенных блоков ``atomic``.
+
+        Пока есть хотя бы один открытый блок с отложенной точкой сохранения,
+        экземпляр установлен в качестве обертки выполнения запросов
+        соединения. Перед первым запросом, отличным от чтения данных,
+        создаются точки сохранения всех ожидающих блоков (от внешнего к
+        внутреннему). Идентификаторы точек сохранения записываются в
+        ``connection.savepoint_ids``, поэтому их подтверждение и откат
+        выполняются штатными средствами ``atomic``.
+
+        Функции ``on_commit``, зарегистрированные в блоке до создания его
+        точки сохранения, запоминают ``savepoint_ids`` без идентификатора
+        этой точки, поэтому при ее создании идентификатор добавляется к
+        ним, чтобы при откате точки сохранения функции не вызывались.
+        """
+
+        __slots__ = ('connection', 'blocks', 'pending', 'active')
+
+        def __init__(self, connection):
+            self.connection = connection
+            # Количество открытых блоков с отложенной точкой сохранения.
+            self.blocks = 0
+            # Блоки, точки сохранения которых еще не созданы, позиции
+            # этих точек в connection.savepoint_ids и количество функций
+            # в connection.run_on_commit на момент открытия блока.
+            self.pending = []
+            # Признак создания точек сохранения (запросы, выполняемые при
+            # этом, обрабатываются без проверок).
+            self.active = False
+
+        def __call__(self, execute, sql, params, many, context):
+            if (
+                self.pending and
+                not self.active and
+                not sql.lstrip()[:8].upper().startswith(_READ_QUERY_PREFIXES)
+            ):
+                self.create_savepoints()
+
+            return execute(sql, params, many, context)
+
+        def create_savepoints(self):
+            connection = self.connection
+            self.active = True
+            try:
+                while self.pending and not connection.needs_rollback:
+                    frame, index, callbacks = self.pending[0]
+                    sid = connection.savepoint()
+                    connection.savepoint_ids[index] = sid
+                    if sid is not None:
+                        for entry in connection.run_on_commit[callbacks:]:
+                            entry[0].add(sid)
+                    frame.savepoint = sid is not None
+                    del self.pending[0]
+            finally:
+                self.active = False
+
+    _LAZY_SAVEPOINTS_SUPPORTED = True
+
+    def _defer_savepoint(frame):
+        """Откладывает создание точки сохранения для вложенного блока."""
+        lazy_savepoints = _state.lazy_savepoints.get(frame.using)
+        if lazy_savepoints is None:
+            lazy_savepoints = _LazySavepoints(frame.connection)
+            frame.connection.execute_wrappers.append(lazy_savepoints)
+            _state.lazy_savepoints[frame.using] = lazy_savepoints
+
+        lazy_savepoints.blocks += 1
+        connection = frame.connection
+        lazy_savepoints.pending.append((
+            frame,
+            len(connection.savepoint_ids) - 1,
+            len(connection.run_on_commit),
+        ))
+
+    def _release_deferred_savepoint(frame):
+        """Завершает отложенное создание точки сохранения для блока."""
+        lazy_savepoints = _state.lazy_savepoints[frame.using]
+        lazy_savepoints.pending = [
+            pending for pending in lazy_savepoints.pending
+            if pending[0] is not frame
+        ]
+
+        lazy_savepoints.blocks -= 1
+        if not lazy_savepoints.blocks:
+            execute_wrappers = frame.connection.execute_wrappers
+            if lazy_savepoints in execute_wrappers:
+                execute_wrappers.remove(lazy_savepoints)
+            del _state.lazy_savepoints[frame.using]
+else:
+    # До Django 2.0 нет возможности перехватить выполнение запросов без
+    # замены курсора, поэтому количество запросов не подсчитывается, а
+    # точки сохранения создаются сразу.
+    def _start_query_counter(connection):
+        return None
+
+    def _stop_query_counter(connection, counter):
+        pass
+
+    _LAZY_SAVEPOINTS_SUPPORTED = False
+# -----------------------------------------------------------------------------
+# События и слушатели
+
+
+#: Событие открытия блока ``atomic``.
+TRANSACTION_START = 'start'
+
+#: Событие успешного завершения блока ``atomic``.
+TRANSACTION_COMMIT = 'commit'
+
+#: Событие отката блока ``atomic``.
+TRANSACTION_ROLLBACK = 'rollback'
+
+
+#: Событие блока ``atomic``.
+#:
+#: Атрибуты:
+#:
+#: - ``kind`` - вид события (``TRANSACTION_START``, ``TRANSACTION_COMMIT``
+#:   или ``TRANSACTION_ROLLBACK``);
+#: - ``using`` - алиас базы данных;
+#: - ``depth`` - уровень вложенности блока (0 - внешний блок);
+#: - ``savepoint`` - признак создания точки сохранения для блока;
+#: - ``duration`` - время выполнения блока в секундах (``None`` для события
+#:   открытия блока);
+#: - ``queries`` - количество запросов, выполненных в блоке (``None`` для
+#:   события открытия блока, в Django<2.0, для блоков, открытых до
+#:   регистрации первого слушателя, подсчитывающего запросы, а также если
+#:   таких слушателей нет);
+#: - ``outermost`` - признак открытия блоком транзакции (``False`` для
+#:   блоков, вложенных в транзакцию, в т.ч. открытую штатным ``atomic``
+#:   Django или параметром ``ATOMIC_REQUESTS``).
+TransactionEvent = namedtuple(
+    'TransactionEvent',
+    (
+        'kind', 'using', 'depth', 'savepoint', 'duration', 'queries',
+        'outermost',
+    ),
+)
+
+
+_listeners = ()
+# Слушатели, которым нужно количество запросов, выполненных в блоках.
+_counting_listeners = ()
+_listeners_lock = Lock()
+
+
+def add_transaction_listener(listener, count_queries=None):
+    """Регистрирует слушателя событий блоков ``atomic``.
+
+    :param listener: Вызываемый объект, принимающий экземпляр
+        :class:`TransactionEvent`. Исключения, возникающие в слушателе,
+        записываются в журнал и не влияют на выполнение транзакции.
+    :param bool count_queries: Определяет, нужно ли подсчитывать запросы,
+        выполненные в блоках. Подсчет запросов требует установки обертки
+        выполнения запросов, поэтому выполняется, только если его
+        запросил хотя бы один из слушателей. По умолчанию определяется
+        атрибутом ``count_queries`` слушателя (при его отсутствии - не
+        выполняется).
+    """
+    global _listeners, _counting_listeners  # pylint: disable=global-statement
+
+    if count_queries is None:
+        count_queries = getattr(listener, 'count_queries', False)
+
+    with _listeners_lock:
+        if listener not in _listeners:
+            _listeners += (listener,)
+            if count_queries:
+                _counting_listeners += (listener,)
+
+
+def remove_transaction_listener(listener):
+    """Отменяет регистрацию слушателя событий блоков ``atomic``."""
+    global _listeners, _counting_listeners  # pylint: disable=global-statement
+
+    with _listeners_lock:
+        _listeners = tuple(
+            registered for registered in _listeners
+            if registered != listener
+        )
+        _counting_listeners = tuple(
+            registered for registered in _counting_listeners
+            if registered != listener
+        )
+
+
+def _notify(event):
+    for listener in _listeners:
+        try:
+            listener(event)
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception('Transaction listener %r failed.', listener)
+# -----------------------------------------------------------------------------
+# Блоки atomic
+
+
+class _TransactionFrame(object):
+
+    """Открытый блок ``atomic``."""
+
+    __slots__ = (
+        'using', 'connection', 'depth', 'outermost', 'atomic', 'savepoint',
+        'lazy', 'started', 'counter', 'queries', 'callbacks', 'cache',
+    )
+
+    def __init__(self, using, connection, depth):
+        self.using = using
+        self.connection = connection
+        self.depth = depth
+        # Признак открытия блоком транзакции (а не точки сохранения).
+        self.outermost = False
+        # Объект, управляющий блоком.
+        self.atomic = None
+        self.savepoint = False
+        # Признак отложенного создания точки сохранения.
+        self.lazy = False
+        self.started = None
+        # Счетчик запросов внешнего блока и его значение при открытии блока.
+        self.counter = None
+        self.queries = None
+        # Функции, которые будут вызваны после подтверждения транзакции
+        # (используются в Django<1.9).
+        self.callbacks = None
+        # Кэш транзакции (используется в Django<1.9).
+        self.cache = None
+
+
+class _State(local):
+
+    def __init__(self):
+        super(_State, self).__init__()
+        # Стеки открытых блоков по алиасам баз данных.
+        self.frames = {}
+        # Отложенные точки сохранения по алиасам баз данных.
+        self.lazy_savepoints = {}
+        # Кэши транзакций по алиасам баз данных (используются в Django>=1.9).
+        self.caches = {}
+
+
+_state = _State()
+
+
+def _get_frames(using):
+    frames = _state.frames.get(using)
+    if frames is None:
+        frames = _state.frames[using] = []
+
+    return frames
+
+
+class Atomic(object):
+
+    """Менеджер контекста/декоратор ``atomic``.
+
+    Состояние открытых блоков хранится отдельно для каждого потока, поэтому
+    один экземпляр может использоваться повторно, в т.ч. рекурсивно.
+    """
+
+    def __init__(self, using, savepoint):
+        self.using = using or DEFAULT_DB_ALIAS
+        self.lazy = savepoint == LAZY_SAVEPOINT and _LAZY_SAVEPOINTS_SUPPORTED
+        # Без возможности отложить создание точки сохранения она создается
+        # сразу.
+        self.savepoint = bool(savepoint) and not self.lazy
+        self._native = _get_native_atomic(self.using, self.savepoint)
+
+    def __enter__(self):
+        using = self.using
+        connection = connections[using]
+        frames = _get_frames(using)
+        frame = _TransactionFrame(using, connection, len(frames))
+
+        if frames:
+            frame.counter = frames[-1].counter
+        elif _counting_listeners:
+            frame.counter = _start_query_counter(connection)
+        if frame.counter is not None:
+            frame.queries = frame.counter.count
+
+        frame.started = default_timer()
+        frame.outermost = not _in_transaction(connection, using)
+        frame.lazy = self.lazy and not frame.outermost
+        try:
+            frame.atomic, frame.savepoint = _enter_atomic(
+                self._native, connection, using, self.savepoint
+            )
+        except:  # noqa
+            if not frames and frame.counter is not None:
+                _stop_query_counter(connection, frame.counter)
+            raise
+        frames.append(frame)
+        if frame.lazy:
+            _defer_savepoint(frame)
+
+        if _listeners:
+            _notify(TransactionEvent(
+                TRANSACTION_START, using, frame.depth, frame.savepoint, None,
+                None, frame.outermost,
+            ))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        frames = _get_frames(self.using)
+        frame = frames.pop()
+
+        rollback = exc_type is not None or _needs_rollback(frame.connection)
+        if frame.lazy:
+            _release_deferred_savepoint(frame)
+            # Если точка сохранения не создавалась, то блок не изменял
+            # данные, и при исключении, не связанном с ошибкой БД, откат
+            # внешней транзакции не требуется.
+            restore_needs_rollback = (
+                exc_type is not None and
+                not frame.savepoint and
+                not issubclass(exc_type, DatabaseError)
+            )
+            needs_rollback = frame.connection.needs_rollback
+        else:
+            restore_needs_rollback = False
+
+        try:
+            _exit_atomic(
+                frame.atomic, frame.using, exc_type, exc_value, traceback
+            )
+            if restore_needs_rollback:
+                frame.connection.needs_rollback = needs_rollback
+        except:  # noqa
+            rollback = True
+            raise
+        finally:
+            if not frames and frame.counter is not None:
+                _stop_query_counter(frame.connection, frame.counter)
+            if _listeners:
+                _notify(_get_exit_event(frame, rollback))
+
+        if not frames:
+            _state.caches.pop(self.using, None)
+        elif rollback:
+            # Откат точки сохранения мог отменить изменения, поэтому
+            # сохраненные в кэше транзакции результаты недействительны.
+            frames[0].cache = None
+
+        if frame.callbacks is not None and not rollback:
+            if frames:
+                frames[-1].callbacks = frame.callbacks.merge(
+                    frames[-1].callbacks
+                )
+            else:
+                frame.callbacks.run()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return inner
+
+
+def _get_exit_event(frame, rollback):
+    return TransactionEvent(
+        TRANSACTION_ROLLBACK if rollback else TRANSACTION_COMMIT,
+        frame.using,
+        frame.depth,
+        frame.savepoint,
+        default_timer() - frame.started,
+        (
+            frame.counter.count - frame.queries
+            if frame.counter is not None else None
+        ),
+        frame.outermost,
+    )
+
+
+def atomic(using=None, savepoint=True):
+    """Совместимый аналог декоратора/менеджера контекста ``atomic``.
+
+    В Django>=1.6 задействует функционал ``atomic``, а в версиях ниже 1.6
+    имитирует его поведение средствами модуля ``django.db.transaction``, при
+    этом, в отличие от ``commit_on_success`` из Django<1.6, поддерживает
+    вложенность.
+
+    При открытии и завершении блока уведомляет слушателей,
+    зарегистрированных функцией :func:`add_transaction_listener`.
+
+    :param str using: Алиас базы данных. Если указано значение ``None``, будет
+        использован алиас базы данных по умолчанию.
+    :param savepoint: Определяет, будут ли использоваться точки сохранения
+        (savepoints) при использовании вложенных ``atomic``. Если указано
+        значение :data:`LAZY_SAVEPOINT` (``'lazy'``), то точка сохранения
+        создается только перед первым изменяющим данные запросом блока, а
+        если таких запросов не было - не создается (и не освобождается) вовсе.
+        Отложенное создание точек сохранения доступно в Django>=2.0, в более
+        ранних версиях точка сохранения создается сразу.
+    :type savepoint: bool or str
+    """
+    if callable(using):
+        # atomic вызван как декоратор без параметров
+        return Atomic(DEFAULT_DB_ALIAS, savepoint)(using)
+
+    return Atomic(using, savepoint)
+# -----------------------------------------------------------------------------
+# Блоки atomic для нескольких баз данных
+
+
+class AtomicManyError(DatabaseError):
+
+    """Ошибка завершения блока ``atomic_many``.
+
+    Возникает, если не удалось подтвердить транзакцию (точку сохранения) в
+    одной из баз данных. Транзакции в базах данных, следующих за ней,
+    откатываются, а уже подтвержденные транзакции остаются подтвержденными.
+    """
+
+    def __init__(self, using, committed, error):
+        super(AtomicManyError, self).__init__(
+            'Failed to commit transaction on {!r} (committed: {}): {!r}'
+            .format(using, ', '.join(committed) or '-', error)
+        )
+        #: Алиас базы данных, в которой возникла ошибка.
+        self.using = using
+        #: Алиасы баз данных, транзакции в которых были подтверждены.
+        self.committed = committed
+        #: Исходное исключение.
+        self.error = error
+
+
+if _VERSION >= (1, 9):
+    def _detach_commit_hooks(using):
+        """Извлекает функции, которые будут вызваны при завершении блока.
+
+        Функции извлекаются только если текущий блок - внешний блок
+        транзакции, открытый функцией :func:`atomic` из этого модуля.
+
+        :returns: Функция, вызывающая извлеченные функции, либо ``None``.
+        """
+        frames = _state.frames.get(using)
+        if not frames or len(frames) != 1 or not frames[0].outermost:
+            return None
+
+        connection = connections[using]
+        hooks = connection.run_on_commit
+        connection.run_on_commit = []
+
+        def run():
+            for _, func in hooks:
+                func()
+
+        return run
+
+else:
+    def _detach_commit_hooks(using):
+        """Извлекает функции, которые будут вызваны при завершении блока.
+
+        Функции извлекаются только если текущий блок - внешний блок
+        транзакции, открытый функцией :func:`atomic` из этого модуля.
+
+        :returns: Функция, вызывающая извлеченные функции, либо ``None``.
+        """
+        frames = _state.frames.get(using)
+        if not frames or len(frames) != 1 or not frames[0].outermost:
+            return None
+
+        callbacks = frames[0].callbacks
+        frames[0].callbacks = None
+
+        return callbacks.run if callbacks is not None else None
+
+
+class AtomicMany(object):
+
+    """Менеджер контекста/декоратор ``atomic_many``."""
+
+    def __init__(self, aliases, savepoint):
+        self.aliases = tuple(sorted(set(
+            using or DEFAULT_DB_ALIAS for using in aliases
+        )))
+        self._atomics = tuple(
+            Atomic(using, savepoint) for using in self.aliases
+        )
+
+    @staticmethod
+    def _rollback(atomics, exc_type, exc_value, traceback):
+        for atomic_ in reversed(atomics):
+            try:
+                atomic_.__exit__(exc_type, exc_value, traceback)
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception(
+                    'Failed to roll back transaction on %r.', atomic_.using
+                )
+
+    @staticmethod
+    def _run_hooks_safely(hooks):
+        for run_hooks in hooks:
+            try:
+                run_hooks()
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception('On commit function failed.')
+
+    def __enter__(self):
+        for index, atomic_ in enumerate(self._atomics):
+            try:
+                atomic_.__enter__()
+            except:  # noqa
+                self._rollback(self._atomics[:index], *sys.exc_info())
+                raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self._rollback(self._atomics, exc_type, exc_value, traceback)
+            return
+
+        # Блоки в разных базах данных независимы, поэтому транзакции
+        # подтверждаются в том же порядке, в котором были открыты. Функции,
+        # зарегистрированные через on_commit, вызываются после завершения
+        # всех блоков, чтобы их ошибки не считались ошибками подтверждения.
+        hooks = []
+        for index, atomic_ in enumerate(self._atomics):
+            run_hooks = _detach_commit_hooks(atomic_.using)
+            try:
+                atomic_.__exit__(None, None, None)
+            except Exception as error:
+                exc_info = sys.exc_info()
+                self._rollback(self._atomics[index + 1:], *exc_info)
+                self._run_hooks_safely(hooks)
+                six.reraise(
+                    AtomicManyError,
+                    AtomicManyError(
+                        atomic_.using, self.aliases[:index], error
+                    ),
+                    exc_info[2],
+                )
+            if run_hooks is not None:
+                hooks.append(run_hooks)
+
+        for run_hooks in hooks:
+            run_hooks()
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+
+        return inner
+
+
+def atomic_many(aliases, savepoint=True):
+    """Блок ``atomic``, охватывающий несколько баз данных.
+
+    Блоки открываются в порядке сортировки алиасов (что исключает
+    взаимоблокировки при одновременном выполнении нескольких таких блоков)
+    и в том же порядке завершаются. При исключении внутри блока транзакции
+    во всех базах данных откатываются. Если не удалось подтвердить
+    транзакцию в одной из баз данных, то транзакции в следующих базах данных
+    откатываются, и возникает исключение :class:`AtomicManyError`.
+
+    Функции, зарегистрированные через :func:`on_commit`, вызываются после
+    подтверждения транзакций во всех базах данных, поэтому исключение в
+    такой функции не влияет на подтверждение транзакций и не оборачивается
+    в :class:`AtomicManyError`.
+
+    .. note::
+
+       Атомарность изменений в нескольких базах данных не гарантируется:
+       транзакции, подтвержденные до возникновения ошибки, не откатываются.
+
+    :param aliases: Алиасы баз данных.
+    :type aliases: collections.Iterable
+    :param savepoint: См. :func:`atomic`.
+
+    :rtype: AtomicMany
+    """
+    return AtomicMany(aliases, savepoint)
+# -----------------------------------------------------------------------------
+# Повторное выполнение транзакций
+
+
+#: Коды ошибок PostgreSQL, при которых транзакцию можно повторить
+#: (serialization_failure и deadlock_detected).
+_RETRYABLE_PGCODES = frozenset(('40001', '40P01'))
+
+#: Коды ошибок MySQL, при которых транзакцию можно повторить
+#: (ER_LOCK_WAIT_TIMEOUT и ER_LOCK_DEADLOCK).
+_RETRYABLE_MYSQL_CODES = frozenset((1205, 1213))
+
+
+def is_retryable_error(error):
+    """Возвращает True, если транзакцию, прерванную ошибкой, можно повторить.
+
+    Повторять имеет смысл транзакции, прерванные из-за конфликта с другими
+    транзакциями: ошибки сериализации и взаимоблокировки, а для SQLite -
+    блокировка базы данных.
+
+    :param error: Исключение, прервавшее транзакцию.
+
+    :rtype: bool
+    """
+    if not isinstance(error, DatabaseError):
+        return False
+
+    # Django сохраняет исходное исключение драйвера БД в __cause__.
+    cause = getattr(error, '__cause__', None) or error
+    if getattr(cause, 'pgcode', None) in _RETRYABLE_PGCODES:
+        return True
+
+    args = getattr(cause, 'args', ())
+    if args and args[0] in _RETRYABLE_MYSQL_CODES:
+        return True
+
+    return (
+        isinstance(error, OperationalError) and
+        'database is locked' in str(error)
+    )
+
+
+_retry_counters = {}
+_retry_counters_lock = Lock()
+
+
+def _count_retry(using, name):
+    with _retry_counters_lock:
+        counters = _retry_counters.get(using)
+        if counters is None:
+            counters = _retry_counters[using] = dict(
+                retries=0, recovered=0, exhausted=0,
+            )
+        counters[name] += 1
+
+
+def get_retry_counters():
+    """Возвращает счетчики повторного выполнения транзакций.
+
+    :returns: Словарь, ключами которого являются алиасы баз данных, а
+        значениями - словари со счетчиками: ``retries`` - количество
+        повторных попыток, ``recovered`` - количество транзакций, успешно
+        выполненных после повтора, ``exhausted`` - количество транзакций,
+        не выполненных после всех попыток.
+    :rtype: dict
+    """
+    with _retry_counters_lock:
+        return dict(
+            (using, dict(counters))
+            for using, counters in _retry_counters.items()
+        )
+
+
+def reset_retry_counters():
+    """Сбрасывает счетчики повторного выполнения транзакций."""
+    with _retry_counters_lock:
+        _retry_counters.clear()
+
+
+class _Attempt(object):
+
+    """Попытка выполнения транзакции.
+
+    Менеджер контекста, подавляющий исключения, при которых транзакцию
+    можно повторить (кроме последней попытки).
+    """
+
+    __slots__ = ('atomic', 'retry', 'final', 'error')
+
+    def __init__(self, atomic_, retry, final):
+        self.atomic = atomic_
+        # Признак возможности повтора транзакции.
+        self.retry = retry
+        # Признак последней попытки.
+        self.final = final
+        # Исключение, прервавшее попытку.
+        self.error = None
+
+    def _suppress(self, error):
+        if not self.retry or not is_retryable_error(error):
+            return False
+
+        if self.final:
+            _count_retry(self.atomic.using, 'exhausted')
+            return False
+
+        self.error = error
+        return True
+
+    def __enter__(self):
+        self.atomic.__enter__()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            # Ошибка сериализации может возникнуть и при подтверждении.
+            self.atomic.__exit__(exc_type, exc_value, traceback)
+        except DatabaseError as error:
+            if not self._suppress(error):
+                raise
+            return True
+
+        if exc_type is not None:
+            return self._suppress(exc_value)
+
+
+class AtomicRetry(object):
+
+    """Блок ``atomic``, повторяемый при ошибках сериализации транзакций.
+
+    Используется как декоратор, либо как итератор попыток:
+
+    .. code::
+
+       @atomic_retry(attempts=5)
+       def transfer(source, target, amount):
+           ...
+
+       for attempt in atomic_retry(attempts=5):
+           with attempt:
+               ...
+
+    Повторяется только внешний блок: если транзакция уже открыта, то блок
+    выполняется однократно, как обычный ``atomic``, т.к. повторить
+    прерванную транзакцию частично нельзя.
+    """
+
+    def __init__(self, using, attempts, backoff, max_backoff, savepoint):
+        assert attempts >= 1, attempts
+
+        self.using = using or DEFAULT_DB_ALIAS
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.atomic = Atomic(self.using, savepoint)
+
+    def get_delay(self, attempt):
+        """Возвращает паузу перед повторной попыткой (в секундах).
+
+        По умолчанию пауза выбирается случайно из интервала, верхняя граница
+        которого растет экспоненциально с номером попытки.
+
+        :param int attempt: Номер завершившейся неудачей попытки (с 1).
+
+        :rtype: float
+        """
+        if callable(self.backoff):
+            return self.backoff(attempt)
+
+        return uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        )
+
+    def __iter__(self):
+        if in_atomic_block(self.using):
+            yield _Attempt(self.atomic, False, True)
+            return
+
+        for number in range(1, self.attempts + 1):
+            attempt = _Attempt(self.atomic, True, number == self.attempts)
+            yield attempt
+
+            if attempt.error is None:
+                if number > 1:
+                    _count_retry(self.using, 'recovered')
+                return
+
+            _count_retry(self.using, 'retries')
+            _logger.debug(
+                'Retrying transaction on %s after %r (attempt %d of %d).',
+                self.using, attempt.error, number + 1, self.attempts,
+            )
+            delay = self.get_delay(number)
+            if delay > 0:
+                sleep(delay)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            for attempt in self:
+                with attempt:
+                    result = func(*args, **kwargs)
+
+            return result
+
+        return inner
+
+
+def atomic_retry(using=None, attempts=3, backoff=0.05, max_backoff=1,
+                 savepoint=True):
+    """Блок ``atomic``, повторяемый при ошибках сериализации транзакций.
+
+    Транзакция выполняется повторно, если она была прервана исключением, для
+    которого :func:`is_retryable_error` возвращает ``True``. Количество
+    повторов учитывается в счетчиках (см. :func:`get_retry_counters`).
+
+    :param str using: Алиас базы данных.
+    :param int attempts: Максимальное количество попыток.
+    :param backoff: Начальная верхняя граница паузы между попытками (в
+        секундах), удваиваемая с каждой попыткой, либо функция, принимающая
+        номер попытки и возвращающая паузу.
+    :type backoff: float or callable
+    :param float max_backoff: Максимальная верхняя граница паузы между
+        попытками (в секундах).
+    :param savepoint: См. :func:`atomic`.
+
+    :rtype: AtomicRetry
+    """
+    if callable(using):
+        # atomic_retry вызван как декоратор без параметров
+        return AtomicRetry(
+            DEFAULT_DB_ALIAS, attempts, backoff, max_backoff, savepoint
+        )(using)
+
+    return AtomicRetry(using, attempts, backoff, max_backoff, savepoint)
+# -----------------------------------------------------------------------------
+# Действия после подтверждения транзакции
+
+
+if _VERSION >= (1, 9):
+    class _KeyedCallback(object):
+
+        """Функция, зарегистрированная с ключом."""
+
+        __slots__ = ('key', 'func')
+
+        def __init__(self, key, func):
+            self.key = key
+            self.func = func
+
+        def __call__(self):
+            return self.func()
+
+    def _get_callback_keys(connection):
+        """Возвращает ключи функций, зарегистрированных в транзакции.
+
+        Django заменяет список ``connection.run_on_commit`` новым при
+        завершении транзакции и при откате точки сохранения, поэтому ключи
+        пересчитываются только после замены списка.
+
+        :rtype: set
+        """
+        run_on_commit = connection.run_on_commit
+        state = getattr(connection, '_compat_callback_keys', None)
+        if state is None or state[0] is not run_on_commit:
+            state = connection._compat_callback_keys = (
+                run_on_commit,
+                set(
+                    func.key for _, func in run_on_commit
+                    if isinstance(func, _KeyedCallback)
+                ),
+            )
+
+        return state[1]
+
+    def on_commit(func, using=None, key=None):
+        """Регистрирует функцию, вызываемую после подтверждения транзакции.
+
+        Если транзакция не открыта, функция вызывается сразу. При откате
+        транзакции (или точки сохранения, после создания которой функция
+        была зарегистрирована) функция не вызывается.
+
+        :param func: Функция без аргументов.
+        :param str using: Алиас базы данных.
+        :param key: Ключ функции. Если в транзакции уже зарегистрирована
+            функция с таким же ключом, то повторная регистрация не
+            выполняется, т.е. функция будет вызвана один раз независимо от
+            количества вызовов ``on_commit``.
+        :type key: collections.Hashable
+        """
+        connection = connections[using or DEFAULT_DB_ALIAS]
+        if key is not None and connection.in_atomic_block:
+            keys = _get_callback_keys(connection)
+            if key in keys:
+                return
+            keys.add(key)
+            func = _KeyedCallback(key, func)
+
+        _transaction.on_commit(func, using)
+
+else:
+    class _Callbacks(object):
+
+        """Функции, зарегистрированные в блоке ``atomic``."""
+
+        __slots__ = ('funcs', 'keys')
+
+        def __init__(self):
+            self.funcs = []
+            self.keys = set()
+
+        def merge(self, callbacks):
+            """Возвращает объединение с функциями внешнего блока."""
+            if callbacks is None:
+                return self
+
+            callbacks.funcs.extend(self.funcs)
+            callbacks.keys.update(self.keys)
+
+            return callbacks
+
+        def run(self):
+            funcs = self.funcs
+            self.funcs = []
+            self.keys = set()
+            for func in funcs:
+                func()
+
+    def on_commit(func, using=None, key=None):
+        """Регистрирует функцию, вызываемую после подтверждения транзакции.
+
+        Если транзакция не открыта, функция вызывается сразу. При откате
+        транзакции (или точки сохранения, после создания которой функция
+        была зарегистрирована) функция не вызывается.
+
+        В Django<1.9 транзакция должна быть открыта функцией
+        :func:`atomic` из этого модуля, иначе возникает исключение
+        :class:`~django.db.transaction.TransactionManagementError`.
+
+        :param func: Функция без аргументов.
+        :param str using: Алиас базы данных.
+        :param key: Ключ функции. Если в транзакции уже зарегистрирована
+            функция с таким же ключом, то повторная регистрация не
+            выполняется, т.е. функция будет вызвана один раз независимо от
+            количества вызовов ``on_commit``.
+        :type key: collections.Hashable
+        """
+        using = using or DEFAULT_DB_ALIAS
+        if not in_atomic_block(using):
+            func()
+            return
+
+        frames = _state.frames.get(using)
+        if not frames or not frames[0].outermost:
+            raise TransactionManagementError(
+                'on_commit() requires a transaction opened by '
+                'm3_django_compat.atomic().'
+            )
+
+        if key is not None:
+            if any(
+                frame.callbacks is not None and key in frame.callbacks.keys
+                for frame in frames
+            ):
+                return
+
+        frame = frames[-1]
+        if frame.callbacks is None:
+            frame.callbacks = _Callbacks()
+        frame.callbacks.funcs.append(func)
+        if key is not None:
+            frame.callbacks.keys.add(key)
+# -----------------------------------------------------------------------------
+# Кэширование в пределах транзакции
+
+
+#: Признак отсутствия значения в кэше.
+_NOT_CACHED = object()
+
+
+if _VERSION >= (1, 9):
+    def _get_transaction_cache(using):
+        """Возвращает кэш текущей транзакции.
+
+        Django заменяет список ``connection.run_on_commit`` новым при
+        завершении транзакции и при откате точки сохранения, поэтому кэш,
+        созданный для другого списка, считается недействительным.
+
+        :rtype: dict
+        """
+        run_on_commit = connections[using].run_on_commit
+        state = _state.caches.get(using)
+        if state is None or state[0] is not run_on_commit:
+            state = _state.caches[using] = (run_on_commit, {})
+
+        return state[1]
+
+else:
+    def _get_transaction_cache(using):
+        """Возвращает кэш текущей транзакции.
+
+        В Django<1.9 кэш хранится во внешнем блоке, поэтому доступен только
+        в транзакциях, открытых функцией :func:`atomic` из этого модуля.
+
+        :rtype: dict or None
+        """
+        frames = _state.frames.get(using)
+        if not frames or not frames[0].outermost:
+            return None
+
+        if frames[0].cache is None:
+            frames[0].cache = {}
+
+        return frames[0].cache
+
+
+class TransactionCached(object):
+
+    """Декоратор, кэширующий результаты функции в пределах транзакции."""
+
+    def __init__(self, using):
+        self.using = using or DEFAULT_DB_ALIAS
+
+    def __call__(self, func):
+        using = self.using
+
+        @wraps(func)
+        def inner(*args, **kwargs):
+            if not in_atomic_block(using):
+                return func(*args, **kwargs)
+
+            cache = _get_transaction_cache(using)
+            if cache is None:
+                return func(*args, **kwargs)
+
+            key = (inner, args, frozenset(kwargs.items())) if kwargs else (
+                inner, args
+            )
+            try:
+                result = cache.get(key, _NOT_CACHED)
+            except TypeError:
+                # Аргументы, не поддерживающие хэширование, не кэшируются.
+                return func(*args, **kwargs)
+
+            if result is _NOT_CACHED:
+                result = cache[key] = func(*args, **kwargs)
+
+            return result
+
+        return inner
+
+
+def transaction_cached(using=None):
+    """Декоратор, кэширующий результаты функции в пределах транзакции.
+
+    Внутри блока ``atomic`` результат функции сохраняется в кэше, связанном
+    с текущей транзакцией, и при повторных вызовах с теми же аргументами
+    возвращается из кэша. Кэш очищается при подтверждении и откате
+    транзакции, а также при откате точки сохранения вложенного блока. Вне
+    транзакции функция вызывается без кэширования.
+
+    .. code::
+
+       @transaction_cached
+       def get_setting(name):
+           return Setting.objects.get(name=name).value
+
+    В Django<1.9 результаты кэшируются только в транзакциях, открытых
+    функцией :func:`atomic` из этого модуля.
+
+    :param str using: Алиас базы данных.
+    """
+    if callable(using):
+        # transaction_cached вызван как декоратор без параметров
+        return TransactionCached(DEFAULT_DB_ALIAS)(using)
+
+    return TransactionCached(using)
+
+
+def clear_transaction_cache(using=None):
+    """Очищает кэш текущей транзакции.
+
+    :param str using: Алиас базы данных.
+    """
+    using = using or DEFAULT_DB_ALIAS
+    if in_atomic_block(using):
+        cache = _get_transaction_cache(using)
+        if cache:
+            cache.clear()
+# -----------------------------------------------------------------------------
+# Статистика транзакций
+
+
+class _AliasStatistics(object):
+
+    __slots__ = (
+        'transactions', 'blocks', 'rollbacks', 'savepoints', 'max_depth',
+        'total_time', 'max_time', 'queries', 'histogram',
+    )
+
+    def __init__(self, size):
+        # Количество внешних блоков (транзакций) и всех блоков.
+        self.transactions = 0
+        self.blocks = 0
+        self.rollbacks = 0
+        self.savepoints = 0
+        self.max_depth = 0
+        # Время выполнения и количество запросов внешних блоков.
+        self.total_time = 0
+        self.max_time = 0
+        self.queries = 0
+        self.histogram = [0] * size
+
+
+class TransactionStatistics(object):
+
+    """Слушатель событий, собирающий статистику транзакций.
+
+    Для каждого алиаса базы данных подсчитывает количество блоков, откатов и
+    точек сохранения, максимальную вложенность блоков, а для блоков,
+    открывающих транзакцию (см. ``TransactionEvent.outermost``), - время
+    выполнения, количество запросов и гистограмму времени выполнения.
+
+    .. code::
+
+       statistics = TransactionStatistics()
+       add_transaction_listener(statistics)
+    """
+
+    #: Слушателю нужно количество запросов, выполненных в блоках.
+    count_queries = True
+
+    #: Верхние границы интервалов гистограммы времени выполнения транзакций
+    #: (в секундах). Последний интервал гистограммы не ограничен сверху.
+    buckets = (
+        0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+        10,
+    )
+
+    def __init__(self, buckets=None):
+        """Инициализация экземпляра.
+
+        :param buckets: Верхние границы интервалов гистограммы (в секундах).
+        """
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+
+        self._lock = Lock()
+        self._statistics = {}
+
+    def __call__(self, event):
+        if event.kind == TRANSACTION_START:
+            return
+
+        with self._lock:
+            statistics = self._statistics.get(event.using)
+            if statistics is None:
+                statistics = self._statistics[event.using] = (
+                    _AliasStatistics(len(self.buckets) + 1)
+                )
+
+            statistics.blocks += 1
+            if event.kind == TRANSACTION_ROLLBACK:
+                statistics.rollbacks += 1
+            if event.savepoint:
+                statistics.savepoints += 1
+            statistics.max_depth = max(statistics.max_depth, event.depth)
+
+            if event.outermost:
+                statistics.transactions += 1
+                statistics.total_time += event.duration
+                statistics.max_time = max(statistics.max_time, event.duration)
+                statistics.queries += event.queries or 0
+                statistics.histogram[
+                    bisect_left(self.buckets, event.duration)
+                ] += 1
+
+    def get_statistics(self):
+        """Возвращает собранную статистику.
+
+        :returns: Словарь, ключами которого являются алиасы баз данных, а
+            значениями - словари со статистикой. Гистограмма представлена
+            кортежем пар (верхняя граница интервала, количество транзакций),
+            для последнего интервала граница равна ``None``.
+        :rtype: dict
+        """
+        with self._lock:
+            return dict(
+                (using, dict(
+                    transactions=statistics.transactions,
+                    blocks=statistics.blocks,
+                    rollbacks=statistics.rollbacks,
+                    savepoints=statistics.savepoints,
+                    max_depth=statistics.max_depth,
+                    total_time=statistics.total_time,
+                    max_time=statistics.max_time,
+                    queries=statistics.queries,
+                    histogram=tuple(zip(
+                        self.buckets + (None,), statistics.histogram
+                    )),
+                ))
+                for using, statistics in self._statistics.items()
+            )
+
+    def reset(self):
+        """Сбрасывает собранную статистику."""
+        with self._lock:
+            self._statistics.clear()
+# -----------------------------------------------------------------------------
+# Контроль длительности транзакций
+
+
+#: Транзакция, выполняющаяся дольше допустимого.
+#:
+#: Атрибуты:
+#:
+#: - ``using`` - алиас базы данных;
+#: - ``thread`` - имя потока, в котором открыта транзакция;
+#: - ``duration`` - время, прошедшее с открытия транзакции (в секундах);
+#: - ``stack`` - стек вызовов в момент открытия транзакции (строка в формате
+#:   модуля :mod:`traceback`).
+LongTransaction = namedtuple(
+    'LongTransaction', ('using', 'thread', 'duration', 'stack'),
+)
+
+
+class _OpenTransaction(object):
+
+    __slots__ = ('using', 'thread', 'started', 'frames', 'reported')
+
+    def __init__(self, using, thread, frames):
+        self.using = using
+        self.thread = thread
+        self.started = default_timer()
+        # Пары (объект кода, номер строки) - форматирование стека
+        # откладывается до момента, когда оно потребуется.
+        self.frames = frames
+        self.reported = False
+
+
+def _capture_stack(limit):
+    """Возвращает стек вызовов без кадров этого модуля."""
+    frame = sys._getframe(1)  # pylint: disable=protected-access
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+
+    frames = []
+    while frame is not None and len(frames) < limit:
+        frames.append((frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+
+    return frames
+
+
+def _format_stack(frames):
+    return ''.join(traceback.format_list([
+        (
+            code.co_filename, lineno, code.co_name,
+            linecache.getline(code.co_filename, lineno).strip(),
+        )
+        for code, lineno in reversed(frames)
+    ]))
+
+
+class TransactionWatchdog(object):
+
+    """Слушатель событий, контролирующий длительность транзакций.
+
+    Отслеживает блоки ``atomic``, открывающие транзакцию, в каждом потоке
+    для каждого алиаса базы данных, и сообщает о блоках, выполняющихся
+    дольше заданного времени (однократно для каждого блока). Проверка
+    выполняется фоновым потоком, поэтому при открытии и завершении блоков
+    выполняется только сохранение стека вызовов (запросы не
+    подсчитываются).
+
+    Транзакции, открытые штатным ``atomic`` Django (в т.ч. при
+    ``ATOMIC_REQUESTS``), не отслеживаются, а вложенные в них блоки не
+    считаются отдельными транзакциями.
+
+    .. code::
+
+       watchdog = TransactionWatchdog(threshold=30)
+       watchdog.start()
+    """
+
+    def __init__(self, threshold, callback=None, interval=None,
+                 stack_limit=20):
+        """Инициализация экземпляра.
+
+        :param float threshold: Допустимая длительность транзакции (в
+            секундах).
+        :param callback: Функция, принимающая экземпляр
+            :class:`LongTransaction`. По умолчанию сведения о транзакции
+            записываются в журнал.
+        :param float interval: Интервал между проверками (в секундах), по
+            умолчанию - половина допустимой длительности транзакции.
+        :param int stack_limit: Максимальное количество сохраняемых кадров
+            стека вызовов.
+        """
+        self.threshold = threshold
+        self.callback = callback or self._log
+        self.interval = interval or threshold / 2.
+        self.stack_limit = stack_limit
+
+        self._lock = Lock()
+        self._transactions = {}
+        self._thread = None
+        self._stopped = None
+
+    @staticmethod
+    def _log(transaction):
+        _logger.warning(
+            'Transaction on %r in thread %s is open for %.3f s, '
+            'started at:\n%s',
+            transaction.using, transaction.thread, transaction.duration,
+            transaction.stack,
+        )
+
+    def __call__(self, event):
+        if not event.outermost:
+            return
+
+        key = (get_ident(), event.using)
+        if event.kind == TRANSACTION_START:
+            transaction = _OpenTransaction(
+                event.using, current_thread().name,
+                _capture_stack(self.stack_limit),
+            )
+            with self._lock:
+                self._transactions[key] = transaction
+        else:
+            with self._lock:
+                self._transactions.pop(key, None)
+
+    def check(self):
+        """Сообщает о транзакциях, выполняющихся дольше допустимого.
+
+        :returns: Количество транзакций, о которых было сообщено.
+        :rtype: int
+        """
+        now = default_timer()
+        with self._lock:
+            transactions = [
+                transaction
+                for transaction in self._transactions.values()
+                if not transaction.reported and
+                now - transaction.started >= self.threshold
+            ]
+            for transaction in transactions:
+                transaction.reported = True
+
+        for transaction in transactions:
+            try:
+                self.callback(LongTransaction(
+                    transaction.using,
+                    transaction.thread,
+                    now - transaction.started,
+                    _format_stack(transaction.frames),
+                ))
+            except Exception:  # pylint: disable=broad-except
+                _logger.exception(
+                    'Transaction watchdog callback %r failed.', self.callback
+                )
+
+        return len(transactions)
+
+    def _run(self, stopped):
+        while not stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        """Начинает отслеживание транзакций в фоновом потоке.
+
+        Транзакции, открытые до вызова метода, не отслеживаются.
+        """
+        assert self._thread is None, 'Watchdog is already started.'
+
+        add_transaction_listener(self)
+        self._stopped = Event()
+        self._thread = Thread(
+            target=self._run, args=(self._stopped,),
+            name='TransactionWatchdog',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Прекращает отслеживание транзакций."""
+        remove_transaction_listener(self)
+        if self._thread is not None:
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+        with self._lock:
+            self._transactions.clear()
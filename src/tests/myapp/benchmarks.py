@@ -0,0 +1,651 @@
+# coding: utf-8
+u"""Микробенчмарки средств обеспечения совместимости.
+
+Запуск: ``python manage.py benchmark [имя бенчмарка ...] [--number N]``.
+
+Каждый бенчмарк - генератор, возвращающий пары (описание замера, время в
+секундах в пересчете на один вызов).
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+from os import environ
+from os import pathsep
+from timeit import Timer
+import subprocess
+import sys
+
+from m3_django_compat import FieldDoesNotExist
+from m3_django_compat import ModelOptions
+from m3_django_compat import get_model
+
+
+#: Зарегистрированные бенчмарки.
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    u"""Регистрирует бенчмарк."""
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def measure(func, number):
+    u"""Возвращает время выполнения функции (в секундах, лучшее из трех)."""
+    return min(Timer(func).repeat(3, number)) / number
+
+
+def run_python(code, *options):
+    u"""Выполняет код в отдельном процессе интерпретатора.
+
+    Процессу передаются пути поиска модулей текущего процесса.
+
+    :returns: Вывод процесса в stdout и stderr.
+    :rtype: tuple
+    """
+    env = dict(environ)
+    env['PYTHONPATH'] = pathsep.join(path for path in sys.path if path)
+    process = subprocess.Popen(
+        (sys.executable,) + options + ('-c', code),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        env=env,
+    )
+    output, errors = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(errors.decode('utf-8'))
+
+    return output.decode('utf-8'), errors.decode('utf-8')
+
+
+@contextmanager
+def model_table(model, using='other'):
+    u"""Создает таблицу модели в БД, если она отсутствует.
+
+    По завершении созданная таблица удаляется, а из существовавшей ранее
+    удаляются все записи.
+
+    :returns: Менеджер модели, использующий указанную БД.
+    """
+    from django.db import connections
+
+    connection = connections[using]
+    table_exists = (
+        model._meta.db_table in connection.introspection.table_names()
+    )
+    if not table_exists:
+        with connection.schema_editor() as editor:
+            editor.create_model(model)
+
+    manager = model._default_manager.db_manager(using)
+    try:
+        yield manager
+    finally:
+        if table_exists:
+            manager.all().delete()
+        else:
+            with connection.schema_editor() as editor:
+                editor.delete_model(model)
+# -----------------------------------------------------------------------------
+
+
+@benchmark
+def model_options(number=100000):
+    u"""Получение ModelOptions для модели."""
+    model = get_model('myapp', 'Model1')
+
+    yield 'ModelOptions(model)', measure(
+        lambda: ModelOptions(model), number
+    )
+    yield 'ModelOptions.for_model(model)', measure(
+        lambda: ModelOptions.for_model(model), number
+    )
+
+
+@benchmark
+def model_options_get_field(number=100000):
+    u"""Поиск полей модели через ModelOptions."""
+    model = get_model('myapp', 'Model2')
+    opts = ModelOptions.for_model(model)
+
+    def get_missing_field():
+        try:
+            opts.get_field('missing')
+        except FieldDoesNotExist:
+            pass
+
+    def get_missing_field_native():
+        try:
+            model._meta.get_field('missing')
+        except FieldDoesNotExist:
+            pass
+
+    yield 'Model._meta.get_field (hit)', measure(
+        lambda: model._meta.get_field('fk_field'), number
+    )
+    yield 'get_field (hit)', measure(
+        lambda: opts.get_field('fk_field'), number
+    )
+    yield 'Model._meta.get_field (miss)', measure(
+        get_missing_field_native, number
+    )
+    yield 'get_field (miss)', measure(get_missing_field, number)
+    yield 'get_field_by_name (hit)', measure(
+        lambda: opts.get_field_by_name('fk_field'), number
+    )
+
+
+@benchmark
+def model_options_relations(number=100000):
+    u"""Получение связей модели через ModelOptions."""
+    opts = ModelOptions.for_model(get_model('myapp', 'Model1'))
+
+    yield 'get_all_related_objects', measure(
+        opts.get_all_related_objects, number
+    )
+    yield 'get_m2m_with_model', measure(opts.get_m2m_with_model, number)
+
+
+@benchmark
+def relation_graph(number=1000):
+    u"""Поиск моделей, транзитивно ссылающихся на модель."""
+    from django.contrib.contenttypes.models import ContentType
+    from m3_django_compat.relations import RelationGraph
+    from m3_django_compat.relations import get_relation_graph
+
+    def walk_meta(model):
+        result = set()
+        models = [model]
+        while models:
+            for related_object in ModelOptions(
+                models.pop()
+            ).get_all_related_objects():
+                related_model = related_object.field.model
+                if related_model not in result:
+                    result.add(related_model)
+                    models.append(related_model)
+        return result
+
+    graph = get_relation_graph()
+
+    yield u'Обход Model._meta', measure(
+        lambda: walk_meta(ContentType), number
+    )
+    yield u'RelationGraph (построение)', measure(
+        lambda: RelationGraph(graph.models), max(1, number // 100)
+    )
+    yield u'RelationGraph.get_referencing_models', measure(
+        lambda: graph.get_referencing_models(ContentType, transitive=True),
+        number
+    )
+    yield u'RelationGraph.get_cascade_paths', measure(
+        lambda: graph.get_cascade_paths(ContentType), number
+    )
+
+
+@benchmark
+def field_path(number=100000):
+    u"""Разбор пути к полю модели."""
+    from m3_django_compat import resolve_field_path
+
+    model = get_model('myapp', 'Model2')
+
+    def resolve_by_segments():
+        opts = ModelOptions(model)
+        field = opts.get_field('fk_field')
+        ModelOptions(field.related_model).get_field('simple_field')
+
+    yield u'ModelOptions.get_field по сегментам', measure(
+        resolve_by_segments, number
+    )
+    yield 'resolve_field_path', measure(
+        lambda: resolve_field_path(model, 'fk_field__simple_field'), number
+    )
+
+
+@benchmark
+def related_object(number=100000):
+    u"""Доступ к атрибутам RelatedObject."""
+    from m3_django_compat import get_related
+
+    class ProxyRelatedObject(object):
+
+        # Реализация RelatedObject с проксированием всех атрибутов через
+        # __getattr__ (использовалась до версии 1.11.0).
+
+        def __init__(self, relation):
+            self.relation = relation
+
+        def __getattr__(self, name):
+            return getattr(self.relation, name)
+
+        @property
+        def model_name(self):
+            return self.relation.related_model._meta.model_name
+
+        @property
+        def parent_model(self):
+            return self.relation.model
+
+    field = ModelOptions(get_model('myapp', 'Model2')).get_field('fk_field')
+    related = get_related(field)
+    proxy = ProxyRelatedObject(related.relation)
+
+    for name in ('model', 'related_model', 'model_name', 'parent_model'):
+        yield u'Прокси: {}'.format(name), measure(
+            lambda: getattr(proxy, name), number
+        )
+        yield u'RelatedObject: {}'.format(name), measure(
+            lambda: getattr(related, name), number
+        )
+    yield u'Прокси: создание объекта', measure(
+        lambda: ProxyRelatedObject(field.remote_field), number
+    )
+    yield u'RelatedObject: get_related', measure(
+        lambda: get_related(field), number
+    )
+
+
+@benchmark
+def model_loading(number=10000):
+    u"""Загрузка классов моделей по ссылкам 'app_label.ModelName'."""
+    from django.apps import apps
+    from m3_django_compat import get_models
+
+    references = [
+        '.'.join((model._meta.app_label, model.__name__))
+        for model in apps.get_models()
+    ]
+    pairs = [reference.split('.') for reference in references]
+
+    def get_native():
+        for app_label, model_name in pairs:
+            apps.get_model(app_label, model_name)
+
+    def get_compat():
+        for app_label, model_name in pairs:
+            get_model(app_label, model_name)
+
+    yield u'apps.get_model ({} моделей)'.format(len(pairs)), measure(
+        get_native, number
+    )
+    yield u'get_model ({} моделей)'.format(len(pairs)), measure(
+        get_compat, number
+    )
+    yield u'get_models ({} моделей)'.format(len(pairs)), measure(
+        lambda: get_models(references), number
+    )
+
+
+@benchmark
+def manager_queryset(number=100000):
+    u"""Получение выборки через методы менеджера модели."""
+    model = get_model('myapp', 'ModelWithCustomManager')
+    native = model.objects
+    old_manager = model.old_manager
+    new_manager = model.new_manager
+
+    yield 'Manager.get_queryset (Django)', measure(native.get_queryset, number)
+    yield 'OldManager.get_queryset', measure(
+        lambda: old_manager.get_queryset(), number
+    )
+    yield 'NewManager.get_query_set', measure(
+        lambda: new_manager.get_query_set(), number
+    )
+    yield 'NewManager.all', measure(new_manager.all, number)
+
+
+@benchmark
+def keyset_iteration(number=1000000):
+    u"""Обход таблицы (number - количество записей)."""
+    from collections import deque
+    from m3_django_compat import _VERSION
+    from m3_django_compat import iterate_chunks
+    from myapp.models import Model1
+
+    if _VERSION < (1, 7):
+        return
+
+    with model_table(Model1) as manager:
+        manager.bulk_create(
+            (Model1(simple_field=str(i % 1000)) for i in range(number)),
+            batch_size=300,
+        )
+        for title, func in (
+            ('QuerySet.iterator', lambda: manager.all().iterator()),
+            ('iterate_chunks', lambda: iterate_chunks(manager, 1000)),
+        ):
+            yield u'{} ({} записей)'.format(title, number), measure(
+                lambda: deque(func(), 0), 1
+            )
+
+
+@benchmark
+def bulk_upsert(number=100000):
+    u"""Загрузка справочника (number - количество записей)."""
+    from timeit import default_timer
+    from m3_django_compat import _VERSION
+    from m3_django_compat.queries import _bulk_upsert_fallback
+    from m3_django_compat.queries import bulk_upsert
+    from m3_django_compat.transaction import atomic
+    from myapp.models import ReferenceItem
+
+    if _VERSION < (1, 7):
+        return
+
+    get_field = ReferenceItem._meta.get_field
+
+    def fallback(manager, objs):
+        with atomic('other', savepoint=False):
+            _bulk_upsert_fallback(
+                manager.all(), objs, [get_field('code')], [get_field('name')],
+                None,
+            )
+
+    def update_or_create(manager, objs):
+        with atomic('other', savepoint=False):
+            for obj in objs:
+                manager.update_or_create(
+                    code=obj.code, defaults=dict(name=obj.name)
+                )
+
+    loop_number = min(number, 1000)
+    with model_table(ReferenceItem) as manager:
+        for title, count, func in (
+            (u'update_or_create в цикле', loop_number, update_or_create),
+            (u'выборка + bulk_create/bulk_update', number, fallback),
+            (
+                u'bulk_upsert',
+                number,
+                lambda manager, objs: bulk_upsert(
+                    manager, objs, ['code'], ['name']
+                ),
+            ),
+        ):
+            # Половина записей уже есть в таблице.
+            manager.all().delete()
+            manager.bulk_create(
+                (ReferenceItem(code=str(i), name='old')
+                 for i in range(0, count, 2)),
+                batch_size=300,
+            )
+            objs = [
+                ReferenceItem(code=str(i), name='new') for i in range(count)
+            ]
+            started = default_timer()
+            func(manager, objs)
+            yield u'{} ({} записей)'.format(title, count), (
+                default_timer() - started
+            )
+
+
+@benchmark
+def installed_apps(number=100000):
+    u"""Получение списка приложений и модели учетной записи."""
+    from django.contrib.auth import get_user_model as get_user_model_native
+    from m3_django_compat import get_installed_apps
+    from m3_django_compat import get_user_model
+
+    yield 'get_installed_apps', measure(get_installed_apps, number)
+    yield 'django.contrib.auth.get_user_model', measure(
+        get_user_model_native, number
+    )
+    yield 'get_user_model', measure(get_user_model, number)
+
+
+@benchmark
+def import_time(number=5):
+    u"""Время импорта модуля.
+
+    В Python 3.7+ время определяется по данным ``python -X importtime``, в
+    более старых версиях измеряется только время импорта m3_django_compat.
+    """
+    if sys.version_info < (3, 7):
+        durations = []
+        for _ in range(number):
+            output, _ = run_python(
+                'from timeit import default_timer; '
+                'start = default_timer(); '
+                'import m3_django_compat; '
+                'print(default_timer() - start)'
+            )
+            durations.append(float(output))
+        yield 'm3_django_compat', min(durations)
+        return
+
+    modules = ('django', 'django.db.models', 'm3_django_compat')
+    durations = dict((module, []) for module in modules)
+    for _ in range(number):
+        _, errors = run_python('import m3_django_compat', '-X', 'importtime')
+        # Строки вида "import time: <self> | <cumulative> | <module>".
+        for line in errors.splitlines():
+            _, cumulative, module = line.split('|')
+            module = module.strip()
+            if module in durations:
+                durations[module].append(int(cumulative))
+
+    for module in modules:
+        yield module, min(durations[module]) / 1000000.
+
+
+@benchmark
+def call_overhead(number=100000):
+    u"""Накладные расходы на вызов функций совместимости.
+
+    Сравнение с непосредственным обращением к API Django актуально только
+    для последних версий Django, где функции совместимости сводятся к
+    вызову соответствующего API.
+    """
+    from django.contrib.auth.models import AnonymousUser
+    from django.db import connection
+    from django.db import transaction
+    from django.test import RequestFactory
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+    from m3_django_compat import get_related
+    from m3_django_compat import get_request_params
+    from m3_django_compat import in_atomic_block
+    from m3_django_compat import is_authenticated
+
+    if _VERSION < (2, 0):
+        return
+
+    request = RequestFactory().get('/')
+    user = AnonymousUser()
+    model = get_model('myapp', 'Model2')
+    field = model._meta.get_field('fk_field')
+    options = ModelOptions.for_model(model)
+
+    for title, native, compat in (
+        (
+            'in_atomic_block',
+            lambda: connection.in_atomic_block,
+            in_atomic_block,
+        ),
+        (
+            'atomic',
+            transaction.atomic,
+            atomic,
+        ),
+        (
+            'get_request_params',
+            lambda: request.GET,
+            lambda: get_request_params(request),
+        ),
+        (
+            'is_authenticated',
+            lambda: user.is_authenticated,
+            lambda: is_authenticated(user),
+        ),
+        (
+            'get_related',
+            lambda: field.remote_field,
+            lambda: get_related(field),
+        ),
+        (
+            'ModelOptions.get_field',
+            lambda: model._meta.get_field('fk_field'),
+            lambda: options.get_field('fk_field'),
+        ),
+    ):
+        yield u'{} (Django)'.format(title), measure(native, number)
+        yield title, measure(compat, number)
+
+
+@benchmark
+def atomic_overhead(number=100000):
+    u"""Накладные расходы на вложенный блок atomic без точки сохранения."""
+    from django.db import transaction
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+    from m3_django_compat.transaction import TransactionStatistics
+    from m3_django_compat.transaction import add_transaction_listener
+    from m3_django_compat.transaction import remove_transaction_listener
+
+    if _VERSION < (1, 6):
+        return
+
+    def native():
+        with transaction.atomic(savepoint=False):
+            pass
+
+    def compat():
+        with atomic(savepoint=False):
+            pass
+
+    with transaction.atomic():
+        yield 'django.db.transaction.atomic', measure(native, number)
+        yield 'atomic', measure(compat, number)
+
+        statistics = TransactionStatistics()
+        add_transaction_listener(statistics)
+        try:
+            yield u'atomic (со сбором статистики)', measure(compat, number)
+        finally:
+            remove_transaction_listener(statistics)
+
+
+@benchmark
+def atomic_many_overhead(number=10000):
+    u"""Блок atomic для двух баз данных."""
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+    from m3_django_compat import atomic_many
+
+    if _VERSION < (1, 6):
+        return
+
+    def nested():
+        with atomic(using='default'):
+            with atomic(using='other'):
+                pass
+
+    def many():
+        with atomic_many(['default', 'other']):
+            pass
+
+    yield u'Вложенные блоки atomic', measure(nested, number)
+    yield 'atomic_many', measure(many, number)
+
+
+@benchmark
+def transaction_watchdog(number=10000):
+    u"""Накладные расходы на контроль длительности транзакций."""
+    from django.db import connection
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+    from m3_django_compat.transaction import TransactionWatchdog
+
+    if _VERSION < (1, 6):
+        return
+
+    def run():
+        with atomic():
+            pass
+
+    def run_queries():
+        with atomic():
+            with connection.cursor() as cursor:
+                for _ in range(10):
+                    cursor.execute('SELECT 1')
+
+    yield 'atomic', measure(run, number)
+    yield u'atomic (10 запросов)', measure(run_queries, number)
+
+    watchdog = TransactionWatchdog(threshold=60)
+    watchdog.start()
+    try:
+        yield u'atomic (с контролем длительности)', measure(run, number)
+        yield u'atomic (10 запросов, с контролем длительности)', measure(
+            run_queries, number
+        )
+    finally:
+        watchdog.stop()
+
+
+@benchmark
+def lazy_savepoints(number=1000):
+    u"""Вложенные блоки atomic, выполняющие только чтение данных."""
+    from django.db import connection
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+
+    if _VERSION < (2, 0):
+        return
+
+    class QueryCounter(object):
+
+        def __init__(self):
+            self.count = 0
+
+        def __call__(self, execute, sql, params, many, context):
+            self.count += 1
+            return execute(sql, params, many, context)
+
+    def read():
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+
+    for savepoint in (True, 'lazy'):
+        def run():
+            with atomic(savepoint=savepoint):
+                read()
+
+        counter = QueryCounter()
+        with atomic():
+            with connection.execute_wrapper(counter):
+                run()
+            duration = measure(run, number)
+
+        yield u'savepoint={!r} (запросов к БД на блок: {})'.format(
+            savepoint, counter.count
+        ), duration
+
+
+@benchmark
+def on_commit_batching(number=10000):
+    u"""Регистрация функций, вызываемых после подтверждения транзакции."""
+    from django.db import transaction
+    from m3_django_compat import _VERSION
+    from m3_django_compat import atomic
+    from m3_django_compat import on_commit
+
+    if _VERSION < (1, 9):
+        return
+
+    calls = []
+
+    def invalidate():
+        calls.append(None)
+
+    with atomic():
+        duration = measure(lambda: transaction.on_commit(invalidate), number)
+    yield u'django.db.transaction.on_commit (вызовов: {})'.format(
+        len(calls)
+    ), duration
+
+    del calls[:]
+    with atomic():
+        duration = measure(
+            lambda: on_commit(invalidate, key='invalidate'), number
+        )
+    yield u'on_commit с ключом (вызовов: {})'.format(len(calls)), duration
@@ -0,0 +1,31 @@
+# coding: utf-8
+from m3_django_compat import BaseCommand
+
+from ...benchmarks import BENCHMARKS
+
+
+class Command(BaseCommand):
+
+    u"""Management-команда для запуска бенчмарков."""
+
+    help = u'Запуск бенчмарков m3_django_compat.'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument(
+            '--number', action='store', dest='number', type=int,
+            default=None, help=u'Количество повторений (объем данных).',
+        )
+
+    def handle(self, *args, **options):
+        names = args or tuple(BENCHMARKS)
+        kwargs = {}
+        if options.get('number'):
+            kwargs['number'] = options['number']
+
+        for name in names:
+            for title, duration in BENCHMARKS[name](**kwargs):
+                self.stdout.write(u'{}: {} - {:.3f} мкс\n'.format(
+                    name, title, duration * 1000000
+                ))
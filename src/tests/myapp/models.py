@@ -3,6 +3,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.db import models
 
 from m3_django_compat import Manager
+from m3_django_compat.managers import CachedManager
 from m3_django_compat.models import GenericForeignKey
 
 
@@ -30,6 +31,11 @@ class NewManager(Manager):
         return self.get_queryset().filter(number__lt=0)
 
 
+class IdentityMapManager(Manager):
+
+    use_identity_map = True
+
+
 class ModelWithCustomManager(models.Model):
 
     u"""Модель с переопределенным менеджером, поддерживающим совместимость."""
@@ -45,6 +51,9 @@ class Model1(models.Model):
 
     simple_field = models.CharField(u'Field 1', max_length=10)
 
+    objects = models.Manager()
+    cached_objects = CachedManager()
+
 
 class Model2(models.Model):
 
@@ -60,3 +69,64 @@ class Model3(models.Model):
 
     simple_field = models.CharField(u'Field 1', max_length=10)
     m2m_field = models.ManyToManyField(Model1)
+
+
+class ReferenceItem(models.Model):
+
+    u"""Элемент справочника."""
+
+    code = models.CharField(u'Код', max_length=10, unique=True)
+    name = models.CharField(u'Наименование', max_length=50)
+    version = models.IntegerField(default=0)
+
+    objects = Manager()
+    identity_objects = IdentityMapManager()
+
+
+class ReferenceItemProxy(ReferenceItem):
+
+    u"""Прокси-модель элемента справочника."""
+
+    class Meta:
+        proxy = True
+
+
+class ReferenceGroup(models.Model):
+
+    u"""Группа элементов справочника."""
+
+    name = models.CharField(u'Наименование', max_length=50)
+
+
+class ReferenceGroupItem(models.Model):
+
+    u"""Элемент группы справочника."""
+
+    group = models.ForeignKey(ReferenceGroup, on_delete=models.CASCADE)
+
+    objects = IdentityMapManager()
+
+
+class CachedItem(models.Model):
+
+    u"""Модель с кэшированием результатов запросов."""
+
+    name = models.CharField(u'Наименование', max_length=50)
+
+    objects = models.Manager()
+    cached_objects = CachedManager()
+
+
+class CachedItemProxy(CachedItem):
+
+    u"""Прокси-модель модели с кэшированием результатов запросов."""
+
+    class Meta:
+        proxy = True
+
+
+class CachedItemChild(CachedItem):
+
+    u"""Дочерняя модель модели с кэшированием результатов запросов."""
+
+    code = models.CharField(u'Код', max_length=10)
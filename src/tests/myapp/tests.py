@@ -2,20 +2,26 @@
 from warnings import catch_warnings
 import atexit
 import json
+import logging
 import subprocess
 import sys
+import time
 
 from django.contrib.auth import get_user
 from django.contrib.auth.models import AnonymousUser
 from django.core.management import call_command
 from django.core.management import load_command_class
+from django.db import connections
 from django.db import models
 from django.db.models.fields import FieldDoesNotExist
 from django.db.models.query import QuerySet
 from django.db.utils import DEFAULT_DB_ALIAS
+from django.db.utils import OperationalError
 from django.test import Client
 from django.test import SimpleTestCase
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
 from six import print_
 
 from m3_django_compat import _VERSION
@@ -25,13 +31,53 @@ from m3_django_compat import DatabaseRouterBase
 from m3_django_compat import ModelOptions
 from m3_django_compat import RelatedObject
 from m3_django_compat import atomic
+from m3_django_compat import bulk_update
+from m3_django_compat import bulk_upsert
+from m3_django_compat import atomic_many
+from m3_django_compat import atomic_retry
 from m3_django_compat import get_model
+from m3_django_compat import get_models
 from m3_django_compat import get_related
 from m3_django_compat import get_user_model
 from m3_django_compat import in_atomic_block
+from m3_django_compat import in_bulk_chunked
+from m3_django_compat import iterate_chunks
+from m3_django_compat import on_commit
+from m3_django_compat import prefetch_related_chunked
+from m3_django_compat import resolve_field_path
+from m3_django_compat import transaction_cached
+from m3_django_compat.identity import get_identity_map
+from m3_django_compat.identity import identity_map
+from m3_django_compat.managers import DjangoCacheBackend
+from m3_django_compat.managers import LocMemBackend
+from m3_django_compat.routers import LeastRecentlyFailedStrategy
+from m3_django_compat.routers import ReplicaRouterBase
+from m3_django_compat.routers import ReplicaStrategy
+from m3_django_compat.routers import RoundRobinStrategy
+from m3_django_compat.routers import WeightedStrategy
+from m3_django_compat.routers import is_pinned_to_primary
+from m3_django_compat.routers import pin_to_primary
+from m3_django_compat.routers import pop_sticky_scope
+from m3_django_compat.routers import push_sticky_scope
+from m3_django_compat.routers import sticky_scope
+from m3_django_compat.routers import use_primary
+from m3_django_compat.transaction import AtomicManyError
+from m3_django_compat.transaction import TRANSACTION_COMMIT
+from m3_django_compat.transaction import TRANSACTION_ROLLBACK
+from m3_django_compat.transaction import TRANSACTION_START
+from m3_django_compat.transaction import TransactionStatistics
+from m3_django_compat.transaction import TransactionWatchdog
+from m3_django_compat.transaction import add_transaction_listener
+from m3_django_compat.transaction import clear_transaction_cache
+from m3_django_compat.transaction import get_retry_counters
+from m3_django_compat.transaction import is_retryable_error
+from m3_django_compat.transaction import remove_transaction_listener
+from m3_django_compat.transaction import reset_retry_counters
 from six.moves import StringIO
 from six.moves import range
 
+from myapp.benchmarks import run_python
+
 
 # -----------------------------------------------------------------------------
 # Проверка работы с моделью учетной записи
@@ -41,6 +87,65 @@ class CustomUserModelTestCase(TestCase):
         u"""Проверка функции get_user_model."""
         user_model = get_model(*AUTH_USER_MODEL.split('.'))
         self.assertIs(user_model, get_user_model())
+
+    def test_settings_changes(self):
+        u"""Проверка сброса кэшей при изменении настроек."""
+        from django.test.utils import override_settings
+        from m3_django_compat import get_installed_apps
+        import m3_django_compat
+
+        installed_apps = get_installed_apps()
+        self.assertIsInstance(installed_apps, tuple)
+        self.assertIn('django.contrib.auth', installed_apps)
+        self.assertIs(installed_apps, get_installed_apps())
+
+        apps_without_auth = [
+            app_name
+            for app_name in installed_apps
+            if app_name not in ('django.contrib.auth', 'user')
+        ]
+        with override_settings(INSTALLED_APPS=apps_without_auth):
+            self.assertNotIn('django.contrib.auth', get_installed_apps())
+            self.assertIsNone(get_user_model())
+            self.assertIsNone(m3_django_compat.AUTH_USER_MODEL)
+
+        self.assertEqual(installed_apps, get_installed_apps())
+        self.assertIs(get_user_model(), get_model(*AUTH_USER_MODEL.split('.')))
+        self.assertEqual(m3_django_compat.AUTH_USER_MODEL, AUTH_USER_MODEL)
+# -----------------------------------------------------------------------------
+# Проверка загрузки моделей
+
+
+class GetModelTestCase(SimpleTestCase):
+
+    def test_get_model(self):
+        u"""Проверка функций get_model и get_models."""
+        from django.contrib.contenttypes.models import ContentType
+        from myapp.models import Model1
+        from myapp.models import Model2
+
+        self.assertIs(get_model('myapp', 'Model1'), Model1)
+        self.assertIs(get_model('myapp', 'model1'), Model1)
+        self.assertIs(get_model('myapp', 'MODEL1'), Model1)
+
+        self.assertEqual(
+            get_models([
+                'myapp.Model2', 'contenttypes.ContentType', 'myapp.model1',
+            ]),
+            [Model2, ContentType, Model1],
+        )
+
+        with self.assertRaises(ValueError):
+            get_models(['myapp'])
+
+        if _VERSION <= (1, 6):
+            self.assertIsNone(get_model('myapp', 'Missing'))
+            self.assertEqual(get_models(['myapp.Missing']), [None])
+        else:
+            with self.assertRaises(LookupError):
+                get_model('myapp', 'Missing')
+            with self.assertRaises(LookupError):
+                get_models(['myapp.Missing'])
 # -----------------------------------------------------------------------------
 # Проверка работы с транзакциями
 
@@ -127,6 +232,627 @@ class AtomicTestCase(SimpleTestCase):
         self.assertFalse(self._is_user_exist('user5'))
         self.assertFalse(self._is_user_exist('user6'))
         self.assertFalse(in_atomic_block())
+
+
+class TransactionListenerTestCase(SimpleTestCase):
+
+    u"""Проверка уведомления слушателей о блоках atomic."""
+
+    allow_database_queries = True
+
+    def setUp(self):
+        self.events = []
+        add_transaction_listener(self.events.append)
+        self.statistics = TransactionStatistics()
+        add_transaction_listener(self.statistics)
+
+    def tearDown(self):
+        remove_transaction_listener(self.events.append)
+        remove_transaction_listener(self.statistics)
+        get_user_model().objects.all().delete()
+
+    def _failing_listener(self, event):
+        raise ValueError(event)
+
+    def test_events(self):
+        with atomic():
+            get_user_model().objects.create(username='user1')
+            with self.assertRaises(ValueError):
+                with atomic():
+                    get_user_model().objects.create(username='user2')
+                    raise ValueError()
+            with atomic(savepoint=False):
+                pass
+
+        self.assertEqual(
+            [(event.kind, event.depth) for event in self.events],
+            [
+                (TRANSACTION_START, 0),
+                (TRANSACTION_START, 1),
+                (TRANSACTION_ROLLBACK, 1),
+                (TRANSACTION_START, 1),
+                (TRANSACTION_COMMIT, 1),
+                (TRANSACTION_COMMIT, 0),
+            ]
+        )
+        self.assertEqual(
+            [event.savepoint for event in self.events],
+            [False, True, True, False, False, False]
+        )
+        self.assertTrue(all(
+            event.using == DEFAULT_DB_ALIAS for event in self.events
+        ))
+        self.assertTrue(all(
+            event.duration >= 0 for event in self.events
+            if event.kind != TRANSACTION_START
+        ))
+        if _VERSION >= (2, 0):
+            # SAVEPOINT, INSERT, ROLLBACK TO SAVEPOINT и RELEASE SAVEPOINT.
+            self.assertEqual(self.events[2].queries, 4)
+            self.assertEqual(self.events[4].queries, 0)
+            self.assertGreaterEqual(self.events[-1].queries, 5)
+
+        statistics = self.statistics.get_statistics()[DEFAULT_DB_ALIAS]
+        self.assertEqual(statistics['transactions'], 1)
+        self.assertEqual(statistics['blocks'], 3)
+        self.assertEqual(statistics['rollbacks'], 1)
+        self.assertEqual(statistics['savepoints'], 1)
+        self.assertEqual(statistics['max_depth'], 1)
+        self.assertEqual(
+            sum(count for _, count in statistics['histogram']), 1
+        )
+        self.assertIsNone(statistics['histogram'][-1][0])
+
+        self.statistics.reset()
+        self.assertEqual(self.statistics.get_statistics(), {})
+
+    def test_native_atomic(self):
+        u"""Блоки внутри штатного atomic не считаются транзакциями."""
+        from django.db import transaction
+
+        with transaction.atomic():
+            with atomic():
+                get_user_model().objects.create(username='user1')
+            with atomic():
+                get_user_model().objects.create(username='user2')
+        with atomic():
+            get_user_model().objects.create(username='user3')
+
+        self.assertEqual(
+            [event.outermost for event in self.events],
+            [False, False, False, False, True, True]
+        )
+        statistics = self.statistics.get_statistics()[DEFAULT_DB_ALIAS]
+        self.assertEqual(statistics['blocks'], 3)
+        self.assertEqual(statistics['transactions'], 1)
+        self.assertEqual(
+            sum(count for _, count in statistics['histogram']), 1
+        )
+
+    def test_failing_listener(self):
+        logger = logging.getLogger('m3_django_compat.transaction')
+        logger.disabled = True
+        add_transaction_listener(self._failing_listener)
+        try:
+            with atomic():
+                get_user_model().objects.create(username='user1')
+        finally:
+            remove_transaction_listener(self._failing_listener)
+            logger.disabled = False
+
+        self.assertTrue(
+            get_user_model().objects.filter(username='user1').exists()
+        )
+        self.assertEqual(len(self.events), 2)
+
+
+class LazySavepointTestCase(SimpleTestCase):
+
+    u"""Проверка отложенного создания точек сохранения."""
+
+    allow_database_queries = True
+
+    def tearDown(self):
+        get_user_model().objects.all().delete()
+
+    def _get_savepoint_queries(self, context):
+        return [
+            query['sql'].split()[0].upper()
+            for query in context.captured_queries
+            if query['sql'].split()[0].upper() in (
+                'SAVEPOINT', 'RELEASE', 'ROLLBACK'
+            )
+        ]
+
+    def test_lazy_savepoint(self):
+        if _VERSION < (2, 0):
+            return
+
+        user_model = get_user_model()
+        connection = connections[DEFAULT_DB_ALIAS]
+        execute_wrappers = list(connection.execute_wrappers)
+
+        with atomic():
+            # Блок без изменения данных.
+            with CaptureQueriesContext(connection) as context:
+                with atomic(savepoint='lazy'):
+                    user_model.objects.filter(username='user1').exists()
+            self.assertEqual(self._get_savepoint_queries(context), [])
+
+            # Исключение в блоке без изменения данных не приводит к откату
+            # внешней транзакции.
+            with self.assertRaises(ValueError):
+                with atomic(savepoint='lazy'):
+                    user_model.objects.filter(username='user1').exists()
+                    raise ValueError()
+            self.assertFalse(connection.needs_rollback)
+
+            # Точка сохранения создается перед изменением данных, а
+            # вложенные блоки с отложенными точками сохранения создают свои
+            # точки сохранения в порядке вложенности.
+            with CaptureQueriesContext(connection) as context:
+                with self.assertRaises(ValueError):
+                    with atomic(savepoint='lazy'):
+                        with atomic(savepoint='lazy'):
+                            user_model.objects.create(username='user2')
+                        raise ValueError()
+            self.assertEqual(
+                self._get_savepoint_queries(context),
+                ['SAVEPOINT', 'SAVEPOINT', 'RELEASE', 'ROLLBACK', 'RELEASE']
+            )
+
+            with atomic(savepoint='lazy'):
+                user_model.objects.create(username='user3')
+
+        self.assertFalse(user_model.objects.filter(username='user2').exists())
+        self.assertTrue(user_model.objects.filter(username='user3').exists())
+        self.assertEqual(connection.execute_wrappers, execute_wrappers)
+
+    def test_lazy_savepoint_on_commit(self):
+        if _VERSION < (2, 0):
+            return
+
+        user_model = get_user_model()
+        calls = []
+
+        with atomic():
+            # Функции, зарегистрированные до создания точки сохранения, не
+            # вызываются при ее откате.
+            with self.assertRaises(ValueError):
+                with atomic(savepoint='lazy'):
+                    on_commit(lambda: calls.append('rolled back'))
+                    user_model.objects.create(username='user1')
+                    raise ValueError()
+
+            with atomic(savepoint='lazy'):
+                on_commit(lambda: calls.append('committed'))
+                user_model.objects.create(username='user2')
+
+        self.assertFalse(user_model.objects.filter(username='user1').exists())
+        self.assertEqual(calls, ['committed'])
+
+
+class OnCommitTestCase(SimpleTestCase):
+
+    u"""Проверка регистрации функций, вызываемых после подтверждения."""
+
+    allow_database_queries = True
+
+    def setUp(self):
+        self.calls = []
+
+    def _callback(self, name):
+        return lambda: self.calls.append(name)
+
+    def test_on_commit(self):
+        # Вне транзакции функция вызывается сразу.
+        on_commit(self._callback('immediate'), key='immediate')
+        self.assertEqual(self.calls, ['immediate'])
+        del self.calls[:]
+
+        with atomic():
+            for _ in range(1000):
+                on_commit(self._callback('key1'), key='key1')
+            on_commit(self._callback('key2'), key='key2')
+            on_commit(self._callback('nokey'))
+            on_commit(self._callback('nokey'))
+
+            with atomic():
+                on_commit(self._callback('key1'), key='key1')
+                on_commit(self._callback('key3'), key='key3')
+
+            # Функции, зарегистрированные в откаченном блоке, не вызываются,
+            # а их ключи могут быть зарегистрированы повторно.
+            with self.assertRaises(ValueError):
+                with atomic():
+                    on_commit(self._callback('key4'), key='key4')
+                    raise ValueError()
+            on_commit(self._callback('key4'), key='key4')
+
+            self.assertEqual(self.calls, [])
+
+        self.assertEqual(
+            self.calls, ['key1', 'key2', 'nokey', 'nokey', 'key3', 'key4']
+        )
+
+    def test_on_commit_rollback(self):
+        with self.assertRaises(ValueError):
+            with atomic():
+                on_commit(self._callback('key1'), key='key1')
+                raise ValueError()
+        self.assertEqual(self.calls, [])
+
+        # Ключи откаченной транзакции не влияют на следующую.
+        with atomic():
+            on_commit(self._callback('key1'), key='key1')
+        self.assertEqual(self.calls, ['key1'])
+
+
+class TransactionWatchdogTestCase(SimpleTestCase):
+
+    u"""Проверка контроля длительности транзакций."""
+
+    allow_database_queries = True
+
+    def setUp(self):
+        self.transactions = []
+
+    def test_check(self):
+        watchdog = TransactionWatchdog(0, self.transactions.append)
+        add_transaction_listener(watchdog)
+        try:
+            self.assertEqual(watchdog.check(), 0)
+            with atomic():
+                with atomic():
+                    self.assertEqual(watchdog.check(), 1)
+                # О транзакции сообщается однократно.
+                self.assertEqual(watchdog.check(), 0)
+            with atomic():
+                pass
+            self.assertEqual(watchdog.check(), 0)
+        finally:
+            remove_transaction_listener(watchdog)
+
+        transaction, = self.transactions
+        self.assertEqual(transaction.using, DEFAULT_DB_ALIAS)
+        self.assertGreaterEqual(transaction.duration, 0)
+        # Стек вызовов указывает на место открытия транзакции.
+        self.assertIn('test_check', transaction.stack.splitlines()[-2])
+        self.assertNotIn('transaction.py', transaction.stack)
+
+    def test_nested_in_native_transaction(self):
+        if _VERSION < (1, 6):
+            return
+        from django.db import transaction
+
+        connection = connections[DEFAULT_DB_ALIAS]
+        execute_wrappers = list(getattr(connection, 'execute_wrappers', ()))
+        watchdog = TransactionWatchdog(0, self.transactions.append)
+        add_transaction_listener(watchdog)
+        try:
+            with transaction.atomic():
+                with atomic():
+                    # Блок внутри транзакции не считается транзакцией, а
+                    # запросы в нем не подсчитываются.
+                    self.assertEqual(watchdog.check(), 0)
+                    self.assertEqual(
+                        list(getattr(connection, 'execute_wrappers', ())),
+                        execute_wrappers,
+                    )
+            with atomic():
+                self.assertEqual(
+                    list(getattr(connection, 'execute_wrappers', ())),
+                    execute_wrappers,
+                )
+                self.assertEqual(watchdog.check(), 1)
+        finally:
+            remove_transaction_listener(watchdog)
+
+    def test_thread(self):
+        watchdog = TransactionWatchdog(
+            0.01, self.transactions.append, interval=0.01
+        )
+        watchdog.start()
+        try:
+            with atomic():
+                for _ in range(100):
+                    if self.transactions:
+                        break
+                    time.sleep(0.01)
+        finally:
+            watchdog.stop()
+
+        self.assertEqual(len(self.transactions), 1)
+
+
+class AtomicManyTestCase(SimpleTestCase):
+
+    u"""Проверка блоков atomic для нескольких баз данных."""
+
+    allow_database_queries = True
+    databases = '__all__'
+
+    def setUp(self):
+        self.events = []
+        add_transaction_listener(self.events.append)
+
+    def tearDown(self):
+        remove_transaction_listener(self.events.append)
+
+    def _get_events(self):
+        return [(event.kind, event.using) for event in self.events]
+
+    def test_atomic_many(self):
+        @atomic_many(['other', None, 'other'])
+        def func():
+            self.assertTrue(in_atomic_block('default'))
+            self.assertTrue(in_atomic_block('other'))
+
+        func()
+        self.assertEqual(self._get_events(), [
+            (TRANSACTION_START, 'default'),
+            (TRANSACTION_START, 'other'),
+            (TRANSACTION_COMMIT, 'default'),
+            (TRANSACTION_COMMIT, 'other'),
+        ])
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with atomic_many(['default', 'other']):
+                raise ValueError()
+
+        self.assertEqual(self._get_events()[2:], [
+            (TRANSACTION_ROLLBACK, 'other'),
+            (TRANSACTION_ROLLBACK, 'default'),
+        ])
+        self.assertFalse(in_atomic_block('default'))
+        self.assertFalse(in_atomic_block('other'))
+
+    def test_commit_error(self):
+        if _VERSION < (2, 0):
+            # Отложенная проверка внешних ключей в SQLite.
+            return
+        from myapp.models import Model1
+        from myapp.models import Model2
+
+        with self.assertRaises(AtomicManyError) as context:
+            with atomic_many(['default', 'other']):
+                Model1.objects.create(simple_field='value')
+                Model2.objects.using('other').create(
+                    simple_field='value', fk_field_id=-1,
+                    content_type_id=-1, object_id=1,
+                )
+
+        error = context.exception
+        self.assertEqual(error.using, 'other')
+        self.assertEqual(error.committed, ('default',))
+        self.assertFalse(in_atomic_block('other'))
+        self.assertEqual(
+            Model1.objects.filter(simple_field='value').delete()[0], 1
+        )
+        self.assertFalse(Model2.objects.using('other').exists())
+
+    def test_on_commit_error(self):
+        from myapp.models import Model1
+
+        calls = []
+
+        def failing_callback():
+            # Функции вызываются после подтверждения во всех базах данных.
+            calls.append(in_atomic_block('other'))
+            raise ValueError()
+
+        try:
+            with self.assertRaises(ValueError):
+                with atomic_many(['default', 'other']):
+                    Model1.objects.create(simple_field='value')
+                    Model1.objects.using('other').create(
+                        simple_field='value'
+                    )
+                    on_commit(failing_callback, 'default')
+
+            self.assertEqual(calls, [False])
+            self.assertEqual(Model1.objects.count(), 1)
+            self.assertEqual(Model1.objects.using('other').count(), 1)
+        finally:
+            Model1.objects.all().delete()
+            Model1.objects.using('other').all().delete()
+
+
+class InBulkThreadsTestCase(SimpleTestCase):
+
+    u"""Проверка параллельной загрузки объектов в нескольких потоках."""
+
+    allow_database_queries = True
+
+    def test_in_bulk_chunked(self):
+        from threading import current_thread
+        from m3_django_compat import queries as queries_module
+
+        model = get_model('myapp', 'ModelWithCustomManager')
+        objs = [model.objects.create(number=i) for i in range(10)]
+        try:
+            with CaptureQueriesContext(
+                connections[DEFAULT_DB_ALIAS]
+            ) as queries:
+                result = in_bulk_chunked(
+                    model.objects, [obj.pk for obj in objs], chunk_size=2,
+                    threads=3,
+                )
+            # Запросы выполнены в других потоках.
+            self.assertEqual(len(queries), 0)
+            self.assertEqual(result, dict((obj.pk, obj) for obj in objs))
+
+            # Потоков не больше, чем частей.
+            threads = []
+            load_chunks = queries_module._load_chunks_in_thread
+
+            def load_chunks_in_thread(*args):
+                threads.append(current_thread())
+                load_chunks(*args)
+
+            queries_module._load_chunks_in_thread = load_chunks_in_thread
+            try:
+                result = in_bulk_chunked(
+                    model.objects, [obj.pk for obj in objs], chunk_size=5,
+                    threads=10,
+                )
+            finally:
+                queries_module._load_chunks_in_thread = load_chunks
+            self.assertEqual(len(threads), 2)
+            self.assertEqual(result, dict((obj.pk, obj) for obj in objs))
+        finally:
+            model.objects.all().delete()
+
+
+class AtomicRetryTestCase(SimpleTestCase):
+
+    u"""Проверка повторного выполнения транзакций."""
+
+    allow_database_queries = True
+
+    def setUp(self):
+        reset_retry_counters()
+        self.calls = 0
+
+    def tearDown(self):
+        reset_retry_counters()
+
+    def _fail(self, failures, error=None):
+        self.calls += 1
+        self.assertTrue(in_atomic_block())
+        if self.calls <= failures:
+            raise error or OperationalError('database is locked')
+        return self.calls
+
+    def test_is_retryable_error(self):
+        self.assertTrue(
+            is_retryable_error(OperationalError('database is locked'))
+        )
+        self.assertTrue(is_retryable_error(OperationalError(1213, 'Deadlock')))
+        self.assertFalse(is_retryable_error(OperationalError('no such table')))
+        self.assertFalse(is_retryable_error(ValueError('database is locked')))
+
+    def test_decorator(self):
+        @atomic_retry(attempts=3, backoff=0)
+        def func():
+            return self._fail(2)
+
+        self.assertEqual(func(), 3)
+        self.assertEqual(
+            get_retry_counters(),
+            {DEFAULT_DB_ALIAS: dict(retries=2, recovered=1, exhausted=0)},
+        )
+
+    def test_iterator(self):
+        delays = []
+
+        def backoff(attempt):
+            delays.append(attempt)
+            return 0
+
+        for attempt in atomic_retry(attempts=3, backoff=backoff):
+            with attempt:
+                self._fail(1)
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(delays, [1])
+
+    def test_exhausted(self):
+        @atomic_retry(attempts=2, backoff=0)
+        def func():
+            return self._fail(5)
+
+        with self.assertRaises(OperationalError):
+            func()
+        self.assertEqual(self.calls, 2)
+        self.assertEqual(
+            get_retry_counters(),
+            {DEFAULT_DB_ALIAS: dict(retries=1, recovered=0, exhausted=1)},
+        )
+
+    def test_not_retryable(self):
+        @atomic_retry(attempts=3, backoff=0)
+        def func():
+            return self._fail(5, ValueError())
+
+        with self.assertRaises(ValueError):
+            func()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(get_retry_counters(), {})
+
+    def test_nested(self):
+        # Внутри открытой транзакции блок не повторяется.
+        @atomic_retry
+        def func():
+            return self._fail(1)
+
+        with self.assertRaises(OperationalError):
+            with atomic():
+                func()
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(get_retry_counters(), {})
+
+
+class TransactionCachedTestCase(SimpleTestCase):
+
+    u"""Проверка кэширования результатов в пределах транзакции."""
+
+    allow_database_queries = True
+
+    def setUp(self):
+        self.calls = []
+
+        @transaction_cached
+        def func(*args, **kwargs):
+            self.calls.append((args, kwargs))
+            return len(self.calls)
+
+        self.func = func
+
+    def test_outside_transaction(self):
+        self.assertEqual(self.func(1), 1)
+        self.assertEqual(self.func(1), 2)
+
+    def test_transaction(self):
+        with atomic():
+            self.assertEqual(self.func(1), 1)
+            self.assertEqual(self.func(1), 1)
+            self.assertEqual(self.func(1, a=1), 2)
+            self.assertEqual(self.func(1, a=1), 2)
+            # Аргументы, не поддерживающие хэширование, не кэшируются.
+            self.assertEqual(self.func([1]), 3)
+            self.assertEqual(self.func([1]), 4)
+
+            with atomic():
+                self.assertEqual(self.func(1), 1)
+                self.assertEqual(self.func(2), 5)
+            # Подтверждение точки сохранения не сбрасывает кэш.
+            self.assertEqual(self.func(2), 5)
+
+            clear_transaction_cache()
+            self.assertEqual(self.func(1), 6)
+
+        # Кэш не переносится в следующую транзакцию.
+        with atomic():
+            self.assertEqual(self.func(1), 7)
+
+    def test_rollback(self):
+        with atomic():
+            self.assertEqual(self.func(1), 1)
+            with self.assertRaises(ValueError):
+                with atomic():
+                    self.assertEqual(self.func(1), 1)
+                    raise ValueError()
+            self.assertEqual(self.func(1), 2)
+
+        with self.assertRaises(ValueError):
+            with atomic():
+                self.assertEqual(self.func(1), 3)
+                raise ValueError()
+
+        with atomic():
+            self.assertEqual(self.func(1), 4)
 # -----------------------------------------------------------------------------
 # Проверка обеспечения совместимости менеджеров моделей
 
@@ -166,6 +892,629 @@ class ManagerTestCase(TestCase):
             self.assertTrue(
                 all(obj.number < 0 for obj in model.new_manager.negative())
             )
+
+    def test_renamed_methods(self):
+        u"""Проверка связи прежних и новых имен методов менеджера."""
+        from myapp.models import NewManager
+        from myapp.models import OldManager
+        from m3_django_compat import Manager
+
+        for manager_class in (Manager, OldManager, NewManager):
+            self.assertEqual(
+                manager_class.__dict__['get_queryset'],
+                manager_class.__dict__['get_query_set'],
+            )
+
+        class PositiveManager(Manager):
+
+            def get_query_set(self):
+                return super(PositiveManager, self).get_query_set().filter(
+                    number__gt=0
+                )
+
+        model = get_model('myapp', 'ModelWithCustomManager')
+        for i in range(-5, 6):
+            model.objects.create(number=i)
+
+        manager = PositiveManager()
+        manager.model = model
+        # Метод, переопределенный под прежним именем, используется
+        # методами менеджера Django.
+        self.assertEqual(manager.count(), 5)
+        self.assertEqual(manager.get_queryset().count(), 5)
+
+    def test_iterate_chunks(self):
+        u"""Проверка постраничной обработки записей."""
+        model = get_model('myapp', 'ModelWithCustomManager')
+        for i in range(9):
+            model.objects.create(number=i)
+        pks = list(model.objects.order_by('pk').values_list('pk', flat=True))
+
+        # 3 полных части и пустая.
+        with self.assertNumQueries(4):
+            self.assertEqual(
+                [obj.pk for obj in model.new_manager.iterate_chunks(3)],
+                pks,
+            )
+
+        with self.assertNumQueries(3):
+            self.assertEqual(
+                [
+                    obj.number
+                    for obj in model.old_manager.iterate_chunks(
+                        4, order_by='-number'
+                    )
+                ],
+                list(range(8, -1, -1)),
+            )
+
+        self.assertEqual(
+            list(model.new_manager.iterate_chunks(
+                2, values=('number',)
+            ))[:2],
+            [{'number': 0}, {'number': 1}],
+        )
+        self.assertEqual(
+            list(model.new_manager.iterate_chunks(2, values=()))[0],
+            {'id': pks[0], 'number': 0},
+        )
+        self.assertEqual(
+            list(iterate_chunks(
+                model.objects.filter(number__gt=5), 2, 'number', ('pk',)
+            )),
+            [{'pk': pks[6]}, {'pk': pks[7]}, {'pk': pks[8]}],
+        )
+
+    def test_bulk_update(self):
+        u"""Проверка обновления полей нескольких объектов."""
+        from django.contrib.contenttypes.models import ContentType
+        from myapp.models import Model1
+        from myapp.models import Model2
+
+        model = get_model('myapp', 'ModelWithCustomManager')
+        objs = [model.objects.create(number=i) for i in range(1500)]
+        for obj in objs:
+            obj.number = -obj.number
+
+        # Количество объектов в запросе ограничено количеством параметров.
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            model.new_manager.bulk_update(objs, ['number'])
+        self.assertGreater(
+            len([query for query in queries if 'UPDATE' in query['sql']]), 1
+        )
+        self.assertEqual(
+            sorted(model.objects.values_list('number', flat=True)),
+            list(range(-1499, 1)),
+        )
+
+        # Объекты, не входящие в выборку, не обновляются.
+        for obj in objs:
+            obj.number = 1
+        bulk_update(model.objects.filter(number__gt=-10), objs, ['number'])
+        self.assertEqual(model.objects.filter(number=1).count(), 10)
+
+        model1_objs = [
+            Model1.objects.create(simple_field=str(i)) for i in range(2)
+        ]
+        obj = Model2.objects.create(
+            simple_field='a', fk_field=model1_objs[0],
+            content_type=ContentType.objects.get_for_model(Model1),
+            object_id=1,
+        )
+        obj.simple_field = 'b'
+        obj.fk_field = model1_objs[1]
+        bulk_update(
+            Model2.objects, [obj], ['simple_field', 'fk_field'], batch_size=1
+        )
+        obj = Model2.objects.get(pk=obj.pk)
+        self.assertEqual(obj.simple_field, 'b')
+        self.assertEqual(obj.fk_field_id, model1_objs[1].pk)
+
+        bulk_update(Model2.objects, [], ['simple_field'])
+        with self.assertRaises(ValueError):
+            bulk_update(Model2.objects, [obj], ['id'])
+        with self.assertRaises(ValueError):
+            bulk_update(Model2.objects, [Model2()], ['simple_field'])
+
+    def test_in_bulk_chunked(self):
+        u"""Проверка загрузки объектов по списку идентификаторов."""
+        from django.contrib.contenttypes.models import ContentType
+        from myapp.models import Model1
+        from myapp.models import Model2
+        from myapp.models import Model3
+        from myapp.models import ReferenceGroup
+        from myapp.models import ReferenceGroupItem
+
+        model = get_model('myapp', 'ModelWithCustomManager')
+        objs = [model.objects.create(number=i) for i in range(10)]
+        pks = [obj.pk for obj in objs]
+
+        with self.assertNumQueries(4):
+            result = model.new_manager.in_bulk_chunked(
+                pks + pks[:3] + [-1], chunk_size=3, threads=2
+            )
+        self.assertEqual(result, dict((obj.pk, obj) for obj in objs))
+        self.assertEqual(
+            sorted(in_bulk_chunked(
+                model.objects.filter(number__lt=5), range(10), 'number',
+            )),
+            list(range(5)),
+        )
+        self.assertEqual(in_bulk_chunked(model.objects, []), {})
+
+        # Для внешних ключей ключами результата являются идентификаторы.
+        model1_objs = [
+            Model1.objects.create(simple_field=str(i)) for i in range(2)
+        ]
+        model2_objs = [
+            Model2.objects.create(
+                simple_field='a', fk_field=model1_obj,
+                content_type=ContentType.objects.get_for_model(Model1),
+                object_id=1,
+            )
+            for model1_obj in model1_objs
+        ]
+        with self.assertNumQueries(1):
+            result = in_bulk_chunked(
+                Model2.objects, [obj.pk for obj in model1_objs], 'fk_field'
+            )
+            self.assertEqual(
+                result,
+                dict((obj.fk_field_id, obj) for obj in model2_objs)
+            )
+
+        # В SQLite количество значений в запросе ограничено количеством
+        # параметров.
+        with CaptureQueriesContext(connections[DEFAULT_DB_ALIAS]) as queries:
+            in_bulk_chunked(model.objects, range(2000), chunk_size=2000)
+        self.assertGreater(len(queries), 1)
+
+        model1 = Model1.objects.create(simple_field='a')
+        model3_objs = []
+        for _ in range(5):
+            obj = Model3.objects.create(simple_field='b')
+            obj.m2m_field.add(model1)
+            model3_objs.append(Model3.objects.get(pk=obj.pk))
+        with self.assertNumQueries(3):
+            prefetch_related_chunked(model3_objs, 'm2m_field', chunk_size=2)
+        with self.assertNumQueries(0):
+            self.assertTrue(all(
+                list(obj.m2m_field.all()) == [model1] for obj in model3_objs
+            ))
+
+        group = ReferenceGroup.objects.create(name='a')
+        for _ in range(3):
+            ReferenceGroupItem.objects.create(group=group)
+        items = list(ReferenceGroupItem.objects.all())
+        with self.assertNumQueries(2):
+            ReferenceGroupItem.objects.prefetch_related_chunked(
+                items, 'group', chunk_size=2
+            )
+        with self.assertNumQueries(0):
+            self.assertTrue(all(item.group == group for item in items))
+
+    def _check_bulk_upsert(self, upsert):
+        from myapp.models import ReferenceItem
+
+        ReferenceItem.objects.create(code='1', name='old', version=1)
+        ReferenceItem.objects.create(code='2', name='old', version=1)
+
+        upsert([
+            ReferenceItem(code='1', name='a'),
+            ReferenceItem(code='3', name='c'),
+            ReferenceItem(code='3', name='c2'),
+        ], ['code'], ['name'])
+        self.assertEqual(
+            list(ReferenceItem.objects.order_by('code').values_list(
+                'code', 'name', 'version'
+            )),
+            [('1', 'a', 1), ('2', 'old', 1), ('3', 'c2', 0)],
+        )
+
+        # Без обновляемых полей существующие записи не изменяются.
+        upsert([
+            ReferenceItem(code='2', name='b'),
+            ReferenceItem(code='4', name='d'),
+        ], ['code'], [])
+        self.assertEqual(
+            list(ReferenceItem.objects.order_by('code').values_list(
+                'code', 'name'
+            )),
+            [('1', 'a'), ('2', 'old'), ('3', 'c2'), ('4', 'd')],
+        )
+
+    def test_bulk_upsert(self):
+        u"""Проверка добавления или обновления нескольких объектов."""
+        from myapp.models import ReferenceItem
+
+        self._check_bulk_upsert(
+            lambda objs, unique_fields, update_fields: (
+                ReferenceItem.objects.bulk_upsert(
+                    objs, unique_fields, update_fields, batch_size=1
+                )
+            )
+        )
+
+        with self.assertRaises(ValueError):
+            bulk_upsert(ReferenceItem.objects, [], ['code'], ['code'])
+        with self.assertRaises(ValueError):
+            bulk_upsert(ReferenceItem.objects, [], [], ['name'])
+        # Запросы INSERT ... ON CONFLICT не учитывают условия выборки.
+        with self.assertRaises(ValueError):
+            bulk_upsert(
+                ReferenceItem.objects.filter(version=1),
+                [ReferenceItem(code='1', name='x')], ['code'], ['name'],
+            )
+        with self.assertRaises(ValueError):
+            bulk_upsert(ReferenceItem.objects.all()[:1], [], ['code'])
+
+    def test_bulk_upsert_fallback(self):
+        u"""Проверка добавления или обновления объектов без ON CONFLICT."""
+        from m3_django_compat.queries import _bulk_upsert_fallback
+        from myapp.models import ReferenceItem
+
+        def upsert(objs, unique_fields, update_fields):
+            get_field = ReferenceItem._meta.get_field
+            # Объекты с одинаковыми значениями уникальных полей исключаются
+            # функцией bulk_upsert.
+            objs = [obj for obj in objs if obj.name != 'c']
+            _bulk_upsert_fallback(
+                ReferenceItem.objects.all(), objs,
+                [get_field(name) for name in unique_fields],
+                [get_field(name) for name in update_fields],
+                None,
+            )
+
+        self._check_bulk_upsert(upsert)
+
+        upsert(
+            [ReferenceItem(code='1', name='a', version=5)],
+            ['code', 'name'], ['version'],
+        )
+        self.assertEqual(ReferenceItem.objects.get(code='1').version, 5)
+
+        # Значения уникальных полей приводятся к типам полей.
+        upsert([ReferenceItem(code=1, name='int')], ['code'], ['name'])
+        self.assertEqual(ReferenceItem.objects.get(code='1').name, 'int')
+        self.assertEqual(ReferenceItem.objects.filter(code='1').count(), 1)
+
+
+class IdentityMapTestCase(TestCase):
+
+    u"""Проверка карты идентичности объектов моделей."""
+
+    def setUp(self):
+        from myapp.models import ReferenceItem
+
+        self.model = ReferenceItem
+        self.manager = ReferenceItem.identity_objects
+        self.objs = [
+            ReferenceItem.objects.create(code=str(i), name=str(i))
+            for i in range(3)
+        ]
+
+    def test_get(self):
+        pk = self.objs[0].pk
+
+        # Вне блока карта идентичности не используется.
+        with self.assertNumQueries(2):
+            self.manager.get(pk=pk)
+            self.manager.get(pk=pk)
+
+        with identity_map() as objects:
+            with self.assertNumQueries(1):
+                obj = self.manager.get(pk=pk)
+                self.assertIs(self.manager.get(id=pk), obj)
+                self.assertIs(self.manager.get(pk__exact=str(pk)), obj)
+            self.assertEqual((objects.hits, objects.misses), (2, 1))
+
+            # Менеджер без карты идентичности и запросы с другими условиями.
+            with self.assertNumQueries(2):
+                self.assertIsNot(self.model.objects.get(pk=pk), obj)
+                self.assertEqual(self.manager.get(code='0'), obj)
+
+            # Сохранение и удаление объекта удаляют его из карты.
+            obj.name = 'new'
+            obj.save()
+            with self.assertNumQueries(1):
+                self.assertIsNot(self.manager.get(pk=pk), obj)
+            self.manager.get(pk=pk).delete()
+            with self.assertRaises(self.model.DoesNotExist):
+                self.manager.get(pk=pk)
+
+    def test_inherited_models(self):
+        u"""Объекты удаляются из карты при изменении через другие модели."""
+        from m3_django_compat.identity import IdentityMap
+        from myapp.models import CachedItem
+        from myapp.models import CachedItemChild
+        from myapp.models import ReferenceItemProxy
+
+        pk = self.objs[0].pk
+        with identity_map():
+            obj = self.manager.get(pk=pk)
+            ReferenceItemProxy.objects.get(pk=pk).save()
+            with self.assertNumQueries(1):
+                self.assertIsNot(self.manager.get(pk=pk), obj)
+
+            obj = self.manager.get(pk=pk)
+            ReferenceItemProxy.objects.get(pk=pk).delete()
+            with self.assertRaises(self.model.DoesNotExist):
+                self.manager.get(pk=pk)
+
+        child = CachedItemChild.objects.create(name='a', code='a')
+        parent = CachedItem.objects.get(pk=child.pk)
+        objects = IdentityMap()
+        objects.add(CachedItem.objects, [parent])
+        objects.add(CachedItemChild.objects, [child])
+        objects.discard(CachedItemChild, child.pk)
+        self.assertIsNone(objects.get(CachedItem.objects, parent.pk))
+        objects.add(CachedItemChild.objects, [child])
+        objects.discard(CachedItem, parent.pk)
+        self.assertIsNone(objects.get(CachedItemChild.objects, child.pk))
+
+    def test_in_bulk(self):
+        pks = [obj.pk for obj in self.objs]
+
+        with identity_map() as objects:
+            obj = self.manager.get(pk=pks[0])
+            with self.assertNumQueries(1):
+                result = self.manager.in_bulk(pks)
+            self.assertIs(result[pks[0]], obj)
+            with self.assertNumQueries(0):
+                self.assertEqual(self.manager.in_bulk(pks), result)
+            self.assertEqual((objects.hits, objects.misses), (4, 3))
+
+    def test_related_manager(self):
+        from myapp.models import ReferenceGroup
+        from myapp.models import ReferenceGroupItem
+
+        group1 = ReferenceGroup.objects.create(name='1')
+        group2 = ReferenceGroup.objects.create(name='2')
+        item = ReferenceGroupItem.objects.create(group=group1)
+
+        with identity_map():
+            self.assertEqual(
+                group1.referencegroupitem_set.get(pk=item.pk), item
+            )
+            # Менеджер связи не должен возвращать объект другого владельца.
+            with self.assertRaises(ReferenceGroupItem.DoesNotExist):
+                group2.referencegroupitem_set.get(pk=item.pk)
+            self.assertEqual(
+                group2.referencegroupitem_set.in_bulk([item.pk]), {}
+            )
+            self.assertIs(
+                ReferenceGroupItem.objects.get(pk=item.pk),
+                ReferenceGroupItem.objects.get(pk=item.pk),
+            )
+
+    def test_middleware(self):
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+        from m3_django_compat.identity import IdentityMap
+        from m3_django_compat.identity import pop_identity_map
+        from m3_django_compat.identity import push_identity_map
+        from m3_django_compat.middleware import IdentityMapMiddleware
+
+        request = RequestFactory().get('/test/')
+        middleware = IdentityMapMiddleware()
+        middleware.process_request(request)
+        self.assertIs(get_identity_map(), request.identity_map)
+        response = HttpResponse()
+        self.assertIs(
+            middleware.process_response(request, response), response
+        )
+        self.assertIsNone(get_identity_map())
+
+        # Блок закрывается и при обработке исключения.
+        middleware.process_request(request)
+        middleware.process_exception(request, ValueError())
+        self.assertIsNone(get_identity_map())
+        middleware.process_response(request, response)
+
+        # Блок, не закрытый при обработке предыдущего запроса, закрывается
+        # перед обработкой следующего.
+        push_identity_map()
+        middleware.process_request(request)
+        middleware.process_response(request, response)
+        self.assertIsNone(get_identity_map())
+
+        objects = push_identity_map()
+        with self.assertRaises(RuntimeError):
+            pop_identity_map(IdentityMap())
+        pop_identity_map(objects)
+        with self.assertRaises(RuntimeError):
+            pop_identity_map(objects)
+
+
+class CachedManagerTestCase(TransactionTestCase):
+
+    u"""Проверка менеджера с кэшированием результатов запросов."""
+
+    def setUp(self):
+        from myapp.models import Model1
+        from myapp.models import Model3
+
+        self.model = Model1
+        self.manager = Model1.cached_objects
+        self.objs = [
+            Model1.objects.create(simple_field=str(i)) for i in range(3)
+        ]
+        self.model3 = Model3
+        self.manager.invalidate_cache()
+
+    def test_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.manager.cached_all(), self.objs)
+            self.assertEqual(self.manager.cached_all(), self.objs)
+
+        with self.assertNumQueries(2):
+            obj = self.manager.cached_get(simple_field='1')
+            self.assertEqual(obj, self.objs[1])
+            self.assertIs(self.manager.cached_get(simple_field='1'), obj)
+            pks = [self.objs[0].pk]
+            self.assertEqual(
+                self.manager.cached_filter(pk__in=pks), self.objs[:1]
+            )
+            self.assertEqual(
+                self.manager.cached_filter(pk__in=tuple(pks)), self.objs[:1]
+            )
+
+        with self.assertNumQueries(1):
+            with self.assertRaises(self.model.DoesNotExist):
+                self.manager.cached_get(simple_field='x')
+
+        # Список возвращается копией.
+        self.manager.cached_all().pop()
+        with self.assertNumQueries(0):
+            self.assertEqual(len(self.manager.cached_all()), 3)
+
+    def test_timeout(self):
+        from m3_django_compat.managers import CachedManager
+
+        manager = CachedManager(timeout=0.05, backend=LocMemBackend())
+        manager.model = self.model
+        with self.assertNumQueries(1):
+            manager.cached_all()
+            manager.cached_all()
+        time.sleep(0.1)
+        with self.assertNumQueries(1):
+            manager.cached_all()
+
+    def test_invalidation(self):
+        self.manager.cached_all()
+        self.objs[0].save()
+        with self.assertNumQueries(1):
+            self.manager.cached_all()
+
+        self.objs[0].delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.manager.cached_all(), self.objs[1:])
+
+        # Изменение связей "многие ко многим" с обеих сторон.
+        obj = self.model3.objects.create(simple_field='m2m')
+        self.manager.cached_all()
+        obj.m2m_field.add(self.objs[1])
+        with self.assertNumQueries(1):
+            self.manager.cached_all()
+        self.objs[2].model3_set.add(obj)
+        with self.assertNumQueries(1):
+            self.manager.cached_all()
+
+    def test_invalidation_inherited(self):
+        u"""Сброс кэша при изменении объектов прокси и дочерних моделей."""
+        from m3_django_compat.managers import CachedManager
+        from myapp.models import CachedItem
+        from myapp.models import CachedItemChild
+        from myapp.models import CachedItemProxy
+
+        manager = CachedItem.cached_objects
+        objs = [CachedItem.objects.create(name=str(i)) for i in range(2)]
+        manager.cached_all()
+        proxy_obj = CachedItemProxy.objects.get(pk=objs[0].pk)
+        proxy_obj.name = 'proxy'
+        proxy_obj.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(manager.cached_all()[0].name, 'proxy')
+        proxy_obj.delete()
+        with self.assertNumQueries(1):
+            self.assertEqual(manager.cached_all(), objs[1:])
+
+        child_manager = CachedManager(backend=LocMemBackend())
+        child_manager.model = CachedItemChild
+        child = CachedItemChild.objects.create(name='a', code='a')
+        manager.cached_all()
+        child_manager.cached_all()
+
+        # Изменение дочерней модели сбрасывает кэш родительской.
+        child.name = 'child'
+        child.save()
+        with self.assertNumQueries(2):
+            self.assertEqual(manager.cached_all()[-1].name, 'child')
+            child_manager.cached_all()
+
+        # Изменение родительской модели сбрасывает кэш дочерней.
+        parent = CachedItem.objects.get(pk=child.pk)
+        parent.name = 'parent'
+        parent.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(child_manager.cached_all()[0].name, 'parent')
+
+        child.delete()
+        with self.assertNumQueries(2):
+            self.assertEqual(manager.cached_all(), objs[1:])
+            self.assertEqual(child_manager.cached_all(), [])
+
+    def test_transaction(self):
+        self.manager.cached_all()
+        with atomic():
+            self.objs[0].simple_field = 'new'
+            self.objs[0].save()
+            # До подтверждения транзакции кэш в ней не используется.
+            with self.assertNumQueries(2):
+                self.assertEqual(
+                    self.manager.cached_get(pk=self.objs[0].pk).simple_field,
+                    'new'
+                )
+                self.manager.cached_get(pk=self.objs[0].pk)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.manager.cached_get(pk=self.objs[0].pk).simple_field,
+                'new'
+            )
+            self.manager.cached_get(pk=self.objs[0].pk)
+
+        # При откате транзакции кэш не сбрасывается.
+        with self.assertRaises(ValueError):
+            with atomic():
+                self.objs[0].save()
+                raise ValueError()
+        with self.assertNumQueries(0):
+            self.manager.cached_get(pk=self.objs[0].pk)
+
+    def test_nested_rollback(self):
+        obj = self.objs[0]
+        self.manager.cached_get(pk=obj.pk)
+        with atomic():
+            obj.simple_field = 'new'
+            obj.save()
+            # Откат вложенного блока и очистка кэша транзакции не отменяют
+            # признак изменения модели в транзакции.
+            with self.assertRaises(ValueError):
+                with atomic():
+                    raise ValueError()
+            clear_transaction_cache()
+            self.assertEqual(
+                self.manager.cached_get(pk=obj.pk).simple_field, 'new'
+            )
+
+        with self.assertNumQueries(1):
+            self.assertEqual(
+                self.manager.cached_get(pk=obj.pk).simple_field, 'new'
+            )
+
+        # Откат внешней транзакции не сбрасывает кэш, а признак изменения
+        # не переносится в следующую транзакцию.
+        with self.assertRaises(ValueError):
+            with atomic():
+                obj.save()
+                raise ValueError()
+        with atomic():
+            with self.assertNumQueries(0):
+                self.manager.cached_get(pk=obj.pk)
+
+    def test_django_cache_backend(self):
+        from m3_django_compat.managers import CachedManager
+
+        manager = CachedManager(backend=DjangoCacheBackend())
+        manager.model = self.model
+        with self.assertNumQueries(1):
+            self.assertEqual(manager.cached_all(), self.objs)
+            self.assertEqual(manager.cached_all(), self.objs)
+
+        self.objs[0].save()
+        with self.assertNumQueries(1):
+            manager.cached_all()
 # -----------------------------------------------------------------------------
 # Проверка корректности обеспечения совместимости для Model API
 
@@ -212,6 +1561,131 @@ class ModelOptionsTestCase(TestCase):
         self.assertIsNotNone(related)
         self.assertIs(related.parent_model, get_model('myapp', 'Model1'))
 
+        if _VERSION >= (1, 8):
+            self.assertIs(related, get_related(field))
+            self.assertIs(related.field, field)
+            self.assertIs(related.related_model, get_model('myapp', 'Model2'))
+            self.assertEqual(related.model_name, 'model2')
+            self.assertEqual(
+                related.get_accessor_name(),
+                field.remote_field.get_accessor_name()
+                if _VERSION >= (1, 9) else
+                field.related.get_accessor_name()
+            )
+            self.assertIn(
+                related,
+                ModelOptions(
+                    get_model('myapp', 'Model1')
+                ).get_all_related_objects()
+            )
+
+    def test__get_field__index(self):
+        u"""Проверка поиска полей по индексу модели."""
+        model1 = get_model('myapp', 'Model1')
+        model2 = get_model('myapp', 'Model2')
+        opts = ModelOptions.for_model(model2)
+
+        self.assertIs(opts.get_field('fk_field'), model2._meta.get_field(
+            'fk_field'
+        ))
+        self.assertIs(opts.get_field('fk_field_id'), opts.get_field(
+            'fk_field'
+        ))
+        self.assertIs(
+            opts.get_field_by_name('fk_field'),
+            opts.get_field_by_name('fk_field'),
+        )
+
+        for _ in range(2):
+            with self.assertRaises(FieldDoesNotExist):
+                opts.get_field('missing')
+            with self.assertRaises(FieldDoesNotExist):
+                opts.get_field_by_name('missing')
+            with self.assertRaises(FieldDoesNotExist):
+                opts.get_field('gfk_field')
+
+        if _VERSION >= (1, 8):
+            # Отсутствующие поля запоминаются в get_field и get_field_by_name.
+            calls = []
+            get_field = model2._meta.get_field
+
+            def counting_get_field(name, *args, **kwargs):
+                calls.append(name)
+                return get_field(name, *args, **kwargs)
+
+            model2._meta.get_field = counting_get_field
+            try:
+                for _ in range(2):
+                    with self.assertRaises(FieldDoesNotExist):
+                        opts.get_field_by_name('missing_by_name')
+                    with self.assertRaises(FieldDoesNotExist):
+                        opts.get_field('missing_by_name')
+            finally:
+                del model2._meta.get_field
+            self.assertEqual(calls, ['missing_by_name'])
+
+        f, _, direct, m2m = ModelOptions.for_model(model1).get_field_by_name(
+            'model2'
+        )
+        self.assertFalse(direct)
+        self.assertFalse(m2m)
+        if _VERSION >= (1, 8):
+            self.assertIs(f.related_model, model2)
+
+    def test__resolve_field_path__function(self):
+        u"""Проверка разбора путей к полям моделей."""
+        model1 = get_model('myapp', 'Model1')
+        model2 = get_model('myapp', 'Model2')
+        model3 = get_model('myapp', 'Model3')
+        opts1 = ModelOptions(model1)
+        opts2 = ModelOptions(model2)
+        opts3 = ModelOptions(model3)
+
+        self.assertEqual(
+            resolve_field_path(model2, 'fk_field__simple_field'),
+            (
+                (opts2.get_field('fk_field'), model1),
+                (opts1.get_field('simple_field'), None),
+            )
+        )
+        self.assertIs(
+            resolve_field_path(model2, 'fk_field__simple_field'),
+            resolve_field_path(model2(), 'fk_field__simple_field'),
+        )
+        self.assertEqual(
+            resolve_field_path(model3, 'm2m_field__pk'),
+            (
+                (opts3.get_field('m2m_field'), model1),
+                (model1._meta.pk, None),
+            )
+        )
+
+        (_, related_model), = resolve_field_path(model1, 'model2')
+        self.assertIs(related_model, model2)
+
+        for path in ('missing', 'fk_field__missing', 'simple_field__name'):
+            with self.assertRaises(FieldDoesNotExist):
+                resolve_field_path(model2, path)
+
+    def test__for_model__method(self):
+        u"""Проверка кэширования экземпляров ModelOptions."""
+        model = get_model('myapp', 'Model1')
+
+        opts = ModelOptions.for_model(model)
+        self.assertIsInstance(opts, ModelOptions)
+        self.assertIs(opts.model, model)
+        self.assertIs(opts, ModelOptions.for_model(model))
+        self.assertIs(opts, ModelOptions.for_model(model()))
+        self.assertIsNot(opts, ModelOptions.for_model(
+            get_model('myapp', 'Model2')
+        ))
+
+        if _VERSION >= (1, 8):
+            from django.apps import apps
+            apps.clear_cache()
+
+            self.assertIsNot(opts, ModelOptions.for_model(model))
+
     def test__get_m2m_with_model__method(self):
         data = (
             dict(
@@ -274,6 +1748,61 @@ class ModelOptionsTestCase(TestCase):
         with self.assertRaises(FieldDoesNotExist):
             ModelOptions(model).get_field('model2')
 
+    def test__related_objects__cache(self):
+        u"""Проверка кэширования связей модели."""
+        for model_name in ('Model1', 'Model3'):
+            opts = ModelOptions(get_model('myapp', model_name))
+
+            related_objects = opts.get_all_related_objects()
+            self.assertIsInstance(related_objects, tuple)
+            self.assertIs(related_objects, opts.get_all_related_objects())
+
+            m2m_with_model = opts.get_m2m_with_model()
+            self.assertIsInstance(m2m_with_model, tuple)
+            self.assertIs(m2m_with_model, opts.get_m2m_with_model())
+
+# -----------------------------------------------------------------------------
+# Проверка графа связей между моделями
+
+
+class RelationGraphTestCase(TestCase):
+
+    def test_relation_graph(self):
+        u"""Проверка графа связей между моделями."""
+        from django.contrib.contenttypes.models import ContentType
+        from m3_django_compat.relations import get_relation_graph
+
+        model1 = get_model('myapp', 'Model1')
+        model2 = get_model('myapp', 'Model2')
+        model3 = get_model('myapp', 'Model3')
+        through = ModelOptions(model3).get_field('m2m_field')
+        through = get_related(through).through
+
+        graph = get_relation_graph()
+        self.assertIs(graph, get_relation_graph())
+
+        self.assertEqual(
+            set(graph.get_referencing_models(model1)),
+            set((model2, model3, through)),
+        )
+        self.assertEqual(
+            set(graph.get_referenced_models(model3, transitive=True)),
+            set((model1,)),
+        )
+        self.assertIn(
+            model2, graph.get_referencing_models(ContentType, transitive=True)
+        )
+
+        cascade_paths = graph.get_cascade_paths(model1)
+        self.assertEqual(set(cascade_paths), set((model2, through)))
+        self.assertEqual(
+            cascade_paths[model2],
+            (ModelOptions(model2).get_field('fk_field'),),
+        )
+        self.assertEqual(graph.get_protecting_fields(model1), ())
+
+        with self.assertRaises(LookupError):
+            graph.get_cascade_paths(object)
 # -----------------------------------------------------------------------------
 # Проверка базового класса для роутеров баз данных
 
@@ -304,6 +1833,149 @@ class DatabaseRouterTestCase(TestCase):
             self.assertTrue(
                 router.allow_migrate(DEFAULT_DB_ALIAS, 'user', 'CustomUser')
             )
+
+
+class TestReplicaRouter(ReplicaRouterBase):
+
+    replicas = ('other', 'replica')
+
+
+class ReplicaRouterTestCase(SimpleTestCase):
+
+    u"""Проверка роутера с чтением из реплик."""
+
+    allow_database_queries = True
+    databases = '__all__'
+
+    def test_strategies(self):
+        replicas = ('a', 'b', 'c')
+
+        class IncompleteStrategy(ReplicaStrategy):
+            pass
+
+        with self.assertRaises(TypeError):
+            IncompleteStrategy()
+
+        strategy = RoundRobinStrategy()
+        self.assertEqual(
+            [strategy.select(replicas) for _ in range(4)],
+            ['a', 'b', 'c', 'a'],
+        )
+
+        strategy = WeightedStrategy({'a': 0, 'b': 3}, default_weight=1)
+        selected = [strategy.select(replicas) for _ in range(1000)]
+        self.assertNotIn('a', selected)
+        self.assertGreater(selected.count('b'), selected.count('c'))
+
+        strategy = LeastRecentlyFailedStrategy(retry_interval=60)
+        strategy.mark_failed('a')
+        self.assertEqual(
+            [strategy.select(replicas) for _ in range(4)],
+            ['b', 'c', 'b', 'c'],
+        )
+        strategy.mark_failed('c')
+        strategy.mark_failed('b')
+        # Все реплики недавно давали ошибки - выбирается самая давняя.
+        self.assertEqual(strategy.select(replicas), 'a')
+        strategy.mark_recovered('b')
+        self.assertEqual(strategy.select(replicas), 'b')
+
+        strategy = LeastRecentlyFailedStrategy(retry_interval=0)
+        strategy.mark_failed('a')
+        self.assertIn('a', [strategy.select(replicas) for _ in range(3)])
+
+    def test_sticky(self):
+        router = TestReplicaRouter()
+        model = get_user_model()
+
+        self.assertEqual(
+            [router.db_for_read(model) for _ in range(3)],
+            ['other', 'replica', 'other'],
+        )
+        # Вне области sticky_scope запись не влияет на чтение.
+        self.assertEqual(router.db_for_write(model), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_read(model), 'replica')
+
+        with sticky_scope():
+            self.assertEqual(router.db_for_read(model), 'other')
+            with sticky_scope():
+                router.db_for_write(model)
+                self.assertTrue(is_pinned_to_primary())
+            # Запись во вложенной области действует и во внешней.
+            self.assertEqual(router.db_for_read(model), DEFAULT_DB_ALIAS)
+        self.assertFalse(is_pinned_to_primary())
+
+        with use_primary():
+            self.assertEqual(router.db_for_read(model), DEFAULT_DB_ALIAS)
+        with atomic():
+            self.assertEqual(router.db_for_read(model), DEFAULT_DB_ALIAS)
+        self.assertEqual(router.db_for_read(model), 'replica')
+
+    def test_routing(self):
+        from django.test.utils import override_settings
+        from myapp.models import ReferenceGroup
+        from myapp.models import ReferenceGroupItem
+        from myapp.models import ReferenceItem
+
+        router = TestReplicaRouter()
+        router.strategy = WeightedStrategy({'other': 1, 'replica': 0})
+        with override_settings(DATABASE_ROUTERS=[router]):
+            try:
+                with sticky_scope():
+                    self.assertFalse(ReferenceItem.objects.exists())
+                    obj = ReferenceItem.objects.create(code='1', name='1')
+                    self.assertEqual(obj._state.db, DEFAULT_DB_ALIAS)
+                    self.assertEqual(ReferenceItem.objects.get(), obj)
+
+                # Реплики в тестах не синхронизируются с основной БД.
+                with sticky_scope():
+                    self.assertFalse(ReferenceItem.objects.exists())
+
+                # Присваивание значения внешнему ключу не является записью.
+                group = ReferenceGroup.objects.create(name='1')
+                with sticky_scope():
+                    ReferenceGroupItem(group=group)
+                    self.assertEqual(
+                        router.db_for_write(ReferenceItem, instance=obj),
+                        DEFAULT_DB_ALIAS,
+                    )
+                    self.assertFalse(is_pinned_to_primary())
+                    # Сохранение объекта - запись.
+                    obj.save()
+                    self.assertTrue(is_pinned_to_primary())
+            finally:
+                ReferenceItem.objects.using(DEFAULT_DB_ALIAS).all().delete()
+                ReferenceGroup.objects.using(DEFAULT_DB_ALIAS).all().delete()
+
+    def test_middleware(self):
+        from django.test.client import RequestFactory
+        from django.http import HttpResponse
+        from m3_django_compat.middleware import ReplicaRoutingMiddleware
+
+        request = RequestFactory().get('/test/')
+        middleware = ReplicaRoutingMiddleware()
+        middleware.process_request(request)
+        TestReplicaRouter().db_for_write(get_user_model())
+        self.assertTrue(is_pinned_to_primary())
+        middleware.process_response(request, HttpResponse())
+        self.assertFalse(is_pinned_to_primary())
+
+        # Область закрывается и при обработке исключения.
+        middleware.process_request(request)
+        pin_to_primary()
+        middleware.process_exception(request, ValueError())
+        self.assertFalse(is_pinned_to_primary())
+        middleware.process_response(request, HttpResponse())
+
+        # Область, не закрытая при обработке предыдущего запроса,
+        # закрывается перед обработкой следующего.
+        push_sticky_scope()
+        pin_to_primary()
+        middleware.process_request(request)
+        self.assertFalse(is_pinned_to_primary())
+        middleware.process_response(request, HttpResponse())
+        with self.assertRaises(RuntimeError):
+            pop_sticky_scope()
 # -----------------------------------------------------------------------------
 
 
@@ -535,3 +2207,80 @@ class AuthTestCases(TestCase):
         self.assertFalse(is_authenticated(user))
 
 # -----------------------------------------------------------------------------
+
+
+class LazyAttributesTestCase(SimpleTestCase):
+
+    u"""Проверка отложенной загрузки атрибутов модуля."""
+
+    def test__import(self):
+        # Импорт m3_django_compat не должен приводить к загрузке модулей,
+        # необходимых только для отложенно загружаемых атрибутов. Модули,
+        # которые загружает сам Django (например, django.template.loader
+        # импортируется в django.forms начиная с Django 1.11), не
+        # учитываются.
+        output, _ = run_python(
+            'import sys, django.db.models; '
+            'loaded = set(sys.modules); '
+            'import m3_django_compat; '
+            'print(",".join(sorted(set(sys.modules) - loaded)))'
+        )
+        modules = set(output.strip().split(','))
+        self.assertFalse(modules & set((
+            'django.contrib.postgres.fields',
+            'django.core.management',
+            'django.http',
+            'django.template.loader',
+            'm3_django_compat.commands',
+        )))
+
+    def test__attributes(self):
+        import m3_django_compat
+        from django.core import management
+        from django.http import HttpResponse
+        from django.template import loader
+
+        self.assertIs(m3_django_compat.management, management)
+        self.assertIs(m3_django_compat.HttpResponse, HttpResponse)
+        self.assertIs(m3_django_compat.loader, loader)
+        self.assertTrue(
+            issubclass(m3_django_compat.BaseCommand, management.BaseCommand)
+        )
+        self.assertIn('JSONField', dir(m3_django_compat))
+        self.assertEqual(AUTH_USER_MODEL, 'user.CustomUser')
+        with self.assertRaises(AttributeError):
+            getattr(m3_django_compat, 'UndefinedAttribute')
+
+    def test__module_attributes(self):
+        u"""Атрибуты модуля изменяются в пространстве имен его функций."""
+        import m3_django_compat
+
+        generation = m3_django_compat._models_generation
+        m3_django_compat._models_generation = generation + 1
+        try:
+            self.assertEqual(
+                m3_django_compat.get_model.__globals__['_models_generation'],
+                generation + 1,
+            )
+        finally:
+            m3_django_compat._models_generation = generation
+        self.assertIs(
+            sys.modules['m3_django_compat.queries'],
+            m3_django_compat.queries,
+        )
+# -----------------------------------------------------------------------------
+
+
+class BenchmarkTestCase(SimpleTestCase):
+
+    u"""Проверка работоспособности бенчмарков."""
+
+    allow_database_queries = True
+    databases = '__all__'
+
+    def test__benchmarks(self):
+        stdout = StringIO()
+        with _StreamReplacer(stdout, StringIO()):
+            call_command('benchmark', number=1, stdout=stdout)
+        self.assertTrue(stdout.getvalue())
+# -----------------------------------------------------------------------------